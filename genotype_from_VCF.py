@@ -3,8 +3,18 @@
 ##print __name__
 
 import os
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
 import optparse
 import re
+import shutil
+import struct
+import tempfile
+import numpy as np
+import parallel_tools
 
 usage_line = """
 genotypes_from_VCF.py
@@ -19,29 +29,41 @@ Script that takes VCF file and parses it to produce input files for downstream a
 	2. A genotype matrix that is customizable for various downstream programs
 	3. A FASTA nucleotide alignment (with IUPAC ambiguities) for phylogenetic analysis (i.e., RAxML)
 	4. A FASTA trinary genotype alignment for phylogenetic analysis (i.e., SNAPP)
+	5. PLINK binary genotypes for programs that read .bed/.bim/.fam files
+	6. Binary genotype likelihood matrix and Beagle genotype likelihoods (i.e., NGSadmix)
 
 The script uses a sample sheet to correctly parse the desired samples, which is a tab-delimited text file \
 with four columns: (1) BAM input file name, (2) Sample name, (3) Population ID, and (4) Location. \
 User can designate various filtering criteria to eliminate unconfident or inappropriate variants. \
+To help choose them, --sweep reports the SNPs retained for every combination of grids of these criteria \
+from a single pass over the VCF. \
 User can specify any combination of the three outputs by using the appropriate flag. For the nucleotide \
 and trinary alignments, a genotype quality threshold is needed so that unreliable sites can be coded \
 as missing data (?). There is also the option to thin the number of SNPs by only taking 1 SNP per 10 kb, \
 so as not to violate the assumptions of many models that dictate SNPs should be independent (i.e., not \
 linked). The user specifies a naming prefix that will be used for naming the output files created. \
 The suffixes for the different file types are as follows:
-	1. Output VCF filtered by MAF, missing data, and other options and possibly thinned.
+	1. Output VCF filtered by MAF, missing data, and other options and possibly thinned: \
+.maf<#>.miss<#>[.thin<#>].recode.vcf (can be skipped with --no_vcf)
 	2. Genotype matrix output customizable for various downstream programs: .genotype
 	3. Nucleotide FASTA: .nucl.fasta
 	4. Trinary FASTA: .tri.fasta
-	5. Log files: .maf<#>.log (needs to be saved if specifying filtered VCF)
+	5. PLINK binary genotypes (alternative allele as A1, population IDs as family IDs): .bed, .bim, .fam
+	6. Binary genotype likelihood matrix (JSON header in the first 4096 bytes): .gl.bin; Beagle: .beagle.gz
 	
-Dependencies include the latest versions of R, with the package MASS installed, and VCFtools, all \
-included in the user's $PATH. This VCF must include the GP, GL, and GQ format/genotype flags. \
+Filtering is done by the script itself in a single pass over the (optionally gzip/BGZF compressed) VCF, \
+applying the same criteria VCFtools would. Dependencies include the latest version of R, with the package \
+MASS installed and included in the user's $PATH, and the NumPy Python module. When re-running from a \
+filtered VCF (--filvcf), parsed genotypes are cached next to it (<filvcf>.gtcache) so later runs skip parsing. A bgzip \
+compressed VCF can be decompressed on several processes (--threads), and if it has a .tbi or .csi index, \
+--regions and --contigs read only the variants in those regions (the cache is not used for region runs). This VCF must include the GP, GL, and GQ format/genotype flags. \
 
 python genotypes_from_VCF.py --samplsheet <samplesheet.txt> --vcf <in.vcf> --prefix <out_prefix> \
 [--maf <0-3> --miss <0-1> --gq <PHRED_genotype_quality> --qual <PHRED_variant_quality> --thin <#> \
---biallelic --nucl --trinary --genotype --locinfo <T/F> --refalt <T/F> --headers <0-4> --delimit <1/2> \
---filvcf <file.vcf>]
+--biallelic --nucl --trinary --plink --genotype --locinfo <T/F> --refalt <T/F> --headers <0-4> --delimit <1/2> --glbin <0/16/32> --beagle \
+--filvcf <file.vcf> --no_cache --no_vcf --block <#loci> --memory <MB> --threads <#> --regions <chr:start-end,...> \
+--contigs <chr,...> --workers <#> --sweep --sweep_maf <0-3,...> --sweep_miss <0-1,...> --sweep_gq <#,...> \
+--sweep_qual <#,...> --sweep_write]
 """
 
 
@@ -58,6 +80,7 @@ parser.add_option("--prefix", action = "store", dest = "prefix", help = "prefix
 parser.add_option("--nucl", action = "store_true", dest = "nucl", help = "create nucleotide FASTA alignment with IUPAC ambiguities for heterozygous sites [FALSE]", default = False)
 parser.add_option("--trinary", action = "store_true", dest = "tri", help = "create trinary FASTA alignment with 0, 1, 2 genotype codes [FALSE]", default = False)
 parser.add_option("--structure", action = "store_true", dest = "structure", help = "create genotype matrix input for Structure [FALSE]", default = False)
+parser.add_option("--plink", action = "store_true", dest = "plink", help = "create PLINK binary genotypes (.bed, .bim, and .fam) [FALSE]", default = False)
 parser.add_option("--genotype", action = "store", dest = "genotype", help = "type of genotype likelihood output: 0 = Option is off (no matrix output), 1 = PHRED, 2 = -Log10, 3 = Standardized, 4 = Genotype Uncertainty [0]", default = "0")
 parser.add_option("--gq", action = "store", dest = "gq", help = "threshold genotype PHRED quality score for reporting individual genotype [20]", default = "20")
 parser.add_option("--thin", action = "store", dest = "thin", help = "window size to use for thinning in bp (keeps first SNP it finds and ignores others) [10000]", default = "10000")
@@ -70,7 +93,23 @@ parser.add_option("--refalt", action = "store_true", dest = "refalt", help = "in
 parser.add_option("--headers", action = "store", dest = "headers", help = "specify which type of header to include in the genotype matrix (comma separated): 0 = none, 1 = matrix dimensions, 2 = sample IDs, 3 = population IDs, 4 = position and reference/alternative headers [1,2,3,4]", default = "1,2,3,4")
 parser.add_option("--delimit", action = "store", dest = "delimit", help = "specify which delimiter to use for the genotype matrix: 1 = space, 2 = tab [1]", default = "1")
 parser.add_option("--entropycomp", action = "store_true", dest = "entcomp", help = "create a genotype uncertainty matrix for direct comparison with Bayesian estimates from Entropy output [FALSE]", default = False)
+parser.add_option("--glbin", action = "store", dest = "glbin", help = "also write the genotype likelihood output as a memory-mappable binary matrix with a JSON header: 16 = float16, 32 = float32, 0 = Option is off [0]", default = "0")
+parser.add_option("--beagle", action = "store_true", dest = "beagle", help = "create gzip compressed Beagle genotype likelihoods for NGSadmix [FALSE]", default = False)
 parser.add_option("--filvcf", action = "store", type = "string", dest = "filvcf", help ="specify a filtered VCF for genotyping (e.g., re-running a script) - bipasses creating new VCF [N/A]", default = "")
+parser.add_option("--no_cache", action = "store_true", dest = "no_cache", help = "do not use or build the binary genotype cache (<filvcf>.gtcache) that speeds up re-runs on a filtered VCF [FALSE]", default = False)
+parser.add_option("--no_vcf", action = "store_true", dest = "no_vcf", help = "do not write the filtered VCF (genotype matrix and alignments are still created while filtering) [FALSE]", default = False)
+parser.add_option("--block", action = "store", dest = "block", help = "number of loci read from the VCF and processed together [10000]", default = "10000")
+parser.add_option("--memory", action = "store", dest = "memory", help = "memory (MB) used to gather each individual's genotypes for the FASTA, Structure, and Entropy comparison outputs [1024]", default = "1024")
+parser.add_option("--threads", action = "store", dest = "threads", help = "number of processes used to decompress a BGZF compressed (bgzip) VCF [1]", default = "1")
+parser.add_option("--regions", action = "store", dest = "regions", help = "only use variants in these regions (comma separated chromosome:start-end; needs a bgzip VCF with a .tbi or .csi index) [all]", default = "")
+parser.add_option("--contigs", action = "store", dest = "contigs", help = "only use variants on these chromosomes/scaffolds (comma separated; needs a bgzip VCF with a .tbi or .csi index) [all]", default = "")
+parser.add_option("--workers", action = "store", dest = "workers", help = "number of processes used to filter, parse, and recode shards of the VCF in parallel (re-runs from the genotype cache are not sharded) [1]", default = "1")
+parser.add_option("--sweep", action = "store_true", dest = "sweep", help = "report retained SNPs and per-sample missing data for every combination of the --sweep_* filter grids (one pass over --vcf or --filvcf) [FALSE]", default = False)
+parser.add_option("--sweep_maf", action = "store", dest = "sweep_maf", help = "comma separated MAF ranges (see --maf) for --sweep [0,1,2,3]", default = "0,1,2,3")
+parser.add_option("--sweep_miss", action = "store", dest = "sweep_miss", help = "comma separated missing data proportions (see --miss) for --sweep [0,0.25,0.5,0.75,1]", default = "0,0.25,0.5,0.75,1")
+parser.add_option("--sweep_gq", action = "store", dest = "sweep_gq", help = "comma separated genotype quality thresholds for --sweep [0,10,20,30]", default = "0,10,20,30")
+parser.add_option("--sweep_qual", action = "store", dest = "sweep_qual", help = "comma separated variant quality thresholds for --sweep [0,10,20,30]", default = "0,10,20,30")
+parser.add_option("--sweep_write", action = "store_true", dest = "sweep_write", help = "after --sweep, also create the requested outputs for the chosen --maf, --miss, --gq, and --qual combination [FALSE]", default = False)
 
 options, args = parser.parse_args()
 
@@ -79,66 +118,960 @@ options, args = parser.parse_args()
 ###       Filter VCF using user input         ###
 #################################################
 
-## Determine user input for MAF and thinning and use it to construct VCFtools, then run command
-def vcf_filter():
+## Filter the raw VCF in a single streaming pass using the user's MAF, missing data, quality, genotype quality,
+## biallelic, and thinning settings (the same criteria that used to be passed to two VCFtools runs)
+## As in VCFtools, genotypes with GQ below --gq have their GT set to missing (./.) before the missing data and MAF filters
+## are applied, and thinning keeps the first passing SNP and drops passing SNPs closer than --thin bp to it
+## Yields every header line and passing variant line so outputs can be created during the same pass, and writes
+## them to the filtered VCF unless filtered_vcf is None
+def vcf_filter(raw_vcf, filtered_vcf):
+	settings = filter_settings()
+	if filtered_vcf is not None:
+		vcf_out = open(filtered_vcf, "w")
+	formats = {}
+	last_kept = [None, 0]
+	[total, kept] = [0, 0]
+	
+	for vline in open_vcf(raw_vcf, parse_regions()):
+		if vline.startswith("#"):
+			if filtered_vcf is not None:
+				vcf_out.write(vline)
+			yield vline
+			continue
+		total += 1
+		vline = filter_line(vline, settings, formats)
+		if vline is None or not thin_pass(vline.split("\t", 2), settings["thin"], last_kept):
+			continue
+		kept += 1
+		if filtered_vcf is not None:
+			vcf_out.write(vline)
+		yield vline
+	
+	print "\n\n***Kept "+str(kept)+" of "+str(total)+" variants***\n\n"
+	if filtered_vcf is not None:
+		vcf_out.close()
+		print "\n\n###The filtered VCF is named "+filtered_vcf+"###\n\n"
+
+## Minimum and maximum minor allele frequency for each --maf range
+maf_ranges = {"0": [0.0, 1.0], "1": [0.05, 1.0], "2": [0.01, 0.0499999], "3": [0.0, 0.0499999]}
+
+## Collect the filter thresholds from the user's options into a dictionary (reporting the MAF and thinning settings)
+def filter_settings():
 	## MAF routine
+	[min_maf, max_maf] = maf_ranges[options.maf]
 	if options.maf == "0":
-		vcf_maf = ""
 		print "\n\n***VCF will not be filtered by MAF***\n\n"
 	elif options.maf == "1":
-		vcf_maf = "--maf 0.0500"
 		print "\n\n***Filtering VCF to MAF >= 0.05***\n\n"
 	elif options.maf == "2":
-		vcf_maf = "--maf 0.0100000 --max-maf 0.0499999"
 		print "\n\n***Filtering VCF to 0.01 <= MAF < 0.05***\n\n"
 	elif options.maf == "3":
-		vcf_maf = "--maf 0 --max-maf 0.0499999"
 		print "\n\n***Filtering VCF to MAF < 0.05***\n\n"
-	else:
-		print "\n\n***Error: a minor allele range needs to be specified!***\n\n"
 	
-	## Biallelic routine
-	if options.biallelic is True:
-		biallelic = "--min-alleles 2 --max-alleles 2"
-	else:
-		biallelic = ""
-
-	## construct genotype quality, MAF, missing data, and biallelic filtering command and run it
-	command = "vcftools --vcf "+str(options.vcf)+" --max-non-ref-af 0.99 "+str(vcf_maf)+" --minQ "+options.qual+" --minGQ "+options.gq+" --max-missing "+options.miss+" "+biallelic+" --recode --recode-INFO-all --out "+str(options.prefix)+".maf"+str(options.maf)+".miss"+str(options.miss)
-	print "\n\n###Using the following command with VCFtools to produce MAF filtered VCF###\n\n"
-	print command
-	os.system(command)
-
 	## Thinning routine (if applicable)
 	if options.thin is not None:
-		vcf_thin = options.thin
-		print "\n\n***Thinning to one SNP per "+options.thin+" bp using the following command***\n\n"
-		command = "vcftools --vcf "+str(options.prefix)+".maf"+str(options.maf)+".miss"+options.miss+".recode.vcf --thin "+str(vcf_thin)+" --recode --recode-INFO-all --out "+str(options.prefix)+".maf"+str(options.maf)+".miss"+options.miss+".thin"+options.thin
-		print command
-		os.system(command)
-#		os.system("mv "+options.prefix+".thin.recode.vcf "+options.prefix+".maf"+options.maf+".recode.vcf")
+		vcf_thin = int(options.thin)
+		print "\n\n***Thinning to one SNP per "+options.thin+" bp***\n\n"
 	else:
-		vcf_thin = ""
+		vcf_thin = 0
 		print "\n\n***No thinning will be performed***\n\n"
-	print "\n\n###The filtered VCF is named "+options.prefix+".maf"+options.maf+".recode.vcf###\n\n"
+	
+	return {"min_maf": min_maf, "max_maf": max_maf, "thin": vcf_thin, "qual": float(options.qual), "gq": float(options.gq), "called": float(options.miss)}
+
+## Apply every filter except thinning to one variant line
+## Returns None if the variant fails, otherwise the line (with low GQ genotypes set to missing)
+## Formats caches the GT and GQ positions of the last FORMAT column seen
+def filter_line(vline, settings, formats):
+	bar = vline.rstrip("\r\n").split("\t")
+	
+	## Variant quality and biallelic filters
+	if vcf_number(bar[5]) < settings["qual"]:
+		return None
+	if bar[4] == ".":
+		alleles = 1
+	else:
+		alleles = bar[4].count(",") + 2
+	if options.biallelic is True and alleles != 2:
+		return None
+	
+	## Genotype quality filter, counting called alleles among the remaining genotypes
+	if bar[8] != formats.get("format"):
+		formats["format"] = bar[8]
+		foo = bar[8].split(":")
+		formats["GT"] = foo.index("GT")
+		formats["GQ"] = foo.index("GQ") if "GQ" in foo else None
+	[GT, GQ] = [formats["GT"], formats["GQ"]]
+	allele_counts = [0] * alleles
+	[called, chromosomes, masked] = [0, 0, False]
+	for sample in xrange(9, len(bar)):
+		vcfchunks = bar[sample].split(":")
+		genotype = vcfchunks[GT].replace("|", "/").split("/")
+		chromosomes += len(genotype)
+		if GQ is None or len(vcfchunks) <= GQ or vcf_number(vcfchunks[GQ]) < settings["gq"]:
+			if genotype.count(".") != len(genotype):
+				vcfchunks[GT] = "/".join(["."] * len(genotype))
+				bar[sample] = ":".join(vcfchunks)
+				masked = True
+			continue
+		for allele in genotype:
+			if allele != "." and int(allele) < alleles:
+				allele_counts[int(allele)] += 1
+				called += 1
+	
+	## Missing data filter
+	if chromosomes == 0 or float(called) / chromosomes < settings["called"]:
+		return None
+	
+	## MAF filter (and VCFtools' --max-non-ref-af 0.99)
+	if called == 0:
+		return None
+	frequencies = [float(count) / called for count in allele_counts]
+	if min(frequencies) < settings["min_maf"] or min(frequencies) > settings["max_maf"]:
+		return None
+	if max(frequencies[1:] + [0.0]) > 0.99:
+		return None
+	
+	if masked:
+		return "\t".join(bar)+"\n"
+	return vline
+
+## Thinning filter: a passing variant is kept unless it is on the same chromosome as, and closer than vcf_thin bp to,
+## the last kept variant (last_kept holds its chromosome and position and is updated when the variant is kept)
+def thin_pass(bar, vcf_thin, last_kept):
+	position = int(bar[1])
+	if vcf_thin > 0 and bar[0] == last_kept[0] and position - last_kept[1] < vcf_thin:
+		return False
+	last_kept[0:2] = [bar[0], position]
+	return True
 
 
 #################################################
-###      Creating Genotype matrix output      ###
+###        Filter threshold sweep mode        ###
 #################################################
 
-## Create input file for Entropy program using sample sheet and VCF
-def geno_matrix(PL, GT, filtered_vcf, delimiter):
-	## Initialize output file
-	genomatrix_out = open(options.prefix+".genomatrix", "w")
+## Evaluate every combination of the --sweep_maf, --sweep_miss, --sweep_gq, and --sweep_qual grids in one pass over
+## the VCF, using the same criteria as vcf_filter (biallelic sites only, genotypes below the GQ threshold set to
+## missing, and thinning with --thin)
+## Per-site allele counts, call rates, QUAL, and per-genotype GQ are parsed once per block and every combination is
+## evaluated on those arrays. Writes a table of retained and post-thinning SNP counts (<prefix>.sweep.txt) and the
+## per-sample proportion of missing genotypes among the post-thinning SNPs (<prefix>.sweep.samples.txt)
+def filter_sweep(vcf):
+	mafs = options.sweep_maf.split(",")
+	misses = [float(value) for value in options.sweep_miss.split(",")]
+	gqs = [float(value) for value in options.sweep_gq.split(",")]
+	quals = [float(value) for value in options.sweep_qual.split(",")]
+	vcf_thin = int(options.thin) if options.thin is not None else 0
+	combos = {}
+	for maf in mafs:
+		if maf not in maf_ranges:
+			print "\n\n***Error: sweep MAF ranges must be 0, 1, 2, or 3!***\n\n"
+			raise SystemExit(1)
+		for miss in misses:
+			for gq in gqs:
+				for qual in quals:
+					combos[(maf, miss, gq, qual)] = {"retained": 0, "last_kept": [None, 0], "kept": 0, "missing": 0}
+	print "\n\n***Sweeping "+str(len(combos))+" filter combinations***\n\n"
 	
-	## Get matrix dimensions (samples x loci) from VCFtools log
-	if "1" in options.headers:
-		[samples, loci] = get_vcf_dims()
-		genomatrix_out.write(str(samples)+str(delimiter)+str(loci)+str(delimiter)+"1\n")
+	total = 0
+	vcf_samples = []
+	for block in sweep_blocks(open_vcf(vcf, parse_regions()), int(options.block)):
+		total += block["total"]
+		vcf_samples = block["vcf_samples"]
+		chromosomes = block["ploidy"].sum(axis = 1).astype(np.float64)
+		quals_pass = dict([[qual, block["qual"] >= qual] for qual in quals])
+		for gq in gqs:
+			unmasked = block["gq"] >= gq
+			ref = (block["ref"] * unmasked).sum(axis = 1).astype(np.float64)
+			alt = (block["alt"] * unmasked).sum(axis = 1).astype(np.float64)
+			called = ref + alt
+			missing = (block["ref"] + block["alt"]) * unmasked == 0
+			with np.errstate(divide = "ignore", invalid = "ignore"):
+				call_rate = np.where(chromosomes > 0, called / chromosomes, -1.0)
+				min_freq = np.where(called > 0, np.minimum(ref, alt) / called, -1.0)
+				alt_freq = np.where(called > 0, alt / called, 2.0)
+			for maf in mafs:
+				[min_maf, max_maf] = maf_ranges[maf]
+				maf_pass = (called > 0) & (min_freq >= min_maf) & (min_freq <= max_maf) & (alt_freq <= 0.99)
+				for miss in misses:
+					site_pass = maf_pass & (call_rate >= miss)
+					for qual in quals:
+						combo = combos[(maf, miss, gq, qual)]
+						loci = np.flatnonzero(site_pass & quals_pass[qual])
+						combo["retained"] += len(loci)
+						keep = [locus for locus in loci if thin_pass([block["chrom"][locus], block["pos"][locus]], vcf_thin, combo["last_kept"])]
+						combo["kept"] += len(keep)
+						combo["missing"] = combo["missing"] + missing[keep].sum(axis = 0)
+	print "\n\n***Read "+str(total)+" variants***\n\n"
 	
+	sweep_out = open(options.prefix+".sweep.txt", "w")
+	sweep_out.write("maf\tmiss\tgq\tqual\tretained\tthinned\tmean_sample_missing\n")
+	samples_out = open(options.prefix+".sweep.samples.txt", "w")
+	samples_out.write("maf\tmiss\tgq\tqual\t"+"\t".join(vcf_samples)+"\n")
+	for key in sorted(combos.keys()):
+		combo = combos[key]
+		settings = key[0]+"\t"+str(key[1])+"\t"+str(key[2])+"\t"+str(key[3])+"\t"
+		if combo["kept"] > 0:
+			missing = [float(count) / combo["kept"] for count in combo["missing"]]
+			[mean_missing, missing] = ["%.4f" % (sum(missing) / len(missing)), ["%.4f" % value for value in missing]]
+		else:
+			[mean_missing, missing] = ["NA", ["NA"] * len(vcf_samples)]
+		sweep_out.write(settings+str(combo["retained"])+"\t"+str(combo["kept"])+"\t"+mean_missing+"\n")
+		samples_out.write(settings+"\t".join(missing)+"\n")
+	sweep_out.close()
+	samples_out.close()
+	print "\n\n###The filter sweep results can be found in "+options.prefix+".sweep.txt and "+options.prefix+".sweep.samples.txt###\n\n"
+
+## Parse blocks of biallelic variants for the sweep: chromosome, position, QUAL, and for every VCF sample the number
+## of reference and alternative alleles called, the ploidy, and the GQ (missing = -1, no GQ tag = -infinity)
+## Each block also counts every variant read ("total") and gives the VCF sample IDs
+def sweep_blocks(vcf_lines, block_size):
+	block = new_sweep_block()
+	vcf_samples = []
+	format_column = None
+	for vline in vcf_lines:
+		if vline.startswith("#CHROM"):
+			vcf_samples = vline.rstrip().split("\t")[9:]
+		if vline.startswith("#"):
+			continue
+		block["total"] += 1
+		bar = vline.rstrip("\r\n").split("\t")
+		if options.biallelic is True and (bar[4] == "." or "," in bar[4]):
+			continue
+		if bar[8] != format_column:
+			format_column = bar[8]
+			foo = format_column.split(":")
+			GT = foo.index("GT")
+			GQ = foo.index("GQ") if "GQ" in foo else None
+		for sample in bar[9:]:
+			vcfchunks = sample.split(":")
+			genotype = vcfchunks[GT].replace("|", "/").split("/")
+			block["ref"].append(genotype.count("0"))
+			block["alt"].append(genotype.count("1"))
+			block["ploidy"].append(len(genotype))
+			if GQ is None or len(vcfchunks) <= GQ:
+				block["gq"].append(float("-inf"))
+			else:
+				block["gq"].append(vcf_number(vcfchunks[GQ]))
+		block["chrom"].append(bar[0])
+		block["pos"].append(int(bar[1]))
+		block["qual"].append(vcf_number(bar[5]))
+		if len(block["pos"]) == block_size:
+			yield finish_sweep_block(block, vcf_samples)
+			block = new_sweep_block()
+	yield finish_sweep_block(block, vcf_samples)
+
+def new_sweep_block():
+	return {"chrom": [], "pos": [], "qual": [], "ref": [], "alt": [], "ploidy": [], "gq": [], "total": 0}
+
+def finish_sweep_block(block, vcf_samples):
+	loci = len(block["pos"])
+	block["vcf_samples"] = vcf_samples
+	block["qual"] = np.array(block["qual"], dtype = np.float64)
+	for key in ["ref", "alt", "ploidy"]:
+		block[key] = np.array(block[key], dtype = np.int16).reshape(loci, len(vcf_samples))
+	block["gq"] = np.array(block["gq"], dtype = np.float64).reshape(loci, len(vcf_samples))
+	return block
+
+
+#################################################
+###     Read filtered VCF into NumPy arrays   ###
+#################################################
+
+## Integer codes used to store the GT field of each sample (any other GT string is coded as unknown)
+gt_codes = {"0/0": 0, "0/1": 1, "1/0": 2, "1/1": 3, "./.": 4}
+gt_unknown = 5
+
+## Read the lines of the filtered VCF once, yielding blocks of loci as NumPy arrays so no writer has to re-read the VCF
+## Each block is a dictionary with CHROM, POS, REF, and ALT arrays (one entry per locus), int8 GT codes
+## (loci x samples), and uint16 PL triplets (loci x samples x 3); missing or malformed PLs are stored as 0,0,0
+## If with_gq is True, GQ is also stored as int16 (loci x samples; missing = -1), and if sample_total is None
+## every sample column of the VCF is read
+## The location of GT, PL, and GQ in the FORMAT column is looked up whenever the FORMAT column changes
+def read_vcf_blocks(vcf_lines, sample_total, block_size = 10000, with_gq = False):
+	block = new_block(with_gq)
+	format_column = None
+	for vline in vcf_lines:
+		if vline.startswith("#"):
+			continue
+		bar = vline.rstrip().split("\t")
+		if bar[8] != format_column:
+			format_column = bar[8]
+			(GT, PL, GQ) = get_stat(format_column)
+		if sample_total is None:
+			vcfchunks = [target.split(":") for target in bar[9:]]
+		else:
+			vcfchunks = [target.split(":") for target in bar[9:sample_total+9]]
+		block["chrom"].append(bar[0])
+		block["pos"].append(int(bar[1]))
+		block["ref"].append(bar[3])
+		block["alt"].append(bar[4])
+		block["gt"].append([gt_codes.get(chunk[GT], gt_unknown) for chunk in vcfchunks])
+		block["pl"].extend(parse_pl(vcfchunks, PL))
+		if with_gq is True:
+			block["gq"].append(parse_gq(vcfchunks, GQ))
+		block["vcf_samples"] = len(bar) - 9
+		if len(block["pos"]) == block_size:
+			yield finish_block(block, sample_total)
+			block = new_block(with_gq)
+	if len(block["pos"]) > 0:
+		yield finish_block(block, sample_total)
+
+def new_block(with_gq = False):
+	block = {"chrom": [], "pos": [], "ref": [], "alt": [], "gt": [], "pl": [], "vcf_samples": 0}
+	if with_gq is True:
+		block["gq"] = []
+	return block
+
+## Convert the lists collected for a block into compact NumPy arrays
+def finish_block(block, sample_total):
+	loci = len(block["pos"])
+	if sample_total is None:
+		sample_total = block["vcf_samples"]
+	block["chrom"] = np.array(block["chrom"], dtype = str)
+	block["pos"] = np.array(block["pos"], dtype = np.int64)
+	block["ref"] = np.array(block["ref"], dtype = str)
+	block["alt"] = np.array(block["alt"], dtype = str)
+	block["gt"] = np.array(block["gt"], dtype = np.int8).reshape(loci, sample_total)
+	block["pl"] = np.minimum(np.array(block["pl"], dtype = np.int64), 65535).astype(np.uint16).reshape(loci, sample_total, 3)
+	if "gq" in block:
+		block["gq"] = np.clip(np.array(block["gq"], dtype = np.int64), -1, 32767).astype(np.int16).reshape(loci, sample_total)
+	return block
+
+## Parse the PL triplets of every sample at a locus in one go, falling back to sample-by-sample parsing
+## when a sample is missing its PL, has a malformed one (e.g., '.'), or has more than three values (only
+## the first three are used)
+def parse_pl(vcfchunks, PL):
+	try:
+		values = [int(value) for chunk in vcfchunks for value in chunk[PL].split(",")]
+		if len(values) == 3 * len(vcfchunks):
+			return values
+	except (IndexError, ValueError):
+		pass
+	values = []
+	for chunk in vcfchunks:
+		try:
+			triplet = [int(value) for value in chunk[PL].split(",")][0:3]
+		except (IndexError, ValueError):
+			triplet = []
+		if len(triplet) != 3:
+			triplet = [0, 0, 0]
+		values.extend(triplet)
+	return values
+
+## Parse the GQ of every sample at a locus (missing, malformed, or absent GQ = -1)
+def parse_gq(vcfchunks, GQ):
+	values = []
+	for chunk in vcfchunks:
+		try:
+			values.append(int(chunk[GQ]))
+		except (TypeError, IndexError, ValueError):
+			values.append(-1)
+	return values
+
+#################################################
+###     Binary genotype cache for re-runs     ###
+#################################################
+
+## Genotypes parsed from a previously filtered VCF are cached next to it (<vcf>.gtcache) as raw binary arrays of
+## GT codes, PL triplets, GQ, and POS for every sample column, plus NumPy files of CHROM, REF, and ALT. Later runs
+## on the same VCF (e.g., for other matrix formats, delimiters, or headers) memory-map these arrays instead of
+## parsing text. The cache stores the VCF's size, modification time, and a hash of its content (see vcf_stamp)
+## and is rebuilt automatically when any of these change
+def cached_blocks(filtered_vcf, sample_total, block_size):
+	cache = filtered_vcf+".gtcache"
+	stamp = vcf_stamp(filtered_vcf)
+	try:
+		meta = json.load(open(os.path.join(cache, "meta.json"), "r"))
+	except (IOError, ValueError):
+		meta = None
+	if meta is not None and meta["stamp"] == stamp and meta["vcf_samples"] >= sample_total:
+		print "\n\n***Reading genotypes from the binary cache "+cache+"***\n\n"
+		return read_cache_blocks(cache, meta, sample_total, block_size)
+	print "\n\n***Parsing "+filtered_vcf+" and building the binary genotype cache "+cache+"***\n\n"
+	return write_cache_blocks(filtered_vcf, cache, stamp, sample_total, block_size)
+
+## Yield blocks of loci straight from the memory-mapped cache (no copies are made until the writers use them)
+def read_cache_blocks(cache, meta, sample_total, block_size):
+	[loci, vcf_samples] = [meta["loci"], meta["vcf_samples"]]
+	if loci == 0:
+		return
+	gt = np.memmap(os.path.join(cache, "gt.bin"), dtype = np.int8, mode = "r", shape = (loci, vcf_samples))
+	pl = np.memmap(os.path.join(cache, "pl.bin"), dtype = np.uint16, mode = "r", shape = (loci, vcf_samples, 3))
+	gq = np.memmap(os.path.join(cache, "gq.bin"), dtype = np.int16, mode = "r", shape = (loci, vcf_samples))
+	pos = np.memmap(os.path.join(cache, "pos.bin"), dtype = np.int64, mode = "r", shape = (loci,))
+	sites = {}
+	for key in ["chrom", "ref", "alt"]:
+		sites[key] = np.load(os.path.join(cache, key+".npy"))
+	for first in xrange(0, loci, block_size):
+		last = min(first + block_size, loci)
+		yield {"chrom": sites["chrom"][first:last], "pos": pos[first:last], "ref": sites["ref"][first:last], "alt": sites["alt"][first:last], "gt": gt[first:last, 0:sample_total], "pl": pl[first:last, 0:sample_total], "gq": gq[first:last, 0:sample_total], "vcf_samples": vcf_samples}
+
+## Parse the VCF (all sample columns, including GQ) and write each block to a new cache while yielding it
+## The cache is built in a temporary directory and only moved into place once the whole VCF has been read,
+## so an interrupted run never leaves a cache that looks valid
+def write_cache_blocks(filtered_vcf, cache, stamp, sample_total, block_size):
+	building = cache+".tmp"+str(os.getpid())
+	try:
+		os.mkdir(building)
+	except OSError:
+		print "\n\n***Cannot create the binary genotype cache "+cache+"; continuing without it***\n\n"
+		for block in read_vcf_blocks(open_vcf(filtered_vcf), sample_total, block_size):
+			yield block
+		return
+	arrays = {}
+	for key in ["gt", "pl", "gq", "pos"]:
+		arrays[key] = open(os.path.join(building, key+".bin"), "wb")
+	sites = {"chrom": [], "ref": [], "alt": []}
+	[loci, vcf_samples] = [0, 0]
+	for block in read_vcf_blocks(open_vcf(filtered_vcf), None, block_size, True):
+		for key in arrays.keys():
+			arrays[key].write(np.ascontiguousarray(block[key]).tostring())
+		for key in sites.keys():
+			sites[key].append(block[key])
+		loci += len(block["pos"])
+		vcf_samples = block["vcf_samples"]
+		yield trim_block(block, sample_total)
+	for key in arrays.keys():
+		arrays[key].close()
+	for key in sites.keys():
+		np.save(os.path.join(building, key+".npy"), np.concatenate(sites[key]) if len(sites[key]) > 0 else np.array([], dtype = str))
+	meta = {"stamp": stamp, "loci": loci, "vcf_samples": vcf_samples}
+	json.dump(meta, open(os.path.join(building, "meta.json"), "w"))
+	shutil.rmtree(cache, ignore_errors = True)
+	try:
+		os.rename(building, cache)
+	except OSError:
+		shutil.rmtree(building, ignore_errors = True)
+
+## Size, modification time, and MD5 hash of the first and last megabyte (plus size) of a VCF, used to decide
+## whether a genotype cache still matches it
+def vcf_stamp(vcf):
+	info = os.stat(vcf)
+	md5 = hashlib.md5(str(info.st_size))
+	handle = open(vcf, "rb")
+	md5.update(handle.read(1048576))
+	handle.seek(max(0, info.st_size - 1048576))
+	md5.update(handle.read(1048576))
+	handle.close()
+	return {"size": info.st_size, "mtime": info.st_mtime, "hash": md5.hexdigest()}
+
+## Keep only the first sample_total individuals of a block
+def trim_block(block, sample_total):
+	for key in ["gt", "pl", "gq"]:
+		if key in block:
+			block[key] = block[key][:, 0:sample_total]
+	return block
+
+
+#################################################
+###   Sharded parallel processing (--workers) ###
+#################################################
+
+## Read, filter (if settings are given), and recode the VCF on --workers processes and yield its blocks in order
+## Plain text VCFs are split into byte ranges aligned to record boundaries that each worker reads itself, while
+## compressed (or region) input is read here and handed out in batches of records. Workers apply every filter
+## except thinning, parse their records into blocks, and format the genotype matrix rows; thinning, writing the
+## filtered VCF, and all other outputs happen here in the original record order, so the results are identical
+## to a serial run
+def sharded_blocks(vcf, settings, filtered_vcf, sample_total, block_size, delimiter):
+	workers = int(options.workers)
+	vcf_out = open(filtered_vcf, "w") if filtered_vcf is not None else None
+	last_kept = [None, 0]
+	[total, kept] = [0, 0]
+	pool = multiprocessing.Pool(workers)
+	try:
+		jobs = ([shard, settings, sample_total, block_size, delimiter] for shard in vcf_shards(vcf, workers, block_size, vcf_out))
+		for [shard_total, blocks] in parallel_tools.ordered_results(pool, shard_worker, jobs, 2 * workers):
+			total += shard_total
+			for block in blocks:
+				if settings is not None and settings["thin"] > 0:
+					keep = [thin_pass([block["chrom"][locus], block["pos"][locus]], settings["thin"], last_kept) for locus in xrange(len(block["pos"]))]
+					if not all(keep):
+						block = subset_block(block, np.array(keep, dtype = bool))
+				kept += len(block["pos"])
+				if filtered_vcf is not None:
+					vcf_out.write("".join(block["lines"]))
+				if len(block["pos"]) > 0:
+					yield block
+	finally:
+		pool.terminate()
+	if settings is not None:
+		print "\n\n***Kept "+str(kept)+" of "+str(total)+" variants***\n\n"
+	if filtered_vcf is not None:
+		vcf_out.close()
+		print "\n\n###The filtered VCF is named "+filtered_vcf+"###\n\n"
+
+## Split the VCF into shards after copying its header to header_out (unless it is None)
+## A shard is either a (file, start, end) byte range or a list of record lines
+def vcf_shards(vcf, workers, block_size, header_out):
+	regions = parse_regions()
+	handle = open(vcf, "rb")
+	compressed = handle.read(2) == "\x1f\x8b"
+	handle.close()
+	if compressed or regions is not None:
+		batch = []
+		for vline in open_vcf(vcf, regions):
+			if vline.startswith("#"):
+				if header_out is not None:
+					header_out.write(vline)
+				continue
+			batch.append(vline)
+			if len(batch) == block_size:
+				yield batch
+				batch = []
+		if len(batch) > 0:
+			yield batch
+		return
+	handle = open(vcf, "r")
+	start = 0
+	for vline in iter(handle.readline, ""):
+		if not vline.startswith("#"):
+			break
+		if header_out is not None:
+			header_out.write(vline)
+		start += len(vline)
+	handle.close()
+	size = os.path.getsize(vcf)
+	shard_size = max(65536, min(64 * 1024 * 1024, (size - start) / (workers * 4)))
+	while start < size:
+		yield (vcf, start, min(start + shard_size, size))
+		start += shard_size
+
+## Process one shard in a worker (see sharded_blocks); returns the number of variants read and the list of blocks,
+## each with its VCF lines ("lines") and its genotype matrix rows ("genomatrix", if a delimiter is given)
+def shard_worker(job):
+	[shard, settings, sample_total, block_size, delimiter] = job
+	formats = {}
+	lines = []
+	total = 0
+	for vline in shard_lines(shard):
+		if vline.startswith("#"):
+			continue
+		total += 1
+		if settings is not None:
+			vline = filter_line(vline, settings, formats)
+		if vline is not None:
+			lines.append(vline)
+	blocks = []
+	first = 0
+	for block in read_vcf_blocks(lines, sample_total, block_size):
+		block["lines"] = lines[first:first + len(block["pos"])]
+		first += len(block["pos"])
+		if delimiter is not None:
+			block["genomatrix"] = geno_rows(block, delimiter, sample_total)
+		blocks.append(block)
+	return [total, blocks]
+
+## Yield the records whose first byte lies in a (file, start, end) byte range, or the lines of a batch
+def shard_lines(shard):
+	if isinstance(shard, tuple):
+		[vcf, start, end] = shard
+		handle = open(vcf, "r")
+		if start > 0:
+			handle.seek(start - 1)
+			start += len(handle.readline()) - 1
+		for vline in iter(handle.readline, ""):
+			if start >= end:
+				break
+			start += len(vline)
+			yield vline
+		handle.close()
+	else:
+		for vline in shard:
+			yield vline
+
+## Keep only the loci of a block selected by a boolean mask
+def subset_block(block, keep):
+	for key in ["chrom", "pos", "ref", "alt", "gt", "pl"]:
+		block[key] = block[key][keep]
+	for key in ["lines", "genomatrix"]:
+		if key in block:
+			block[key] = [block[key][locus] for locus in np.flatnonzero(keep)]
+	return block
+
+
+#################################################
+###     Compressed and indexed VCF input      ###
+#################################################
+
+## Open a VCF for reading, whether it is plain text or gzip/BGZF compressed (detected from the first bytes)
+## BGZF files are decompressed block by block on --threads processes, and if regions are given (a list of
+## [chromosome, start, end] from parse_regions) only the header and the records overlapping them are read,
+## using the .tbi or .csi index next to the VCF
+def open_vcf(vcf, regions = None):
+	handle = open(vcf, "rb")
+	magic = handle.read(16)
+	handle.close()
+	bgzf = magic[0:2] == "\x1f\x8b" and magic[12:14] == "BC"
+	if regions is not None:
+		if not bgzf:
+			print "\n\n***Error: --regions and --contigs need a BGZF compressed (bgzip) VCF with a .tbi or .csi index!***\n\n"
+			raise SystemExit(1)
+		return region_lines(vcf, regions)
+	if bgzf and int(options.threads) > 1:
+		return parallel_tools.bgzf_lines(vcf, int(options.threads))
+	if magic[0:2] == "\x1f\x8b":
+		return io.BufferedReader(gzip.open(vcf, "rb"))
+	return open(vcf, "r")
+
+## Yield the lines between two BGZF virtual offsets (compressed block offset << 16 | offset within the block)
+## If end is None, lines are read to the end of the file
+def bgzf_range_lines(handle, start, end):
+	handle.seek(start >> 16)
+	within = start & 0xFFFF
+	remainder = ""
+	while True:
+		coffset = handle.tell()
+		if end is not None and coffset > (end >> 16):
+			break
+		block = parallel_tools.read_bgzf_block(handle)
+		if block is None:
+			break
+		data = parallel_tools.inflate_bgzf_block(block)
+		if end is not None and coffset == (end >> 16):
+			data = data[within:end & 0xFFFF]
+		else:
+			data = data[within:]
+		within = 0
+		lines = (remainder + data).split("\n")
+		remainder = lines.pop()
+		for line in lines:
+			yield line+"\n"
+	if remainder != "":
+		yield remainder
+
+## Yield the VCF header followed by every record overlapping the regions, in index order
+## Regions are merged and sorted first so no record is returned twice
+def region_lines(vcf, regions):
+	index = read_vcf_index(vcf)
+	handle = open(vcf, "rb")
+	for line in bgzf_range_lines(handle, 0, None):
+		if not line.startswith("#"):
+			break
+		yield line
+	for [chrom, beg, end] in merge_regions(regions, index["names"]):
+		if chrom not in index["names"]:
+			print "\n\n***Warning: "+chrom+" is not in the VCF index and will be skipped***\n\n"
+			continue
+		for [chunk_beg, chunk_end] in region_chunks(index, index["names"].index(chrom), beg, end):
+			for line in bgzf_range_lines(handle, chunk_beg, chunk_end):
+				bar = line.split("\t", 5)
+				position = int(bar[1]) - 1
+				if bar[0] != chrom or position + len(bar[3]) <= beg:
+					continue
+				if position >= end:
+					break
+				yield line
+	handle.close()
+
+## Parse --regions (chromosome, chromosome:start, or chromosome:start-end; 1-based and inclusive) and --contigs
+## (whole chromosomes) into a list of [chromosome, start, end] with 0-based, half-open coordinates
+## Returns None if neither option was given
+def parse_regions():
+	if options.regions == "" and options.contigs == "":
+		return None
+	regions = []
+	for contig in options.contigs.split(","):
+		if contig != "":
+			regions.append([contig, 0, 1 << 62])
+	for region in options.regions.split(","):
+		match = re.match("^(.+):([0-9,]+)(-([0-9,]+))?$", region)
+		if match is not None:
+			end = int(match.group(4)) if match.group(4) is not None else 1 << 62
+			regions.append([match.group(1), int(match.group(2)) - 1, end])
+		elif region != "":
+			regions.append([region, 0, 1 << 62])
+	return regions
+
+## Sort regions by their chromosome's order in the index and merge any that overlap
+def merge_regions(regions, names):
+	order = lambda region: [names.index(region[0]) if region[0] in names else len(names), region[0], region[1]]
+	merged = []
+	for region in sorted(regions, key = order):
+		if len(merged) > 0 and merged[-1][0] == region[0] and region[1] <= merged[-1][2]:
+			merged[-1][2] = max(merged[-1][2], region[2])
+		else:
+			merged.append(list(region))
+	return merged
+
+## Read a tabix (.tbi) or coordinate-sorted (.csi) index into a dictionary with the chromosome names, the binning
+## parameters, and for each chromosome its bins (bin number -> list of [start, end] virtual offset chunks) and the
+## minimum virtual offsets used to skip chunks that end before a region starts (linear index for .tbi, bin offsets
+## for .csi)
+def read_vcf_index(vcf):
+	if os.path.exists(vcf+".tbi"):
+		data = gzip.open(vcf+".tbi", "rb").read()
+	elif os.path.exists(vcf+".csi"):
+		data = gzip.open(vcf+".csi", "rb").read()
+	else:
+		print "\n\n***Error: no .tbi or .csi index found for "+vcf+" (create one with 'tabix -p vcf' or 'bcftools index')!***\n\n"
+		raise SystemExit(1)
+	index = {"refs": []}
+	if data[0:4] == "TBI\x01":
+		[n_ref, l_nm] = [struct.unpack("<i", data[4:8])[0], struct.unpack("<i", data[32:36])[0]]
+		index["names"] = data[36:36+l_nm].split("\x00")[0:n_ref]
+		[index["min_shift"], index["depth"]] = [14, 5]
+		offset = 36 + l_nm
+	else:
+		[index["min_shift"], index["depth"], l_aux] = struct.unpack("<3i", data[4:16])
+		aux = data[16:16+l_aux]
+		n_ref = struct.unpack("<i", data[16+l_aux:20+l_aux])[0]
+		offset = 20 + l_aux
+		if l_aux >= 28:
+			l_nm = struct.unpack("<i", aux[24:28])[0]
+			index["names"] = aux[28:28+l_nm].split("\x00")[0:n_ref]
+		else:
+			index["names"] = [line.split("ID=")[1].split(",")[0].rstrip(">\n") for line in region_header(vcf) if line.startswith("##contig=")]
+	for ref in xrange(n_ref):
+		bins = {}
+		min_offsets = {}
+		n_bin = struct.unpack("<i", data[offset:offset+4])[0]
+		offset += 4
+		for foo in xrange(n_bin):
+			bin_id = struct.unpack("<I", data[offset:offset+4])[0]
+			offset += 4
+			if data[0:4] != "TBI\x01":
+				min_offsets[bin_id] = struct.unpack("<Q", data[offset:offset+8])[0]
+				offset += 8
+			n_chunk = struct.unpack("<i", data[offset:offset+4])[0]
+			chunks = struct.unpack("<%dQ" % (2 * n_chunk), data[offset+4:offset+4+16*n_chunk])
+			bins[bin_id] = [[chunks[i], chunks[i+1]] for i in xrange(0, len(chunks), 2)]
+			offset += 4 + 16 * n_chunk
+		if data[0:4] == "TBI\x01":
+			n_intv = struct.unpack("<i", data[offset:offset+4])[0]
+			linear = list(struct.unpack("<%dQ" % n_intv, data[offset+4:offset+4+8*n_intv]))
+			offset += 4 + 8 * n_intv
+		else:
+			linear = None
+		index["refs"].append({"bins": bins, "linear": linear, "min_offsets": min_offsets})
+	return index
+
+def region_header(vcf):
+	handle = open(vcf, "rb")
+	header = []
+	for line in bgzf_range_lines(handle, 0, None):
+		if not line.startswith("#"):
+			break
+		header.append(line)
+	handle.close()
+	return header
+
+## List the merged [start, end] virtual offset chunks that may hold records overlapping beg-end on a chromosome
+def region_chunks(index, tid, beg, end):
+	ref = index["refs"][tid]
+	[min_shift, depth] = [index["min_shift"], index["depth"]]
+	end = min(end, 1 << (min_shift + 3 * depth))
+	bins = reg2bins(beg, end, min_shift, depth)
+	if ref["linear"] is not None and len(ref["linear"]) > 0:
+		min_offset = ref["linear"][min(beg >> min_shift, len(ref["linear"]) - 1)]
+	else:
+		## For .csi, the offset stored with the smallest indexed bin holding the region start
+		bin_id = ((1 << 3 * depth) - 1) // 7 + (beg >> min_shift)
+		while bin_id > 0 and bin_id not in ref["min_offsets"]:
+			bin_id = (bin_id - 1) >> 3
+		min_offset = ref["min_offsets"].get(bin_id, 0)
+	chunks = sorted([chunk for bin_id in bins for chunk in ref["bins"].get(bin_id, []) if chunk[1] > min_offset])
+	merged = []
+	for chunk in chunks:
+		if len(merged) > 0 and chunk[0] <= merged[-1][1]:
+			merged[-1][1] = max(merged[-1][1], chunk[1])
+		else:
+			merged.append(list(chunk))
+	return merged
+
+## List the bins that may contain records overlapping beg-end (0-based, half-open), as in the SAM/tabix specification
+def reg2bins(beg, end, min_shift, depth):
+	bins = []
+	end -= 1
+	[level, first_bin, shift] = [0, 0, min_shift + depth * 3]
+	while level <= depth:
+		bins.extend(range(first_bin + (beg >> shift), first_bin + (end >> shift) + 1))
+		shift -= 3
+		first_bin += 1 << (level * 3)
+		level += 1
+	return bins
+
+
+#################################################
+###    Stream VCF to all requested outputs    ###
+#################################################
+
+## Hand each block of loci (read once from the filtered VCF or its cache) to every requested output (delimiter is
+## None when no genotype matrix is requested)
+## Locus-major outputs (genotype matrix, header of the Entropy comparison matrix) are written as blocks arrive.
+## Sample-major outputs (FASTA alignments, Structure, rows of the Entropy comparison matrix) need each individual's
+## genotypes across all loci, so each block is transposed and spilled to a temporary file, which is read back
+## afterwards in groups of individuals sized to fit within --memory
+def stream_outputs(vcf_blocks, delimiter):
 	sample_total = file_len(options.sheet)
+	sample_lines = [line for line in open(options.sheet, "r") if not line.strip().startswith("#")]
+	temp_dir = os.path.dirname(options.prefix) or "."
+	
+	## Initialize locus-major output files (the matrix dimensions header is only known at the end, so if
+	## it is requested the matrix body goes to a temporary file first)
+	genomatrix_out = None
+	if delimiter is not None:
+		genomatrix_out = open(options.prefix+".genomatrix", "w")
+		if "1" in options.headers:
+			genomatrix_body = tempfile.TemporaryFile(dir = temp_dir)
+		else:
+			geno_headers(genomatrix_out, delimiter)
+			genomatrix_body = genomatrix_out
+	if options.entcomp is True:
+		entcomp_out = open(options.prefix+".entcomp", "w")
+		entcomp_out.write("Individual")
+	if options.plink is True:
+		bed_out = open(options.prefix+".bed", "wb")
+		bed_out.write("\x6c\x1b\x01")        # PLINK magic number and SNP-major mode
+		bim_out = open(options.prefix+".bim", "w")
+		plink_fam(sample_lines)
+	if options.glbin in ["16", "32"]:
+		gl_dtype = "<f"+str(int(options.glbin) / 8)
+		gl_out = open(options.prefix+".gl.bin", "wb")
+		gl_out.write(gl_bin_header(gl_dtype, 0, sample_total))
+	if options.beagle is True:
+		beagle_out = gzip.open(options.prefix+".beagle.gz", "wb")
+		beagle_out.write(beagle_header(sample_lines))
+	
+	## Initialize spill files for sample-major outputs
+	sample_major = options.nucl or options.tri or options.structure or options.entcomp
+	if sample_major:
+		gt_spill = tempfile.TemporaryFile(dir = temp_dir)
+		if options.entcomp is True:
+			pl_spill = tempfile.TemporaryFile(dir = temp_dir)
+	block_loci = []
+	sites = {"pos": [], "ref": [], "alt": []}
+	vcf_samples = 0
+	loci = 0
 	
+	## Single pass through the VCF
+	for block in vcf_blocks:
+		vcf_samples = block["vcf_samples"]
+		loci += len(block["pos"])
+		if genomatrix_out is not None:
+			if "genomatrix" in block:
+				genomatrix_body.write("".join(block["genomatrix"]))
+			else:
+				genomatrix_body.write("".join(geno_rows(block, delimiter, sample_total)))
+		if options.entcomp is True:
+			entcomp_out.write(entcomp_header(block, ","))
+		if options.plink is True:
+			bed_out.write(plink_bed_rows(block["gt"]))
+			bim_out.write(plink_bim_rows(block))
+		if options.glbin in ["16", "32"] or options.beagle is True:
+			pl = masked_pl(block)
+			if options.glbin in ["16", "32"]:
+				gl_out.write(gl_bin_rows(pl, gl_dtype))
+			if options.beagle is True:
+				beagle_out.write(beagle_rows(block, pl))
+		if sample_major:
+			gt_spill.write(np.ascontiguousarray(block["gt"].T).tostring())
+			if options.entcomp is True:
+				pl_spill.write(np.ascontiguousarray(block["pl"].transpose(1, 0, 2)).tostring())
+			block_loci.append(len(block["pos"]))
+			for key in sites.keys():
+				sites[key].append(block[key])
+	
+	## Finish the genotype matrix
+	if genomatrix_out is not None:
+		if "1" in options.headers:
+			genomatrix_out.write(str(vcf_samples)+str(delimiter)+str(loci)+str(delimiter)+"1\n")
+			geno_headers(genomatrix_out, delimiter)
+			genomatrix_body.seek(0)
+			shutil.copyfileobj(genomatrix_body, genomatrix_out)
+			genomatrix_body.close()
+		genomatrix_out.close()
+		print "\n\n###The genotype likelihood matrix can be found in "+options.prefix+".genomatrix###\n\n"
+	if options.plink is True:
+		bed_out.close()
+		bim_out.close()
+		print "\n\n###PLINK binary genotypes can be found in "+options.prefix+".bed, .bim, and .fam###\n\n"
+	if options.glbin in ["16", "32"]:
+		gl_out.seek(0)
+		gl_out.write(gl_bin_header(gl_dtype, loci, sample_total))
+		gl_out.close()
+		print "\n\n###The binary genotype likelihood matrix can be found in "+options.prefix+".gl.bin###\n\n"
+	if options.beagle is True:
+		beagle_out.close()
+		print "\n\n###Beagle genotype likelihoods can be found in "+options.prefix+".beagle.gz###\n\n"
+	if not sample_major:
+		return
+	
+	## Build the per-locus lookup tables for the sample-major outputs and open their files
+	for key in sites.keys():
+		sites[key] = np.concatenate(sites[key]) if len(sites[key]) > 0 else np.array([], dtype = str)
+	if options.nucl is True:
+		nucl_table = gt_table(sites, nucl_codes)
+		nucl_out = open(options.prefix+".nucl.fasta", "w")
+	if options.tri is True:
+		tri_table = gt_table(sites, tri_codes)
+		tri_out = open(options.prefix+".tri.fasta", "w")
+	if options.structure is True:
+		struct_tables = [gt_table(sites, struct_first_codes), gt_table(sites, struct_second_codes)]
+		struct_out = open(options.prefix+".structure", "w")
+	if options.entcomp is True:
+		entcomp_out.write("\n")
+	
+	## Read the spilled genotypes back in groups of individuals and write one row (or two for Structure) per individual
+	bytes_per_sample = max(1, loci * (1 + 6 * int(options.entcomp is True)))
+	group = max(1, int(options.memory) * 1024 * 1024 / bytes_per_sample)
+	for first in xrange(0, len(sample_lines), group):
+		last = min(first + group, len(sample_lines))
+		gt_rows = read_spill(gt_spill, block_loci, sample_total, first, last, np.int8, 1)
+		if options.entcomp is True:
+			pl_rows = read_spill(pl_spill, block_loci, sample_total, first, last, np.uint16, 3)
+		for counter in xrange(first, last):
+			line = sample_lines[counter]
+			codes = gt_rows[counter - first]
+			if options.nucl is True:
+				nucl_out.write(nucl_row(line, codes, nucl_table))
+			if options.tri is True:
+				tri_out.write(tri_row(line, codes, tri_table))
+			if options.structure is True:
+				struct_out.write(struct_rows(line, codes, struct_tables))
+			if options.entcomp is True:
+				entcomp_out.write(entcomp_row(line, pl_rows[counter - first], ","))
+	
+	gt_spill.close()
+	if options.nucl is True:
+		nucl_out.close()
+		print "\n\n###Nucleotide genotype alignment can be found in "+options.prefix+".nucl.fasta###\n\n"
+	if options.tri is True:
+		tri_out.close()
+		print "\n\n###Trinary genotype alignment can be found in "+options.prefix+".tri.fasta###\n\n"
+	if options.structure is True:
+		struct_out.close()
+		print "\n\n###Nucleotide genotype alignment can be found in "+options.prefix+".structure###\n\n"
+	if options.entcomp is True:
+		pl_spill.close()
+		entcomp_out.close()
+		print "\n\n###Nucleotide genotype alignment can be found in "+options.prefix+".entcomp###\n\n"
+
+## Read the spilled rows of individuals first to last - 1 from every block and join them across blocks
+## Each block was spilled as samples x loci (x width) so these rows are one contiguous read per block
+def read_spill(spill, block_loci, sample_total, first, last, dtype, width):
+	itemsize = np.dtype(dtype).itemsize * width
+	rows = []
+	offset = 0
+	for loci in block_loci:
+		spill.seek(offset + first * loci * itemsize)
+		chunk = np.frombuffer(spill.read((last - first) * loci * itemsize), dtype = dtype)
+		rows.append(chunk.reshape(last - first, loci, width))
+		offset += sample_total * loci * itemsize
+	if len(rows) == 0:
+		rows.append(np.zeros((last - first, 0, width), dtype = dtype))
+	rows = np.concatenate(rows, axis = 1)
+	if width == 1:
+		return rows[:, :, 0]
+	return rows
+
+
+#################################################
+###      Creating Genotype matrix output      ###
+#################################################
+
+## Header lines of the genotype matrix (input file for Entropy program) with sample IDs and population IDs
+def geno_headers(genomatrix_out, delimiter):
 	## Output line of sample names from second column of sample sheet
 	if "2" in options.headers:
 		if options.locinfo is True:
@@ -174,281 +1107,159 @@ def geno_matrix(PL, GT, filtered_vcf, delimiter):
 					l2out = bar[2]+str(delimiter)+bar[2]+str(delimiter)+bar[2]+str(delimiter)
 				genomatrix_out.write(l2out)
 		genomatrix_out.write("\n")
-	
-	## Output genotypes for each sample from VCF (begin at column 10)
-	for vline in open(filtered_vcf, "r"):
-		if not vline.strip().startswith("#"):
-			bar = vline.rstrip().split("\t")
-			if options.locinfo is True:
-				genomatrix_out.write(bar[0]+"_"+bar[1]+str(delimiter))
-			if options.refalt is True:
-				genomatrix_out.write(bar[3]+str(delimiter)+bar[4]+str(delimiter))
-			for sample in range(9, sample_total+9):
-				vcfchunks = bar[sample].split(":")
-				if vcfchunks[GT] == "./.":
-					geno_out = recode_gl(genomatrix_out, "0,0,0", delimiter)
-				else:
-					geno_out = recode_gl(genomatrix_out, vcfchunks[PL], delimiter)		# recode genotype likelihoods user choice
-				genomatrix_out.write(geno_out+str(delimiter))
-			genomatrix_out.write("\n")
-	
-	genomatrix_out.close()
-	print "\n\n###The genotype likelihood matrix can be found in "+options.prefix+".genomatrix###\n\n"
+
+## Output genotypes for each sample in a block of loci as one matrix row per locus (missing genotypes are recoded from PL = 0,0,0)
+def geno_rows(block, delimiter, sample_total):
+	values = recode_block(masked_pl(block)).reshape(len(block["pos"]), -1).tolist()
+	row_format = (recode_format(delimiter)+str(delimiter)) * sample_total + "\n"
+	rows = []
+	for locus in xrange(len(block["pos"])):
+		row = ""
+		if options.locinfo is True:
+			row += block["chrom"][locus]+"_"+str(block["pos"][locus])+str(delimiter)
+		if options.refalt is True:
+			row += block["ref"][locus]+str(delimiter)+block["alt"][locus]+str(delimiter)
+		rows.append(row + row_format % tuple(values[locus]))        # recode genotype likelihoods user choice
+	return rows
+
+
+#################################################
+###   Binary genotype likelihood outputs      ###
+#################################################
+
+## Bytes reserved for the JSON header of the binary genotype likelihood matrix (padded with spaces and ended by a
+## newline); the values follow as a C-ordered loci x samples (x 3 unless --genotype 4) array, so the matrix can be
+## memory-mapped, e.g. numpy.memmap(file, dtype, "r", offset, shape) with the values given in the header
+gl_header_size = 4096
+
+## JSON header of the binary genotype likelihood matrix
+def gl_bin_header(dtype, loci, sample_total):
+	shape = [loci, sample_total] + ([] if options.genotype == "4" else [3])
+	header = json.dumps({"genotype": int(options.genotype), "dtype": np.dtype(dtype).str, "shape": shape, "order": "C", "offset": gl_header_size})
+	return header + " " * (gl_header_size - len(header) - 1) + "\n"
+
+## Binary values of the user's genotype likelihood output for a block of loci (missing genotypes recoded from PL = 0,0,0)
+def gl_bin_rows(pl, dtype):
+	return np.ascontiguousarray(recode_block(pl), dtype = dtype).tostring()
+
+## Allele codes used by Beagle files (other alleles are written as they are)
+beagle_alleles = {"A": "0", "C": "1", "G": "2", "T": "3"}
+
+## Beagle header line for NGSadmix: marker, allele1, allele2, and each sample ID three times
+def beagle_header(sample_lines):
+	names = [line.split("\t")[1] for line in sample_lines]
+	return "marker\tallele1\tallele2\t"+"\t".join([name for name in names for foo in xrange(3)])+"\n"
+
+## Beagle lines for a block of loci with the standardized likelihoods of 0/0, 0/1, and 1/1 for each sample
+## (computed exactly from the PL values; missing genotypes get 1/3 each)
+def beagle_rows(block, pl):
+	likelihoods = 10 ** (pl / -10.0)
+	likelihoods = likelihoods / likelihoods.sum(axis = 2)[..., np.newaxis]
+	values = likelihoods.reshape(len(block["pos"]), -1).tolist()
+	row_format = "\t%.6f" * (3 * pl.shape[1]) + "\n"
+	rows = []
+	for locus in xrange(len(block["pos"])):
+		[ref, alt] = [block["ref"][locus], block["alt"][locus]]
+		marker = block["chrom"][locus]+"_"+str(block["pos"][locus])+"\t"+beagle_alleles.get(ref, ref)+"\t"+beagle_alleles.get(alt, alt)
+		rows.append(marker + row_format % tuple(values[locus]))
+	return "".join(rows)
 
 
 #################################################
 ###    Creating nucleotide alignment fasta    ###
 #################################################
 
-## Create fasta alignment of nucleotides based on genotypes from each sample in VCF
-def nucl_fasta(GT, GQ, filtered_vcf):
-	counter = 0
-	## Initalize output file
-	nucl_out = open(options.prefix+".nucl.fasta", "w")
-	
-	## For each individual in sample sheet
-	for line in open(options.sheet, "r"):
-	    if not line.strip().startswith("#"):
-
-			## Write out fasta header with sample ID and population ID
-			nucl_out.write(">"+line.split("\t")[1]+"_"+line.split("\t")[2]+"_"+line.split("\t")[3])
-			
-			## For each line (locus) in VCF
-			for vline in open(filtered_vcf, "r"):
-				if not vline.strip().startswith("#"):
-					bar = vline.rstrip().split("\t")
-					
-					## For each individual in VCF
-					target = bar[counter + 9]
-					vcfchunks = target.split(":")
-					
-					## Only write genotypes for loci with genotype quality greater than threshold
-#					if int(vcfchunks[GQ]) >= int(options.gq):
-
-#					print vcfchunks[GT]						
-					if vcfchunks[GT] == "0/0":				# homozygous reference (4th column)
-#						print "homozygous ref"
-						nucl_out.write(str(bar[3]))
-					elif vcfchunks[GT] == "1/1":
-#						print "homozygous alt"
-						nucl_out.write(str(bar[4]))			# homozygous alternative (5th column)
-					elif vcfchunks[GT] == "1/0":
-#                                               print "heterozygous"
-                                                nucl_out.write(str(get_amb(bar[3], bar[4])))    # heterozygous (use column 4/5 and subroutine to get ambiguity) 
-					elif vcfchunks[GT] == "0/1":
-#						print "heterozygous"
-						nucl_out.write(str(get_amb(bar[3], bar[4])))	# heterozygous (use column 4/5 and subroutine to get ambiguity)
-					elif vcfchunks[GT] == """./.""":
-#						print "missing"
-						nucl_out.write("?")
-					else:
-						print "Error! Unknown genotype!"
-
-					## Else write missing data (?)
-#					else:
-#						nucl_out.write("?")
-			nucl_out.write("\n")
-			counter += 1
-	
-	nucl_out.close()
-	print "\n\n###Nucleotide genotype alignment can be found in "+options.prefix+".nucl.fasta###\n\n"
+## Nucleotide written for each GT code at a locus: 0/0 = reference (4th column), 0/1 and 1/0 = ambiguity code
+## of columns 4/5, 1/1 = alternative (5th column), ./. = missing (?)
+def nucl_codes(ref, alt):
+	return [ref, get_amb(ref, alt), get_amb(ref, alt), alt, "?"]
+
+## Create fasta alignment row of nucleotides for one individual, with a header of sample ID, population ID, and location
+def nucl_row(line, codes, nucl_table):
+	return ">"+line.split("\t")[1]+"_"+line.split("\t")[2]+"_"+line.split("\t")[3]+render_gt(nucl_table, codes)+"\n"
 	
 
 #################################################
 ###      Creating trinary alignment fasta     ###
 #################################################
 
-## Create trinary fasta alignment based on genotypes from VCF... much the same as nucleotide function
-def tri_fasta(GT, GQ, filtered_vcf):
-	counter = 0
-	## Initialize output file
-	tri_out = open(options.prefix+".tri.fasta", "w")
-	
-	## For each individual in sample sheet
-	for line in open(options.sheet, "r"):
-	    if not line.strip().startswith("#"):
-			
-			## Write out fasta header with sample ID and population ID
-			tri_out.write(">"+line.split()[1]+"_"+line.split()[2]+"_"+line.split()[3]+"\n")
-			
-			## for each line (locus) in VCF
-			for vline in open(filtered_vcf, "r"):
-				if not vline.strip().startswith("#"):
-					bar = vline.rstrip().split("\t")
-					
-					## For each individual in VCF
-					target = bar[counter + 9]
-					vcfchunks = target.split(":")
-
-					## Only write genotypes for loci with genotype quality greater than threshold
-#					if int(vcfchunks[GQ]) >= int(options.gq):
-						
-					if vcfchunks[GT] == "0/0":			# homozygous reference = 0
-						tri_out.write("0")
-					elif vcfchunks[GT] == "1/1":			# homozygous alternative = 2
-						tri_out.write("2")
-					elif vcfchunks [GT] == "0/1":			# heterozygous = 1
-                                                tri_out.write("1")
-					elif vcfchunks [GT] == "1/0":			# heterozygous = 1
-						tri_out.write("1")
-					elif vcfchunks [GT] == "./.":
-						tri_out.write("?")
-					else:
-						print "Error! Unknown genotype!"
-
-					## Else write missing data (?)
-#					else:
-#						tri_out.write("?")
-			tri_out.write("\n")
-			counter += 1
-	
-	tri_out.close()
-	print "\n\n###Trinary genotype alignment can be found in "+options.prefix+".tri.fasta###\n\n"
+## Trinary code written for each GT code: homozygous reference = 0, heterozygous = 1, homozygous alternative = 2,
+## missing = ?
+def tri_codes(ref, alt):
+	return ["0", "1", "1", "2", "?"]
+
+## Create trinary fasta alignment row for one individual... much the same as nucleotide function
+def tri_row(line, codes, tri_table):
+	return ">"+line.split()[1]+"_"+line.split()[2]+"_"+line.split()[3]+"\n"+render_gt(tri_table, codes)+"\n"
 	
 
 #################################################
 ###      Creating Structure input matrix      ###
 #################################################
 
-## Create genotype matrix suitable for Structure based on genotypes from each sample in VCF
-def structure(GT, GQ, filtered_vcf):
-	counter = 0
-	## Initalize output file
-	struct_out = open(options.prefix+".structure", "w")
-	
-	## For each individual in sample sheet
-	for line in open(options.sheet, "r"):
-	    if not line.strip().startswith("#"):
-
-			## Write out first column with sample ID
-			struct_out.write(line.split("\t")[1]+"\t")
-			
-			## For each line (locus) in VCF
-			for vline in open(filtered_vcf, "r"):
-				if not vline.strip().startswith("#"):
-					bar = vline.rstrip().split("\t")
-					
-					## For each individual in VCF
-					target = bar[counter + 9]
-					vcfchunks = target.split(":")
-					
-					## Only write genotypes for loci with genotype quality greater than threshold
-#					if int(vcfchunks[GQ]) >= int(options.gq):
-
-#					print vcfchunks[GT]						
-					if vcfchunks[GT] == "0/0":				# homozygous reference (use column 4 and subroutine to get code)
-#						print "homozygous ref"
-						struct_out.write(str(str_amb(bar[3]))+"\t")
-					elif vcfchunks[GT] == "1/1":
-#						print "homozygous alt"
-						struct_out.write(str(str_amb(bar[4]))+"\t")			# homozygous alternative (use column 5 and subroutine to get code)
-					elif vcfchunks[GT] == "1/0":
-#						print "heterozygous"
-						struct_out.write(str(str_amb(bar[4]))+"\t")    # heterozygous (use column 4 and subroutine to get code)
-					elif vcfchunks[GT] == "0/1":
-#						print "heterozygous"
-						struct_out.write(str(str_amb(bar[3]))+"\t")	# heterozygous (use column 5 and subroutine to get code)
-					elif vcfchunks[GT] == """./.""":
-#						print "missing"
-						struct_out.write("-9\t")				# Else write missing data
-					else:
-						print "Error! Unknown genotype!"
-
-			struct_out.write("\n")
-
-			## Write out first column with sample ID
-			struct_out.write(line.split("\t")[1]+"\t")
-			
-			for vline in open(filtered_vcf, "r"):
-				if not vline.strip().startswith("#"):
-					bar = vline.rstrip().split("\t")
-					
-					## For each individual in VCF
-					target = bar[counter + 9]
-					vcfchunks = target.split(":")
-					
-					## Only write genotypes for loci with genotype quality greater than threshold
-#					if int(vcfchunks[GQ]) >= int(options.gq):
-
-#					print vcfchunks[GT]						
-					if vcfchunks[GT] == "0/0":				# homozygous reference (use column 4 and subroutine to get code)
-#						print "homozygous ref"
-						struct_out.write(str(str_amb(bar[3]))+"\t")
-					elif vcfchunks[GT] == "1/1":
-#						print "homozygous alt"
-						struct_out.write(str(str_amb(bar[4]))+"\t")			# homozygous alternative (use column 5 and subroutine to get code)
-					elif vcfchunks[GT] == "1/0":
-#						print "heterozygous"
-						struct_out.write(str(str_amb(bar[3]))+"\t")    # heterozygous (use column 4 and subroutine to get code) 
-					elif vcfchunks[GT] == "0/1":
-#						print "heterozygous"
-						struct_out.write(str(str_amb(bar[4]))+"\t")	# heterozygous (use column 5 and subroutine to get code)
-					elif vcfchunks[GT] == """./.""":
-#						print "missing"
-						struct_out.write("-9\t")				# Else write missing data
-					else:
-						print "Error! Unknown genotype!"
-			
-			struct_out.write("\n")
-						
-			counter += 1
-	
-	struct_out.close()
-	print "\n\n###Nucleotide genotype alignment can be found in "+options.prefix+".structure###\n\n"
+## Each individual gets two rows (one per allele) coded with str_amb; heterozygotes write the reference allele
+## first for 0/1 and the alternative allele first for 1/0, and missing genotypes are written as -9
+def struct_first_codes(ref, alt):
+	return [str_amb(ref)+"\t", str_amb(ref)+"\t", str_amb(alt)+"\t", str_amb(alt)+"\t", "-9\t"]
+
+def struct_second_codes(ref, alt):
+	return [str_amb(ref)+"\t", str_amb(alt)+"\t", str_amb(ref)+"\t", str_amb(alt)+"\t", "-9\t"]
+
+## Create the two Structure rows for one individual, each starting with the sample ID
+def struct_rows(line, codes, struct_tables):
+	first = line.split("\t")[1]+"\t"+render_gt(struct_tables[0], codes)+"\n"
+	second = line.split("\t")[1]+"\t"+render_gt(struct_tables[1], codes)+"\n"
+	return first + second
+
+
+#################################################
+###      Creating PLINK binary genotypes      ###
+#################################################
+
+## PLINK 2-bit code for each GT code, with the alternative allele as A1 and the reference allele as A2:
+## homozygous alternative = 00, heterozygous = 10, homozygous reference = 11, missing = 01
+plink_codes = np.array([3, 2, 2, 0, 1, 1], dtype = np.uint8)
+
+## Write the .fam file with the population ID as family ID and the sample ID as individual ID (parents, sex, and
+## phenotype unknown)
+def plink_fam(sample_lines):
+	fam_out = open(options.prefix+".fam", "w")
+	for line in sample_lines:
+		fam_out.write(line.split("\t")[2]+"\t"+line.split("\t")[1]+"\t0\t0\t0\t-9\n")
+	fam_out.close()
 
+## Create the .bim lines (chromosome, chromosome_position ID, genetic distance, position, A1, A2) for a block of loci
+def plink_bim_rows(block):
+	rows = []
+	for locus in xrange(len(block["pos"])):
+		[chrom, pos] = [block["chrom"][locus], str(block["pos"][locus])]
+		rows.append(chrom+"\t"+chrom+"_"+pos+"\t0\t"+pos+"\t"+block["alt"][locus]+"\t"+block["ref"][locus]+"\n")
+	return "".join(rows)
+
+## Pack the genotypes of a block of loci into SNP-major .bed bytes, four individuals per byte with the first
+## individual in the lowest two bits (unused bits at the end of each locus are left as 0)
+def plink_bed_rows(gt):
+	codes = plink_codes[gt]
+	padding = -codes.shape[1] % 4
+	if padding > 0:
+		codes = np.hstack([codes, np.zeros((codes.shape[0], padding), dtype = np.uint8)])
+	codes = codes.reshape(codes.shape[0], -1, 4)
+	return (codes[:, :, 0] | codes[:, :, 1] << 2 | codes[:, :, 2] << 4 | codes[:, :, 3] << 6).tostring()
 
 
 ##########################################################################################
 ###      Creating 'Transposed' genotype matrix for comparison with Entropy output      ###
 ##########################################################################################
 
-## Create genotype matrix to compare with genotype uncertainty values produced by Entropy
-def entropy_compare(PL, filtered_vcf, delimiter):
+## Write the part of the initial line that contains the locus ID information for a block of loci
+def entcomp_header(block, delimiter):
+	return "".join([delimiter+block["chrom"][locus]+"_"+str(block["pos"][locus]) for locus in xrange(len(block["pos"]))])
 
-	## Initalize output file
-	entcomp_out = open(options.prefix+".entcomp", "w")
-	
-	entcomp_out.write("Individual")
-	
-	## Write an initial line that contains the locus ID information
-	for vline in open(filtered_vcf, "r"):
-				if not vline.strip().startswith("#"):
-					bar = vline.rstrip().split("\t")
-					
-					entcomp_out.write(delimiter+bar[0]+"_"+bar[1])
-								
-	entcomp_out.write("\n")
-	
-	counter = 0
-	
-	## For each individual in sample sheet
-	for line in open(options.sheet, "r"):
-	    if not line.strip().startswith("#"):
-
-			## Write out first column with sample ID
-			entcomp_out.write(line.split("\t")[1])
-			
-			## For each line (locus) in VCF
-			for vline in open(filtered_vcf, "r"):
-				if not vline.strip().startswith("#"):
-					bar = vline.rstrip().split("\t")
-					
-					## For each individual in VCF
-					target = bar[counter + 9]
-					vcfchunks = target.split(":")
-					
-					## Recode the genotype likelihood to desired format (should be 4)
-					geno_out = recode_gl(entcomp_out, vcfchunks[PL], delimiter)
-					
-					## Write the genotype likelihood to output with a delimiter (should be comma) prefix
-					entcomp_out.write(str(delimiter)+geno_out)
-					
-			entcomp_out.write("\n")
-						
-			counter += 1
-	
-	entcomp_out.close()
-	print "\n\n###Nucleotide genotype alignment can be found in "+options.prefix+".structure###\n\n"
+## Create the row for one individual: sample ID followed by the genotype likelihood at each locus recoded to
+## desired format (should be 4), each with a delimiter (should be comma) prefix
+def entcomp_row(line, pl_row, delimiter):
+	row_format = (str(delimiter)+recode_format(delimiter)) * len(pl_row)
+	return line.split("\t")[1]+row_format % tuple(recode_block(pl_row).ravel().tolist())+"\n"
 		
 
 #################################################
@@ -460,62 +1271,68 @@ def entropy_compare(PL, filtered_vcf, delimiter):
 ## Standardize the likelihood (for each number alternative alleles): = likelihood/sum(all likelihoods)
 ## Multiple standardized likelihoods by number of alternative alles: = standardized likelihoods * # alternative alleles
 ## Sum to produce absolute genotype on 0 (homozygous reference) to 2 (homozygous alternative) scale
-def recode_gl(outfile, genochunk, delimiter):
-	bar = genochunk.split(",")
-	p0 = float(10 ** (int(bar[0])/-10))
-	p1 = float(10 ** (int(bar[1])/-10))
-	p2 = float(10 ** (int(bar[2])/-10))
-	psum = float(p0 + p1 + p2)
-	g0 = float(p0/psum)
-	g1 = float(p1/psum)
-	g2 = float(p2/psum)
-	gsum = float(float(g0*0) + float(g1*1) + float(g2*2))
+## Works on whole arrays of PL triplets (last axis = 3) and returns the values for the user's output format
+## (the PL values, likelihoods, standardized likelihoods, or absolute genotypes), ready for recode_format
+def recode_block(pl):
 	if options.genotype == "1":
-		return bar[0]+delimiter+bar[1]+delimiter+bar[2]
-	elif options.genotype == "2":
-		return '{:.3f}'.format(p0)+delimiter+'{:.3f}'.format(p1)+delimiter+'{:.3f}'.format(p2)
-	elif options.genotype == "3":
-		return '{:.3f}'.format(g0)+delimiter+'{:.3f}'.format(g1)+delimiter+'{:.3f}'.format(g2)
-	elif options.genotype == "4":
-		return '{:.5f}'.format(gsum)
+		return pl
+	p = pl_likelihood[pl]
+	if options.genotype == "2":
+		return p
+	psum = p[..., 0] + p[..., 1] + p[..., 2]
+	g = p / psum[..., np.newaxis]
+	if options.genotype == "3":
+		return g
+	return g[..., 1] * 1 + g[..., 2] * 2
+
+## PL triplets of a block with missing genotypes set to 0,0,0
+def masked_pl(block):
+	return np.where((block["gt"] == gt_codes["./."])[:, :, np.newaxis], 0, block["pl"])
+
+## Format string for the values recode_block returns for one genotype
+def recode_format(delimiter):
+	if options.genotype == "1":
+		return "%d"+delimiter+"%d"+delimiter+"%d"
+	elif options.genotype == "2" or options.genotype == "3":
+		return "%.3f"+delimiter+"%.3f"+delimiter+"%.3f"
 	else:
-		print "\n\n***Specify the output genotype format for genotype matrix***\n\n"
+		return "%.5f"
+
+## Likelihood (10 ^ PHRED/-10) for every possible PL value, looked up by recode_block
+## Note PHRED/-10 is an integer division, so PHRED values are effectively rounded up to a multiple of 10
+pl_likelihood = np.array([float(10 ** (pl/-10)) for pl in xrange(65536)])
 		
 ## Determines which portion of the FORMAT column contains the genotype, PHRED genotype likelihood, and genotype quality
-## Uses sample line from end of output VCF
-## Splits by tabs to isolate FORMAT column (#9) and then splits by : to separate tags
-## Returns the tag number of three values
-def get_stat(filtered_VCF):
-	os.system("tail -1 "+filtered_VCF+" > sample_VCF_line.txt")
-	sample_line = open("sample_VCF_line.txt", "r").readline()
-	chunks = sample_line.rstrip().split("\t")
-	target = chunks[8]
-	foo = target.split(":")
+## Splits the FORMAT column (#9) of a VCF line by : to separate tags
+## Returns the tag number of three values (GQ is None if the VCF has no GQ)
+def get_stat(format_column):
+	foo = format_column.split(":")
 	GT = foo.index("GT")
 	PL = foo.index("PL")
-	GQ = foo.index("GQ")
+	GQ = foo.index("GQ") if "GQ" in foo else None
 	return GT, PL, GQ
-	
-## Determines the dimensions of the genotype matrix (loci X individuals)
-## Calculates the number of uncommented (#) rows (=# loci) and the number of columns - 9 (=# individuals)
-def get_vcf_dims():
-	out = []
-	if options.filvcf is not "":
-		file = options.filvcf
-	elif options.vcf is not "":
-		file = options.vcf
-	else:
-		print "Error! Either a raw VCF or a filtered VCF must be specified!"
-	snps = 0
-	for line in open(file, "r"):
-		if not line.strip().startswith("#"):
-			bar = line.rstrip().split("\t")
-			samples = len(bar) - 9
-			snps += 1
-	out.append(samples)
-	out.append(snps)
-
-	return out
+
+## Convert a numeric VCF field (e.g., QUAL or GQ) to a float, treating missing values (.) as -1 like VCFtools
+def vcf_number(value):
+	try:
+		return float(value)
+	except ValueError:
+		return -1.0
+
+## Builds a lookup table (loci x GT codes) of the text written for each genotype at each locus
+## Recode is a function of the reference and alternative alleles returning the text for 0/0, 0/1, 1/0, 1/1,
+## and ./. in that order; unknown genotypes write nothing
+def gt_table(vcf_data, recode):
+	table = np.empty((len(vcf_data["pos"]), gt_unknown + 1), dtype = object)
+	for locus in xrange(len(vcf_data["pos"])):
+		table[locus] = recode(vcf_data["ref"][locus], vcf_data["alt"][locus]) + [""]
+	return table
+
+## Looks up the text for one individual's genotype codes at every locus and joins it into one string
+def render_gt(table, codes):
+	if (codes == gt_unknown).any():
+		print "Error! Unknown genotype!"
+	return "".join(table[np.arange(len(codes)), codes])
 
 ## Determine proper ambiguity code at a locus for heterozygous individuals
 def get_amb(major, minor):
@@ -574,64 +1391,101 @@ def str_amb(nucleotide):
 #################################################
 
 def main():
-	## If previously filtered VCF is specified, use that, otherwise filter based on user input
-	if options.filvcf == "":
-		print "\n\n***Producing new VCF based on MAF and SNP independence settings***\n\n"
-		vcf_filter()
-		if options.thin is None:
-			filtered_vcf = options.prefix+".maf"+options.maf+".miss"+options.miss+".recode.vcf"
-		else:
-			filtered_vcf = options.prefix+".maf"+options.maf+".miss"+options.miss+".thin"+options.thin+".recode.vcf"
-	else:
-		print "\n\n***Working from previously filtered VCF***\n\n"
-		filtered_vcf = options.filvcf
-	
-	## Retrieve location of FORMAT flags so we can extract the values we want
-	(GT, PL, GQ) = get_stat(filtered_vcf)
+	## If user asked for a filter sweep, report every combination and stop unless the chosen one should be written
+	if options.sweep is True:
+		print "\n\n***Sweeping filter settings***\n\n"
+		filter_sweep(options.vcf if options.filvcf == "" else options.filvcf)
+		if options.sweep_write is not True:
+			print "\n\n###Command has finished###\n\n"
+			return
 	
 	## If user specified genotype likelihood output, give it to them
+	delimiter = None
 	if options.genotype is not "0":
 		print "\n\n***Creating a genotype likelihood matrix***\n\n"
 		if options.delimit == "1":
-			geno_matrix(PL, GT, filtered_vcf, " ")
+			delimiter = " "
 		elif options.delimit == "2":
-			geno_matrix(PL, GT, filtered_vcf, "\t")
+			delimiter = "\t"
 		elif options.delimit == "3":
-			geno_matrix(PL, GT, filtered_vcf, ",")
+			delimiter = ","
 		else:
 			print "\n\n***Specify a delimiter for the genotype matrix!***\n\n"
 	else:
 		print "\n\n***Not creating a genotype likelihood matrix***\n\n"
 	
+	## If previously filtered VCF is specified, use that, otherwise filter based on user input
+	workers = int(options.workers)
+	if options.filvcf == "":
+		if options.maf not in ["0", "1", "2", "3"]:
+			print "\n\n***Error: a minor allele range needs to be specified!***\n\n"
+			return
+		print "\n\n***Producing new VCF based on MAF and SNP independence settings***\n\n"
+		if options.thin is None:
+			filtered_vcf = options.prefix+".maf"+options.maf+".miss"+options.miss+".recode.vcf"
+		else:
+			filtered_vcf = options.prefix+".maf"+options.maf+".miss"+options.miss+".thin"+options.thin+".recode.vcf"
+		if options.no_vcf is True:
+			print "\n\n***Not writing the filtered VCF; outputs are created while filtering***\n\n"
+			filtered_vcf = None
+		if workers > 1:
+			vcf_blocks = sharded_blocks(options.vcf, filter_settings(), filtered_vcf, file_len(options.sheet), int(options.block), delimiter)
+		else:
+			vcf_blocks = read_vcf_blocks(vcf_filter(options.vcf, filtered_vcf), file_len(options.sheet), int(options.block))
+	elif options.no_cache is True or parse_regions() is not None:
+		print "\n\n***Working from previously filtered VCF***\n\n"
+		if workers > 1:
+			vcf_blocks = sharded_blocks(options.filvcf, None, None, file_len(options.sheet), int(options.block), delimiter)
+		else:
+			vcf_blocks = read_vcf_blocks(open_vcf(options.filvcf, parse_regions()), file_len(options.sheet), int(options.block))
+	else:
+		print "\n\n***Working from previously filtered VCF***\n\n"
+		vcf_blocks = cached_blocks(options.filvcf, file_len(options.sheet), int(options.block))
+	
 	## If user specified nucleotide fasta output, give it to them
 	if options.nucl is True:
 		print "\n\n***Creating nucleotide SNP genotype alignment***\n\n"
-		nucl_fasta(GT, GQ, filtered_vcf)
 	else:
 		print "\n\n***Not creating a nucleotide SNP genotype alignment***\n\n"
 	
 	## If user specified trinary fasta output, give it to them
 	if options.tri is True:
 		print "\n\n***Creating trinary SNP genotype alignment***\n\n"
-		tri_fasta(GT, GQ, filtered_vcf)
 	else:
 		print "\n\n***Not creating a trinary SNP genotype alignment***\n\n"
 
 	## If user specified Structure output, give it to them
 	if options.structure is True:
 		print "\n\n***Creating genotype matrix input for Structure***\n\n"
-		structure(GT, GQ, filtered_vcf)
 	else:
 		print "\n\n***Not creating genotype matrix input for Structure***\n\n"
 		
+	## If user specified PLINK output, give it to them
+	if options.plink is True:
+		print "\n\n***Creating PLINK binary genotypes***\n\n"
+	else:
+		print "\n\n***Not creating PLINK binary genotypes***\n\n"
+	
+	## If user specified binary genotype likelihood outputs, give them to them
+	if options.glbin not in ["0", "16", "32"] or (options.glbin != "0" and options.genotype not in ["1", "2", "3", "4"]):
+		print "\n\n***Specify --glbin 16 or 32 and the output genotype format (--genotype) for the binary genotype likelihood matrix***\n\n"
+		options.glbin = "0"
+	if options.glbin != "0":
+		print "\n\n***Creating float"+options.glbin+" binary genotype likelihood matrix***\n\n"
+	if options.beagle is True:
+		print "\n\n***Creating Beagle genotype likelihoods***\n\n"
+	
 	## If user specified a genotype matrix to compare to Entropy output, give it to them
+	if options.entcomp is True and options.genotype not in ["1", "2", "3", "4"]:
+		print "\n\n***Specify the output genotype format (--genotype) for the Entropy comparison matrix***\n\n"
+		options.entcomp = False
 	if options.entcomp is True:
 		print "\n\n***Creating genotype matrix to compare with Entropy results***\n\n"
-		entropy_compare(PL, filtered_vcf, ",")
 	else:
 		print "\n\n***Not creating genotype matrix to compare with Entropy results***\n\n"
 	
-	os.system("rm -f sample_VCF_line.txt")  # clean up
+	## Read (or filter) the VCF once and write every requested output from that single pass
+	stream_outputs(vcf_blocks, delimiter)
 	
 	print "\n\n###Command has finished###\n\n"
 
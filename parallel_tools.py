@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+##print __name__
+
+import collections
+import multiprocessing
+import struct
+import zlib
+
+# Helpers for running work on a pool of processes, shared by process_rawreads.py and genotype_from_VCF.py (which
+# import this file, so it must be kept in the same directory as them)
+
+
+#################################################
+###        Ordered results from a pool        ###
+#################################################
+
+### Run func on every job in the pool and yield the results in job order, keeping at most window jobs in flight ###
+# so that batches read from compressed input do not pile up in memory
+def ordered_results(pool, func, jobs, window):
+	pending = collections.deque()
+	for job in jobs:
+		pending.append(pool.apply_async(func, [job]))
+		if len(pending) >= window:
+			yield pending.popleft().get()
+	while len(pending) > 0:
+		yield pending.popleft().get()
+
+
+#################################################
+###        Parallel BGZF decompression        ###
+#################################################
+
+### Yield the lines of a BGZF file, decompressing batches of blocks on a pool of processes ###
+# The next batch is decompressed while the lines of the current one are being handed out, so decompression overlaps
+# with the caller's processing and only two batches are ever held in memory
+def bgzf_lines(path, processes, batch = 256):
+	pool = multiprocessing.Pool(processes)
+	handle = open(path, "rb")
+	pending = None
+	try:
+		pending = pool.map_async(inflate_bgzf_block, read_bgzf_blocks(handle, batch))
+		remainder = ""
+		while True:
+			data = pending.get()
+			if len(data) == 0:
+				break
+			pending = pool.map_async(inflate_bgzf_block, read_bgzf_blocks(handle, batch))
+			lines = (remainder + "".join(data)).split("\n")
+			remainder = lines.pop()
+			for line in lines:
+				yield line+"\n"
+		if remainder != "":
+			yield remainder
+	finally:
+		# Let an outstanding batch finish (e.g., when the caller stops early) rather than terminating the pool under it
+		if pending is not None:
+			pending.wait()
+		pool.close()
+		pool.join()
+		handle.close()
+
+### Read up to count raw BGZF blocks from an open file ###
+def read_bgzf_blocks(handle, count):
+	blocks = []
+	while len(blocks) < count:
+		block = read_bgzf_block(handle)
+		if block is None:
+			break
+		blocks.append(block)
+	return blocks
+
+### Read the next raw BGZF block (header, compressed data, and footer) from an open file, or None at the end ###
+def read_bgzf_block(handle):
+	header = handle.read(12)
+	if len(header) < 12:
+		return None
+	xlen = struct.unpack("<H", header[10:12])[0]
+	extra = handle.read(xlen)
+	bsize = None
+	field = 0
+	while field + 4 <= xlen:
+		slen = struct.unpack("<H", extra[field+2:field+4])[0]
+		if extra[field:field+2] == "BC":
+			bsize = struct.unpack("<H", extra[field+4:field+6])[0]
+		field += 4 + slen
+	return header + extra + handle.read(bsize + 1 - 12 - xlen)
+
+### Decompress one raw BGZF block (runs in the decompression processes) ###
+def inflate_bgzf_block(block):
+	xlen = struct.unpack("<H", block[10:12])[0]
+	return zlib.decompress(block[12+xlen:-8], -15)
@@ -4,9 +4,23 @@
 
 import re
 import sys
+import itertools
+import collections
+import multiprocessing
+import multiprocessing.pool
 import os
 import optparse
 import subprocess
+import hashlib
+import json
+import struct
+import tempfile
+import threading
+import time
+import Queue
+import zlib
+import numpy as np
+import parallel_tools
 
 usage_line = """
 process_rawreads.py
@@ -20,7 +34,7 @@ Script that process raw RADseq reads that are generated using the Peterson et al
 protocol. The script filters out PCR clones, trims away the 8bp unique molecular identifiers at \
 the beginning of each read, parses by combinatorial barcodes (an inline barcode and standard Illumina \
 index), and quality trims using either Stacks or Trimmomatic. The script will handle either single-end \
-or paired-end reads appropriately. User must input the raw reads (unzipped fastq format) and a sample \
+or paired-end reads appropriately. User must input the raw reads (fastq format, optionally gzip or BGZF compressed) and a sample \
 sheet (example is included as part of this repository). The script also includes the flexibility of \
 running certain portions of the pipeline, which is useful if one doesn't need to repeat a specific step. \
 The pipeline steps are as follows (with numbers corresponding to those passed using the -x flag):
@@ -31,12 +45,31 @@ The pipeline steps are as follows (with numbers corresponding to those passed us
 using this information, and renames the files logically using the sample sheet.
 5. Quality filtering - quality filters the reads using Trimmomatic. If user specifies read quality \
 filtering in Stacks, this filtering takes place simulteneously with read parsing (step 4).
+With the '--fused' flag, steps 2-4 are instead done natively in a single pass over the raw reads (exact inline \
+barcode and index matches, no restriction site checks or Stacks quality filtering), writing each sample's reads \
+directly to the 'parsed' directory with no intermediate files. With '--trim_renz', the cut site remnants of '--renz1' \
+(read 1) and '--renz2' (read 2) are trimmed from the start of the parsed reads, as part of the '--fused' pass or \
+after step 4 otherwise (with '-r', remnants with one mismatch are trimmed as well). With '--clone_mem <MB>', PCR clones are found \
+natively using fingerprints of the reads split into on-disk buckets, so memory use stays below the given \
+ceiling no matter how many reads there are (requires NumPy). With '--fused -r', inline barcodes and indexes \
+with one mismatch are rescued using a lookup table of all one-mismatch variants built from the sample sheet; \
+reads whose barcode or index is one mismatch from more than one sample are discarded as ambiguous. The native steps split the reads into \
+shards that are processed on the number of threads given with '-t'. With '--compress', the per-sample files \
+are written as BGZF compressed FASTQ (.fq.gz, compressed on '-t' threads), which read_mapping.py and Trimmomatic read \
+directly. At most '--max_open' output files are held open at once, however many samples there are. With \
+'-q --native_trim', step 5 applies the same trimming rules as Trimmomatic (LEADING:10 TRAILING:10 SLIDINGWINDOW:4:15 \
+MINLEN:36) natively on batches of reads (requires NumPy), writing the same 'cleaned' files with their final read names \
+(also compressed with '--compress'). Step 5 quality trims up to '-t' samples at once, starting with the largest, \
+with the console output of each sample written to 'cleaned/<sample>.qtrim.out'. With '--telemetry <file>', \
+the native stages ('--fused' and '--native_trim') append their live counters (reads in and out per sample, clone, \
+barcode rescue, and restriction site rates, mean quality per cycle, and reads and MB per second) to the file as a \
+JSON line every '--telemetry_interval' seconds, and write a final summary to <file>.<stage>.summary.json.
 
 Dependencies include the Stacks pipeline (v. 1.10 - 1.19), the FastX toolkit, and Trimmomatic v. 0.32 \
 (if desired), and all need to be installed in the users path.
 
 python process_rawreads.py -t <#threads> -s <samplesheet.txt> [-p -r] -c/-q -1 <single-end.fastq> \
-[-2 <paired-end.fastq>] --renz1 <RE_1> --renz2 <RE_2> --bar_loc <inline/index> [-x [1,2,3,4,5]							
+[-2 <paired-end.fastq>] --renz1 <RE_1> --renz2 <RE_2> [--trim_renz] --bar_loc <inline/index> [--fused --clone_mem <MB> --compress --max_open <#files> --native_trim --telemetry <file>] [-x [1,2,3,4,5]							
 """
 
 #################################################
@@ -46,17 +79,25 @@ python process_rawreads.py -t <#threads> -s <samplesheet.txt> [-p -r] -c/-q -1 <
 usage = usage_line
                         
 parser = optparse.OptionParser(usage=usage)
-parser.add_option("-t", action="store", type = "string", dest = "threads", help = "threads")
+parser.add_option("-t", action="store", type = "string", dest = "threads", help = "threads (also the number of processes for native read processing, e.g. --fused)")
 parser.add_option("-s", action="store", type = "string", dest = "sheet", help = "Sample sheet file (see sample)")
 parser.add_option("-p", action="store_true", dest = "paired", help = "paired reads flag")
 parser.add_option("-c", action="store_true", dest = "clean", help = "quality trim reads using Stacks")
 parser.add_option("-q", action="store_true", dest = "quality", help = "quality trim reads using Trimmomatic")
-parser.add_option("-r", action="store_true", dest = "rescue", help = "rescue barcodes/restriction sites in Stacks (default settings)")
+parser.add_option("-r", action="store_true", dest = "rescue", help = "rescue barcodes/restriction sites in Stacks (default settings), or barcodes and indexes with one mismatch with --fused")
 parser.add_option("-1", action="store", type = "string", dest = "read1", help = "single end read")
 parser.add_option("-2", action="store", type = "string", dest = "read2", help = "paired end read")
 parser.add_option("--renz1", action="store", type = "string", dest = "renz1", help = "restriction enzyme 1 (common cutter)")
 parser.add_option("--renz2", action="store", type = "string", dest = "renz2", help = "restriction enzyme 2 (rare cutter)")
+parser.add_option("--trim_renz", action="store_true", dest = "trim_renz", help = "trim the --renz1/--renz2 cut site remnants from the start of read 1/read 2 after parsing")
 parser.add_option("--bar_loc", action="store", type = "string", dest = "bar_loc", help = "location of barcode & index (per process_radtags documentation)")
+parser.add_option("--clone_mem", action="store", type = "string", dest = "clone_mem", help = "filter PCR clones natively using on-disk fingerprint buckets that each fit in this much memory (MB), instead of clone_filter")
+parser.add_option("--fused", action="store_true", dest = "fused", help = "run clone filtering, UMI trimming, and sample parsing (steps 2-4) as a single native pass")
+parser.add_option("--compress", action="store_true", dest = "compress", help = "write the per-sample reads from --fused as BGZF compressed FASTQ (.fq.gz)")
+parser.add_option("--native_trim", action="store_true", dest = "native_trim", help = "quality trim (step 5, with -q) natively with the Trimmomatic settings instead of running Trimmomatic")
+parser.add_option("--telemetry", action="store", type = "string", dest = "telemetry", help = "append live read counts, rates, and per-cycle quality of the native read processing to this file as JSON lines")
+parser.add_option("--telemetry_interval", action="store", type = "string", dest = "telemetry_interval", help = "seconds between telemetry lines [30]", default = "30")
+parser.add_option("--max_open", action="store", type = "string", dest = "max_open", help = "maximum number of per-sample output files kept open at once [64]", default = "64")
 parser.add_option("-x", action="store", type = "string", dest = "run", help = "processes to run, separated by commas (e.g., 1,2,...,5) [1,2,3,4,5]", default = "1,2,3,4,5")
 
 options, args = parser.parse_args()
@@ -82,13 +123,19 @@ def setup(r1nm):
 
 def PE_clone_filter():
 	print "\n***Filtering PCR duplicates***\n"
-	os.system("clone_filter -1 "+options.read1+" -2 "+options.read2+" -o ./clone_filtered/ 2>&1 | tee ./clone_filtered/"+options.read1+".clonefilter.log")
+	os.system("clone_filter "+clone_filter_type()+"-1 "+options.read1+" -2 "+options.read2+" -o ./clone_filtered/ 2>&1 | tee ./clone_filtered/"+options.read1+".clonefilter.log")
 
 def SE_clone_filter():
 	print "\n***Filtering PCR duplicates***\n"
-	os.system("clone_filter -1 "+options.read1+" -2 "+options.read1+" -o ./clone_filtered/ 2>&1 | tee ./clone_filtered/"+options.read1+".clonefilter.log")
+	os.system("clone_filter "+clone_filter_type()+"-1 "+options.read1+" -2 "+options.read1+" -o ./clone_filtered/ 2>&1 | tee ./clone_filtered/"+options.read1+".clonefilter.log")
 	os.system("rm -f ./clone_filtered/*.fil.fq_2")
 
+### Input type flag for gzip compressed reads ###
+def clone_filter_type():
+	if compressed_input():
+		return "-i gzfastq "
+	return ""
+
 #################################################
 ###             Trim leading 8bp UMI          ###
 #################################################
@@ -193,14 +240,703 @@ def PE_sample_rename(r1nm):
 		os.system(remp2_rename)
 		os.system(combine_broken)
 		
-### Place restriction site trimming routine here ###
+### restriction site trimming subroutine ###
+def PE_site_trim(r1nm):
+	print "\n***Trimming restriction site remnants***\n"
+	global site_patterns
+	site_patterns = [site_remnants(options.renz1), site_remnants(options.renz2)]
+	for handle in fused_samples().values():
+		site_trim_file("./parsed/"+str(r1nm)+"/"+handle+".P1.fq", 1)
+		site_trim_file("./parsed/"+str(r1nm)+"/"+handle+".P2.fq", 2)
+		site_trim_file("./parsed/"+str(r1nm)+"/"+handle+".rem.cat.fq", None)
 
 def SE_sample_rename(r1nm):
 	for foo in open(options.sheet).read().splitlines():
         	bar = foo.split()
         	parse_single = "mv ./parsed/"+str(r1nm)+"/sample_"+bar[3]+".fq ./parsed/"+str(r1nm)+"/"+bar[0]+"_"+bar[3]+".S1.fq"
 		os.system(parse_single)
-### Place restriction site trimming routine here ###
+
+def SE_site_trim(r1nm):
+	print "\n***Trimming restriction site remnants***\n"
+	global site_patterns
+	site_patterns = [site_remnants(options.renz1), site_remnants(options.renz2)]
+	for handle in fused_samples().values():
+		site_trim_file("./parsed/"+str(r1nm)+"/"+handle+".S1.fq", 1)
+
+### Trim the restriction site remnants from the reads of a parsed file in one streaming pass (see site_remnants) ###
+# Reads are read 1 or read 2 (mate 1 or 2), or told apart by their _1/_2 read name suffix (mate None, for broken pairs)
+def site_trim_file(path, mate):
+	if not os.path.exists(path):
+		return
+	writer = sample_writer(path+".renz")
+	stats = {"re_sites": 0, "no_re_site": 0}
+	for chunk in chunked(read_fastq(path), 65536):
+		text = []
+		for record in chunk:
+			read = mate
+			if read is None:
+				read = 2 if record[0].endswith("_2") else 1
+			[record, trimmed] = trim_site(record, read)
+			stats["re_sites" if trimmed else "no_re_site"] += 1
+			text.append(record[0]+"\n"+record[1]+"\n+\n"+record[2]+"\n")
+		write_sample(writer, "".join(text))
+	close_writers([writer])
+	os.rename(path+".renz", path)
+	print os.path.basename(path)+": "+str(stats["re_sites"])+" restriction site remnants trimmed, "+str(stats["no_re_site"])+" reads without one"
+
+
+#################################################
+###     Memory-bounded PCR clone filtering    ###
+#################################################
+
+### Mark PCR clones using 64-bit fingerprints of the UMI + read sequences, with a configurable memory ceiling ###
+# First pass: every read (pair) is fingerprinted and its (fingerprint, read number) is written to an on-disk bucket
+# chosen by the fingerprint prefix, with enough buckets (up to 256) that each should fit in --clone_mem MB
+# Each bucket is then deduplicated on its own (split further by clone_bucket if it is still too large), keeping the
+# first read of every fingerprint, and the remaining reads are marked as clones in a bitmap (one bit per read) that
+# the caller checks on a second pass
+# Writes a clone-count histogram like the clone_filter log to ./clone_filtered/<read1>.clonefilter.log
+def clone_marks():
+	if int(options.clone_mem) < 1:
+		print "\n***Error: --clone_mem must be at least 1 (MB)!***\n"
+		raise SystemExit(1)
+	print "\n***Fingerprinting reads to find PCR duplicates***\n"
+	bits = clone_bucket_bits(int(options.clone_mem))
+	if not os.path.isdir("./clone_filtered"):
+		os.mkdir("./clone_filtered")
+	bucket_dir = tempfile.mkdtemp(prefix = "clone_buckets.", dir = "./clone_filtered")
+	buckets = [open(bucket_dir+"/"+str(bucket), "wb") for bucket in xrange(2 ** bits)]
+	total = 0
+	for chunk in chunked(read_pairs(), 65536):
+		fingerprints = np.array([clone_fingerprint(pair) for pair in chunk], dtype = np.uint64)
+		records = np.zeros(len(chunk), dtype = clone_record)
+		records["fp"] = fingerprints
+		records["idx"] = np.arange(total, total + len(chunk), dtype = np.uint64)
+		total += len(chunk)
+		split_records(records, buckets, 0, bits)
+	for bucket in buckets:
+		bucket.close()
+	
+	print "\n***Removing PCR duplicates from "+str(2 ** bits)+" fingerprint bucket(s)***\n"
+	marks = np.zeros((total + 7) / 8, dtype = np.uint8)
+	histogram = {}
+	for bucket in xrange(2 ** bits):
+		clone_bucket(bucket_dir+"/"+str(bucket), bits, int(options.clone_mem), marks, histogram)
+	os.rmdir(bucket_dir)
+	clone_log(histogram, total)
+	return marks
+
+### Deduplicate one bucket file (whose records share their first 'used' fingerprint bits) into marks and histogram ###
+# A bucket that would not fit in memory_mb while sorted is first split by the next 8 fingerprint bits into 256 smaller
+# buckets, as many times as needed, so the ceiling holds however large the lane and only 256 files are open at once
+def clone_bucket(path, used, memory_mb, marks, histogram):
+	if os.path.getsize(path) * 3 > memory_mb * 1024 * 1024:
+		if used < 64:
+			split_dir = tempfile.mkdtemp(prefix = os.path.basename(path)+".", dir = os.path.dirname(path))
+			buckets = [open(split_dir+"/"+str(bucket), "wb") for bucket in xrange(256)]
+			source = open(path, "rb")
+			while True:
+				records = np.fromfile(source, dtype = clone_record, count = 65536)
+				if len(records) == 0:
+					break
+				split_records(records, buckets, used, 8)
+			source.close()
+			for bucket in buckets:
+				bucket.close()
+			os.remove(path)
+			for bucket in xrange(256):
+				clone_bucket(split_dir+"/"+str(bucket), used + 8, memory_mb, marks, histogram)
+			os.rmdir(split_dir)
+			return
+		print "\n***Warning: "+str(os.path.getsize(path) / clone_record.itemsize)+" copies of one read exceed --clone_mem, sorting them anyway***\n"
+	records = np.fromfile(path, dtype = clone_record)
+	os.remove(path)
+	if len(records) == 0:
+		return
+	records = records[np.lexsort((records["idx"], records["fp"]))]
+	first = np.ones(len(records), dtype = bool)
+	first[1:] = records["fp"][1:] != records["fp"][:-1]
+	clones = records["idx"][~first].astype(np.int64)
+	np.bitwise_or.at(marks, clones >> 3, (1 << (clones & 7)).astype(np.uint8))
+	sizes = np.diff(np.append(np.flatnonzero(first), len(records)))
+	for size, count in enumerate(np.bincount(sizes)):
+		if count > 0:
+			histogram[size] = histogram.get(size, 0) + int(count)
+
+### Append records to the 2 ** bits open bucket files chosen by the fingerprint bits after the first 'used' bits ###
+def split_records(records, buckets, used, bits):
+	if bits == 0:
+		records.tofile(buckets[0])
+		return
+	prefixes = ((records["fp"] << np.uint64(used)) >> np.uint64(64 - bits)).astype(np.int64)
+	order = np.argsort(prefixes, kind = "mergesort")
+	edges = np.searchsorted(prefixes[order], np.arange(2 ** bits + 1))
+	for bucket in np.flatnonzero(np.diff(edges)):
+		records[order[edges[bucket]:edges[bucket+1]]].tofile(buckets[bucket])
+
+### Number of fingerprint prefix bits (log2 of the first-pass bucket count) so that each bucket fits in memory_mb ###
+# The read count is estimated from the size of the read 1 file (assuming 4x compression for gzip files) and its first
+# records; each read takes 16 bytes in a bucket and about three times that while it is being sorted (at most 256
+# buckets are written in the first pass, and clone_bucket splits any that are still too large)
+def clone_bucket_bits(memory_mb):
+	sample = list(itertools.islice(read_fastq(options.read1), 1000))
+	record_bytes = max(1.0, sum([len(record[0]) + 2 * len(record[1]) + 6 for record in sample]) / max(1.0, len(sample)))
+	reads = os.path.getsize(options.read1) * (4 if compressed_input() else 1) / record_bytes
+	bits = 0
+	while bits < 8 and reads * 48 / (2 ** bits) > memory_mb * 1024 * 1024:
+		bits += 1
+	return bits
+
+### Fingerprint and read number of one read (pair) as stored in the buckets ###
+clone_record = np.dtype([("fp", "<u8"), ("idx", "<u8")])
+
+### 64-bit fingerprint of the UMI + read sequences of a read (pair) ###
+def clone_fingerprint(pair):
+	return struct.unpack("<Q", hashlib.md5("\t".join([record[1] for record in pair])).digest()[0:8])[0]
+
+### Clone bitmap of the raw reads, set by fused_parser before worker processes are started so they share it ###
+clone_bitmap = None
+
+### Check the clone bitmap from clone_marks for a read number ###
+def is_clone(marks, read):
+	return (marks[read >> 3] >> (read & 7)) & 1 == 1
+
+### Group the items of an iterator into lists of up to size items ###
+def chunked(iterator, size):
+	chunk = []
+	for item in iterator:
+		chunk.append(item)
+		if len(chunk) == size:
+			yield chunk
+			chunk = []
+	if len(chunk) > 0:
+		yield chunk
+
+### Write the clone-count histogram and totals (in the layout of the clone_filter log) ###
+def clone_log(histogram, total):
+	kept = sum(histogram.values())
+	log = open("./clone_filtered/"+options.read1+".clonefilter.log", "w")
+	log.write("Num Clones\tCount\n")
+	for size in sorted(histogram.keys()):
+		log.write(str(size)+"\t"+str(histogram[size])+"\n")
+	log.write("\n"+str(total)+" pairs of reads input. "+str(kept)+" pairs of reads output, discarded "+str(total - kept)+" pairs of reads, ")
+	log.write("%.2f%% clone reads.\n" % (100.0 * (total - kept) / max(1, total)))
+	log.close()
+	print open("./clone_filtered/"+options.read1+".clonefilter.log", "r").read()
+
+### Step 2 without Stacks: write the reads that are not PCR clones to the files clone_filter would create ###
+def native_clone_filter(r1nm, r2nm):
+	marks = clone_marks()
+	outputs = [open("./clone_filtered/"+r1nm+".fil.fq_1", "w")]
+	if options.paired == True:
+		outputs.append(open("./clone_filtered/"+r2nm+".fil.fq_2", "w"))
+	for read, pair in enumerate(read_pairs()):
+		if not is_clone(marks, read):
+			for out, record in zip(outputs, pair):
+				out.write(record[0]+"\n"+record[1]+"\n+\n"+record[2]+"\n")
+	for out in outputs:
+		out.close()
+
+
+#################################################
+###  Fused clone filter, UMI trim, and parse  ###
+#################################################
+
+### Single pass replacing steps 2-4 ###
+# Reads the raw reads once, drops PCR clones (identical UMI + read sequences by 64-bit fingerprint, first copy kept, as
+# clone_filter does; with --clone_mem the clones are found by clone_marks in a separate, memory-bounded first pass),
+# trims the 8bp UMI from each read, matches the inline barcode (and Illumina index from the read header for paired
+# reads) against the sample sheet, trims the barcode, and writes each sample's reads straight to their final names in
+# ./parsed/<read1 name>/ so step 5 can run directly afterwards
+# With more than one thread (-t), the reads are split into shards that are parsed on a pool of processes and written
+# in shard order, so the output is the same as a single-threaded run (PCR clones are then always found by clone_marks,
+# with --clone_mem or 1024 MB per bucket)
+def fused_parser(r1nm):
+	print "\n***Filtering PCR duplicates, trimming UMIs, and parsing reads by sample in a single pass***\n"
+	samples = fused_samples()
+	barcode_lengths = sorted(set([len(key[0]) for key in samples.keys()]), reverse = True)
+	global barcode_index, site_patterns
+	barcode_index = barcode_lookup(samples.keys(), options.rescue == True)
+	if options.trim_renz == True:
+		site_patterns = [site_remnants(options.renz1), site_remnants(options.renz2)]
+	outdir = "./parsed/"+str(r1nm)+"/"
+	ext = parsed_ext()
+	outputs = {}
+	for key, handle in samples.items():
+		if options.paired == True:
+			outputs[key] = [sample_writer(outdir+handle+".P1."+ext), sample_writer(outdir+handle+".P2."+ext)]
+			close_writers([sample_writer(outdir+handle+".rem.cat."+ext)])		# no broken pairs are created, but step 5 expects the file
+		else:
+			outputs[key] = [sample_writer(outdir+handle+".S1."+ext)]
+	counts = dict([[key, 0] for key in samples.keys()])
+	stats = {"total": 0, "clones": 0, "no_barcode": 0, "rescued": 0, "ambiguous": 0, "re_sites": 0, "no_re_site": 0}
+	telemetry = telemetry_start("fused")
+	workers = worker_count()
+	if workers > 1 or options.clone_mem is not None:
+		if options.clone_mem is None:
+			options.clone_mem = "1024"
+		global clone_bitmap
+		clone_bitmap = clone_marks()
+		seen = None
+	else:
+		seen = set()
+	
+	if workers > 1:
+		pool = multiprocessing.Pool(workers)
+		if compressed_input():
+			shards = numbered_chunks(read_pairs(), 100000)
+		else:
+			shards = fastq_shards(raw_read_files(), 100000)
+		jobs = ([shard, first_read, barcode_lengths] for [shard, first_read] in shards)
+		results = parallel_tools.ordered_results(pool, fused_shard, jobs, 2 * workers)
+	else:
+		results = (fused_chunk(chunk, first_read, barcode_lengths, seen) for [chunk, first_read] in numbered_chunks(read_pairs(), 65536))
+	for [texts, chunk_stats, chunk_counts, chunk_reads] in results:
+		for key in texts.keys():
+			for mate in xrange(len(texts[key])):
+				write_sample(outputs[key][mate], "".join(texts[key][mate]))
+			counts[key] += chunk_counts[key]
+		for stat in stats.keys():
+			stats[stat] += chunk_stats[stat]
+		telemetry_update(telemetry, chunk_stats, dict([[samples[key], {"reads_out": count}] for key, count in chunk_counts.items()]), chunk_reads)
+	if workers > 1:
+		pool.close()
+		pool.join()
+	close_writers([writer for files in outputs.values() for writer in files])
+	telemetry_write(telemetry, True)
+	fused_log(outdir+str(r1nm)+".parse.log", stats, counts, samples)
+
+### Clone filter, UMI trim, and parse a list of read (pair)s whose first read number is first_read ###
+# PCR clones are looked up in clone_bitmap (from clone_marks), or in the seen set of fingerprints if one is given, and
+# samples in barcode_index (from barcode_lookup)
+# Returns the FASTQ text to write for each sample and read file, the read counts, and the size and qualities of the
+# reads for the telemetry (see read_telemetry)
+def fused_chunk(pairs, first_read, barcode_lengths, seen):
+	texts = {}
+	counts = {}
+	reads = read_telemetry(pairs)
+	stats = {"total": len(pairs), "clones": 0, "no_barcode": 0, "rescued": 0, "ambiguous": 0, "re_sites": 0, "no_re_site": 0}
+	for read, pair in enumerate(pairs, first_read):
+		if seen is None:
+			clone = is_clone(clone_bitmap, read)
+		else:
+			fingerprint = clone_fingerprint(pair)
+			clone = fingerprint in seen
+			seen.add(fingerprint)
+		if clone:
+			stats["clones"] += 1
+			continue
+		pair = [[record[0], record[1][8:], record[2][8:]] for record in pair]		# trim UMI (fastx_trimmer -f 9)
+		[key, match] = match_sample(pair, barcode_lengths)
+		if match == "ambiguous":
+			stats["ambiguous"] += 1
+			continue
+		if key is None:
+			stats["no_barcode"] += 1
+			continue
+		if match == "rescued":
+			stats["rescued"] += 1
+		if key not in texts:
+			[texts[key], counts[key]] = [[[] for record in pair], 0]
+		counts[key] += 1
+		barcode_length = len(key[0])
+		for mate in xrange(len(pair)):
+			[header, seq, qual] = pair[mate]
+			if mate == 0:
+				[seq, qual] = [seq[barcode_length:], qual[barcode_length:]]
+			if site_patterns is not None:
+				[[header, seq, qual], trimmed] = trim_site([header, seq, qual], mate + 1)
+				stats["re_sites" if trimmed else "no_re_site"] += 1
+			texts[key][mate].append(stacks_read_name(header, mate + 1)+"\n"+seq+"\n+\n"+qual+"\n")
+	return [texts, stats, counts, reads]
+
+### Parse one shard of the raw reads in a worker process (see fused_parser) ###
+def fused_shard(job):
+	[shard, first_read, barcode_lengths] = job
+	return fused_chunk(list(read_shard(shard)), first_read, barcode_lengths, None)
+
+### Sample sheet as a dictionary: (barcode, index) for paired reads or (barcode,) for single-end reads -> file root ###
+def fused_samples():
+	samples = {}
+	for line in open(options.sheet, "r"):
+		if not line.strip().startswith("#") and line.strip() != "":
+			bar = line.rstrip().split("\t")
+			if options.paired == True:
+				samples[(bar[3], bar[4])] = bar[0]+"_"+bar[3]+"-"+bar[4]
+			else:
+				samples[(bar[3],)] = bar[0]+"_"+bar[3]
+	return samples
+
+### Lookup table from every (barcode, index) or (barcode,) read key to the sample key it belongs to ###
+# Holds the sample keys themselves and, when rescuing, every key with one mismatch in the barcode and/or one in the index,
+# over ACGTN; a variant shared by two samples maps to "ambiguous" instead (variants never replace an exact sample key)
+def barcode_lookup(keys, rescue):
+	index = dict([[key, key] for key in keys])
+	if rescue == True:
+		for key in keys:
+			for variant in itertools.product(*[[part] + mismatch_variants(part) for part in key]):
+				sample = index.get(variant, key)
+				if sample == variant:
+					continue
+				if sample != key:
+					index[variant] = "ambiguous"
+				else:
+					index[variant] = key
+	return index
+
+### Every sequence with exactly one mismatch (A, C, G, T, or N) from seq ###
+def mismatch_variants(seq):
+	return [seq[:pos]+base+seq[pos+1:] for pos in xrange(len(seq)) for base in "ACGTN" if base != seq[pos]]
+
+barcode_index = None
+
+### Find the sample of a read (pair) from its inline barcode and index, with one lookup per barcode length ###
+# Exact matches win (trying the longest barcodes first); otherwise a rescued match is only used if all barcode lengths
+# agree on the sample. Returns [sample key or None, "exact", "rescued", "ambiguous", or None]
+def match_sample(pair, barcode_lengths):
+	if options.paired == True:
+		index = pair[0][0].split(" ")[-1].split(":")[-1]
+	rescued = set()
+	for length in barcode_lengths:
+		if options.paired == True:
+			key = (pair[0][1][:length], index)
+		else:
+			key = (pair[0][1][:length],)
+		sample = barcode_index.get(key)
+		if sample == key:
+			return [key, "exact"]
+		if sample is not None:
+			rescued.add(sample)
+	if len(rescued) == 1 and "ambiguous" not in rescued:
+		return [rescued.pop(), "rescued"]
+	if len(rescued) > 0:
+		return [None, "ambiguous"]
+	return [None, None]
+
+### Restriction site remnant at the start of reads (after the barcode) cut by each enzyme, named as for process_radtags ###
+renz_remnants = {"apeki": "CWGC", "apoi": "AATTY", "bamhi": "GATCC", "bglii": "GATCT", "clai": "CGAT", "csp6i": "TAC",
+	"ecori": "AATTC", "ecot22i": "TGCAT", "hindiii": "AGCTT", "kpni": "GTACC", "mluci": "AATT", "msei": "TAA",
+	"mspi": "CGG", "ndei": "TATG", "nhei": "CTAGC", "nlaiii": "CATG", "noti": "GGCCGC", "nsii": "TGCAT", "psti": "TGCAG",
+	"saci": "AGCTC", "sali": "TCGAC", "sau3ai": "GATC", "sbfi": "TGCAGG", "sphi": "CATGC", "taqi": "CGA", "xbai": "CTAGA",
+	"xhoi": "TCGAG"}
+iupac_bases = {"A": "A", "C": "C", "G": "G", "T": "T", "R": "AG", "Y": "CT", "S": "CG", "W": "AT", "K": "GT", "M": "AC", "N": "ACGT"}
+
+### Patterns matched against the start of reads cut by an enzyme: [remnant length, set of sequences], or None ###
+# All the sequences a (degenerate) remnant stands for are precomputed, along with their one-mismatch variants with -r,
+# so matching a read is a single set lookup of its first bases
+def site_remnants(enzyme):
+	if enzyme is None:
+		return None
+	if enzyme.lower() not in renz_remnants:
+		print "\n***Error: restriction enzyme "+enzyme+" is not known! Choose from: "+", ".join(sorted(renz_remnants.keys()))+"***\n"
+		raise SystemExit(1)
+	remnant = renz_remnants[enzyme.lower()]
+	patterns = set(["".join(bases) for bases in itertools.product(*[iupac_bases[base] for base in remnant])])
+	if options.rescue == True:
+		patterns.update([variant for pattern in patterns for variant in mismatch_variants(pattern)])
+	return [len(remnant), patterns]
+
+site_patterns = None
+
+### Trim the restriction site remnant from the start of a record of read 1 or 2 (using site_patterns) ###
+# Returns [record, whether a remnant was trimmed]
+def trim_site(record, read):
+	patterns = site_patterns[read - 1]
+	if patterns is None or record[1][:patterns[0]] not in patterns[1]:
+		return [record, False]
+	return [[record[0], record[1][patterns[0]:], record[2][patterns[0]:]], True]
+
+### Read the raw reads as lists of one (single-end) or two (paired-end) FASTQ records ###
+def read_pairs():
+	if options.paired == True:
+		return itertools.izip(read_fastq(options.read1), read_fastq(options.read2))
+	return ([record] for record in read_fastq(options.read1))
+
+### Read a FASTQ file one record (header, sequence, quality) at a time, optionally only from byte start to end ###
+# Whole files may be gzip or BGZF compressed (see open_fastq); byte ranges are only used with uncompressed files
+def read_fastq(fastq, start = 0, end = None):
+	if end is None:
+		lines = iter(open_fastq(fastq))
+	else:
+		lines = fastq_range_lines(fastq, start, end)
+	for header in lines:
+		header = header.rstrip("\r\n")
+		if header == "":
+			break
+		seq = next(lines, "").rstrip("\r\n")
+		next(lines, "")
+		qual = next(lines, "").rstrip("\r\n")
+		yield [header, seq, qual]
+
+### Yield the lines of an uncompressed file from byte start up to byte end ###
+def fastq_range_lines(fastq, start, end):
+	handle = open(fastq, "r")
+	handle.seek(start)
+	while handle.tell() < end:
+		line = handle.readline()
+		if line == "":
+			break
+		yield line
+	handle.close()
+
+### Read name written by process_radtags (lane_tile_x_y_read for Illumina 1.8+ headers, otherwise read ID_read) ###
+def stacks_read_name(header, read):
+	name = header[1:].split(" ")[0].split("\t")[0]
+	fields = name.split(":")
+	if len(fields) >= 7:
+		return "@"+"_".join(fields[3:7])+"_"+str(read)
+	if name.endswith("/1") or name.endswith("/2"):
+		name = name[:-2]
+	return "@"+name+"_"+str(read)
+
+### Write the parsing summary log ###
+def fused_log(log_file, stats, counts, samples):
+	log = open(log_file, "w")
+	log.write("Total reads\t"+str(stats["total"])+"\n")
+	log.write("PCR clones removed\t"+str(stats["clones"])+"\n")
+	log.write("No barcode/index match\t"+str(stats["no_barcode"])+"\n")
+	if options.rescue == True:
+		log.write("Barcode/index rescued (1 mismatch)\t"+str(stats["rescued"])+"\n")
+		log.write("Ambiguous barcode/index discarded\t"+str(stats["ambiguous"])+"\n")
+	if options.trim_renz == True:
+		log.write("Restriction site remnants trimmed\t"+str(stats["re_sites"])+"\n")
+		log.write("Reads without restriction site remnant\t"+str(stats["no_re_site"])+"\n")
+	log.write("Retained reads\t"+str(sum(counts.values()))+"\n\n")
+	log.write("Sample\tReads\n")
+	for key in sorted(samples.keys()):
+		log.write(samples[key]+"\t"+str(counts[key])+"\n")
+	log.close()
+	print open(log_file, "r").read()
+
+
+#################################################
+###           Compressed read input           ###
+#################################################
+
+### Open a FASTQ file as an iterator over its lines, whether it is plain text, gzip, or BGZF compressed ###
+# BGZF files are decompressed block by block in batches on the -t processes and plain gzip files are inflated by a
+# separate thread that runs ahead of the caller, so decompression overlaps with the read processing either way. Worker
+# processes (see reset_writers) can't start processes of their own, so they always use the thread
+def open_fastq(fastq):
+	handle = open(fastq, "rb")
+	magic = handle.read(16)
+	handle.close()
+	processes = inflate_processes or worker_count()
+	if magic[0:2] != "\x1f\x8b":
+		return open(fastq, "r")
+	if magic[12:14] == "BC" and processes > 1:
+		return parallel_tools.bgzf_lines(fastq, processes)
+	return inflate_lines(fastq)
+
+### Check whether any of the raw read files is gzip (or BGZF) compressed ###
+def compressed_input():
+	for fastq in raw_read_files():
+		handle = open(fastq, "rb")
+		magic = handle.read(2)
+		handle.close()
+		if magic == "\x1f\x8b":
+			return True
+	return False
+
+### Name of a read file without its extension(s) (e.g., lane1_R1 for lane1_R1.fastq or lane1_R1.fastq.gz) ###
+def read_root(fastq):
+	if fastq.endswith(".gz"):
+		fastq = fastq[:-3]
+	return os.path.splitext(fastq)[0]
+
+### Yield the lines of a gzip file, inflated in a separate thread ###
+def inflate_lines(fastq, queue_size = 16):
+	chunks = Queue.Queue(queue_size)
+	inflater = threading.Thread(target = inflate_chunks, args = (fastq, chunks))
+	inflater.daemon = True
+	inflater.start()
+	remainder = ""
+	while True:
+		data = chunks.get()
+		if data is None:
+			break
+		lines = (remainder + data).split("\n")
+		remainder = lines.pop()
+		for line in lines:
+			yield line+"\n"
+	if remainder != "":
+		yield remainder
+
+### Inflate a gzip file (of one or more members) in 1 MB pieces onto a queue, ending with None ###
+def inflate_chunks(fastq, chunks):
+	handle = open(fastq, "rb")
+	try:
+		inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		while True:
+			data = handle.read(1024 * 1024)
+			if data == "":
+				break
+			while data != "":
+				chunks.put(inflater.decompress(data))
+				data = inflater.unused_data
+				if data != "":
+					inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+	finally:
+		handle.close()
+		chunks.put(None)
+
+
+#################################################
+###           Compressed sample output        ###
+#################################################
+
+### Extension of the per-sample parsed read files (fq.gz with --compress for the --fused outputs, otherwise fq) ###
+def parsed_ext():
+	if options.compress == True and options.fused == True:
+		return "fq.gz"
+	return "fq"
+
+### Create (or truncate) a per-sample output file and return its writer ###
+# Text written to a writer is buffered and, for a .gz file (see parsed_ext and cleaned_ext), cut into 64 KB BGZF
+# blocks that are compressed on a pool of -t threads; at most max_pending blocks per file are in flight before the
+# oldest is written out, so memory stays bounded no matter how many samples there are. Files are only opened while
+# blocks are written out, through an LRU of at most --max_open handles (see writer_handle)
+def sample_writer(path):
+	open(path, "wb").close()
+	return {"path": path, "buffer": [], "size": 0, "pending": collections.deque(), "compress": path.endswith(".gz")}
+
+bgzf_payload = 65280
+max_pending = 4
+compress_pool = None
+compress_threads = None
+inflate_processes = None
+open_handles = collections.OrderedDict()
+
+### Add text to a per-sample output file ###
+def write_sample(writer, text):
+	writer["buffer"].append(text)
+	writer["size"] += len(text)
+	if writer["size"] >= bgzf_payload:
+		flush_writer(writer, False)
+
+### Hand the full blocks of a writer's buffer (or all of it, if final) to the compression threads and write out finished blocks ###
+def flush_writer(writer, final):
+	data = "".join(writer["buffer"])
+	if final:
+		end = len(data)
+	else:
+		end = len(data) - len(data) % bgzf_payload
+	if writer["compress"] == True:
+		for start in xrange(0, end, bgzf_payload):
+			writer["pending"].append(compression_pool().apply_async(bgzf_block, [data[start:start+bgzf_payload]]))
+		while len(writer["pending"]) > (0 if final else max_pending):
+			writer_handle(writer["path"]).write(writer["pending"].popleft().get())
+	elif end > 0:
+		writer_handle(writer["path"]).write(data[:end])
+	[writer["buffer"], writer["size"]] = [[data[end:]], len(data) - end]
+
+### Write out everything left in a list of writers and close their files (BGZF files end with an empty EOF block) ###
+def close_writers(writers):
+	for writer in writers:
+		flush_writer(writer, True)
+		if writer["compress"] == True:
+			writer_handle(writer["path"]).write(bgzf_block(""))
+		if writer["path"] in open_handles:
+			open_handles.pop(writer["path"]).close()
+
+### Open file handle of an output file, reopening it for appending and closing the least recently used handle if needed ###
+def writer_handle(path):
+	if path in open_handles:
+		handle = open_handles.pop(path)
+	else:
+		if len(open_handles) >= max(1, int(options.max_open)):
+			open_handles.popitem(last = False)[1].close()
+		handle = open(path, "ab")
+	open_handles[path] = handle
+	return handle
+
+### Forget the compression threads and open files of the parent process (in a newly started worker process) ###
+# The worker then compresses its output on its own pool of threads threads, and reads compressed input in-process
+# (a pool worker is daemonic and can't have decompression processes of its own)
+def reset_writers(threads):
+	global compress_pool, compress_threads, inflate_processes
+	[compress_pool, compress_threads, inflate_processes] = [None, threads, 1]
+	open_handles.clear()
+
+### Pool of -t threads (or the threads given to reset_writers) that compress output blocks (zlib releases the interpreter lock while compressing) ###
+def compression_pool():
+	global compress_pool
+	if compress_pool is None:
+		compress_pool = multiprocessing.pool.ThreadPool(compress_threads or worker_count())
+	return compress_pool
+
+### Compress data (at most 64 KB) into one BGZF block, a gzip member whose header holds the block size ###
+def bgzf_block(data):
+	compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+	deflated = compressor.compress(data) + compressor.flush()
+	header = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"+struct.pack("<H", len(deflated) + 25)
+	return header + deflated + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+#################################################
+###     Sharded multi-core read processing    ###
+#################################################
+
+### Number of worker processes for native read processing (-t, default 1) ###
+def worker_count():
+	if options.threads is None:
+		return 1
+	return max(1, int(options.threads))
+
+### The raw read file(s): read 1, and read 2 for paired reads ###
+def raw_read_files():
+	if options.paired == True:
+		return [options.read1, options.read2]
+	return [options.read1]
+
+### Split read files into shards of records_per_shard reads ###
+# Returns [shard, first read number] pairs, where a shard is a tuple of one (start, end) byte range per read file, aligned to
+# 4-line FASTQ records and covering the same reads in every file so read 1 and read 2 stay in sync
+def fastq_shards(fastqs, records_per_shard):
+	offsets = [record_offsets(fastq, records_per_shard) for fastq in fastqs]
+	if len(set([len(offset) for offset in offsets])) != 1:
+		print "\n***Error: the read files do not hold the same number of reads!***\n"
+		raise SystemExit(1)
+	return [[tuple([(offset[shard], offset[shard+1]) for offset in offsets]), shard * records_per_shard] for shard in xrange(len(offsets[0]) - 1)]
+
+### Byte offsets of every records_per_shard-th FASTQ record, ending with the file size ###
+# Newlines are counted in large blocks, so this is much faster than parsing the reads
+def record_offsets(fastq, records_per_shard):
+	lines_per_shard = 4 * records_per_shard
+	handle = open(fastq, "rb")
+	offsets = [0]
+	[position, lines] = [0, 0]
+	while True:
+		block = handle.read(4 * 1024 * 1024)
+		if block == "":
+			break
+		start = 0
+		while lines + block.count("\n", start) >= lines_per_shard:
+			for foo in xrange(lines_per_shard - lines):
+				start = block.find("\n", start) + 1
+			offsets.append(position + start)
+			lines = 0
+		lines += block.count("\n", start)
+		position += len(block)
+	handle.close()
+	if offsets[-1] != position:
+		offsets.append(position)
+	return offsets
+
+### Read the read (pair)s of one shard: a tuple of byte ranges, or a list of read (pair)s read from compressed input ###
+def read_shard(shard):
+	if not isinstance(shard, tuple):
+		return shard
+	if len(shard) == 2:
+		return itertools.izip(read_fastq(options.read1, shard[0][0], shard[0][1]), read_fastq(options.read2, shard[1][0], shard[1][1]))
+	return ([record] for record in read_fastq(options.read1, shard[0][0], shard[0][1]))
+
+### Group the items of an iterator into lists of up to size items, each with the number of its first item ###
+def numbered_chunks(iterator, size):
+	first = 0
+	for chunk in chunked(iterator, size):
+		yield [chunk, first]
+		first += len(chunk)
 
 
 #################################################
@@ -208,33 +944,315 @@ def SE_sample_rename(r1nm):
 #################################################
 
 def PE_quality_trim(r1nm):
-	if options.quality == True:
-		for foo in open(options.sheet).read().splitlines():
-        		bar = foo.split()
-			handle = bar[0]+"_"+bar[3]+"-"+bar[4]
-			threads = options.threads
-			PEclean = "trimmomatic-0.35.jar PE -threads "+threads+" -trimlog ./cleaned/"+handle+"_paired.qtrim.log ./parsed/"+str(r1nm)+"/"+handle+".P1.fq ./parsed/"+str(r1nm)+"/"+handle+".P2.fq ./cleaned/"+handle+".P1.qtrim ./cleaned/"+handle+".S1.qtrim ./cleaned/"+handle+".P2.qtrim ./cleaned/"+handle+".S2.qtrim LEADING:10 TRAILING:10 SLIDINGWINDOW:4:15 MINLEN:36 TOPHRED33 2>&1 | tee ./cleaned/"+handle+"_paired.qtrim.summary.log"
-			broken_clean = "trimmomatic-0.35.jar SE -threads "+threads+" -trimlog ./cleaned/"+handle+"_broken.qtrim.log ./parsed/"+str(r1nm)+"/"+handle+".rem.cat.fq ./cleaned/"+handle+".broken.qtrim LEADING:10 TRAILING:10 SLIDINGWINDOW:4:15 MINLEN:36 TOPHRED33 2>&1 | tee ./cleaned/"+handle+".broken.qtrim.summary.log"
-			os.system(str(PEclean))
-			os.system(str(broken_clean))
-			os.system("sed -i 's/\_1$/\ 1/g' ./cleaned/"+handle+".P1.qtrim")
-			os.system("sed -i 's/\_2$/\ 2/g' ./cleaned/"+handle+".P2.qtrim")
-			os.system("sed -i 's/\_1$/\ 1/g' ./cleaned/"+handle+".S1.qtrim")
-                        os.system("sed -i 's/\_2$/\ 2/g' ./cleaned/"+handle+".S2.qtrim")
-### Put command to trim away restriction site here and below else for Trimmomatic option ###
-				
+	if options.quality == True and options.native_trim == True:
+		native_quality_trim(r1nm)
+	elif options.quality == True:
+		jobs = trim_jobs(r1nm)
+		[slots, threads] = trim_slots(len(jobs))
+		run_concurrently([[handle, PE_trim_command(r1nm, handle, threads), "./cleaned/"+handle+".qtrim.out"] for [size, handle] in jobs], slots)
+
+### Trimmomatic and read name fixing commands for one sample (paired and broken reads), as one shell command ###
+def PE_trim_command(r1nm, handle, threads):
+	PEclean = "trimmomatic-0.35.jar PE -threads "+threads+" -trimlog ./cleaned/"+handle+"_paired.qtrim.log ./parsed/"+str(r1nm)+"/"+handle+".P1."+parsed_ext()+" ./parsed/"+str(r1nm)+"/"+handle+".P2."+parsed_ext()+" ./cleaned/"+handle+".P1.qtrim ./cleaned/"+handle+".S1.qtrim ./cleaned/"+handle+".P2.qtrim ./cleaned/"+handle+".S2.qtrim LEADING:10 TRAILING:10 SLIDINGWINDOW:4:15 MINLEN:36 TOPHRED33 2>&1 | tee ./cleaned/"+handle+"_paired.qtrim.summary.log"
+	broken_clean = "trimmomatic-0.35.jar SE -threads "+threads+" -trimlog ./cleaned/"+handle+"_broken.qtrim.log ./parsed/"+str(r1nm)+"/"+handle+".rem.cat."+parsed_ext()+" ./cleaned/"+handle+".broken.qtrim LEADING:10 TRAILING:10 SLIDINGWINDOW:4:15 MINLEN:36 TOPHRED33 2>&1 | tee ./cleaned/"+handle+".broken.qtrim.summary.log"
+	commands = [PEclean, broken_clean]
+	commands.append("sed -i 's/\_1$/\ 1/g' ./cleaned/"+handle+".P1.qtrim")
+	commands.append("sed -i 's/\_2$/\ 2/g' ./cleaned/"+handle+".P2.qtrim")
+	commands.append("sed -i 's/\_1$/\ 1/g' ./cleaned/"+handle+".S1.qtrim")
+	commands.append("sed -i 's/\_2$/\ 2/g' ./cleaned/"+handle+".S2.qtrim")
+	return "; ".join(commands)
+
 def SE_quality_trim(r1nm):
-	if options.quality == True:
-		for foo in open(options.sheet).read().splitlines():
-        		bar = foo.split()
-            		handle = bar[0]+"_"+bar[3]
-            		threads = options.threads
-            		SEclean = "trimmomatic-0.35.jar SE -threads "+threads+" -trimlog ./cleaned/"+handle+".qtrim.log ./parsed/"+str(r1nm)+"/"+handle+".S1.fq ./cleaned/"+handle+".S1.qtrim LEADING:10 TRAILING:10 SLIDINGWINDOW:4:15 MINLEN:36 TOPHRED33 2>&1 | tee ./cleaned/"+handle+".qtrim.summary.log"
-			os.system(str(SEclean))
-			os.system("sed -i 's/\_1$/\ 1/g' ./cleaned/"+handle+".S1.qtrim")
-			os.system("sed -i 's/\_2$/\ 2/g' ./cleaned/"+handle+".S2.qtrim")
-### Put command to trim away restriction site here and below else for Trimmomatic option ###
+	if options.quality == True and options.native_trim == True:
+		native_quality_trim(r1nm)
+	elif options.quality == True:
+		jobs = trim_jobs(r1nm)
+		[slots, threads] = trim_slots(len(jobs))
+		run_concurrently([[handle, SE_trim_command(r1nm, handle, threads), "./cleaned/"+handle+".qtrim.out"] for [size, handle] in jobs], slots)
+
+### Trimmomatic and read name fixing commands for one sample, as one shell command ###
+def SE_trim_command(r1nm, handle, threads):
+	SEclean = "trimmomatic-0.35.jar SE -threads "+threads+" -trimlog ./cleaned/"+handle+".qtrim.log ./parsed/"+str(r1nm)+"/"+handle+".S1."+parsed_ext()+" ./cleaned/"+handle+".S1.qtrim LEADING:10 TRAILING:10 SLIDINGWINDOW:4:15 MINLEN:36 TOPHRED33 2>&1 | tee ./cleaned/"+handle+".qtrim.summary.log"
+	commands = [SEclean]
+	commands.append("sed -i 's/\_1$/\ 1/g' ./cleaned/"+handle+".S1.qtrim")
+	commands.append("sed -i 's/\_2$/\ 2/g' ./cleaned/"+handle+".S2.qtrim")
+	return "; ".join(commands)
 
+### Samples to quality trim as [size of their parsed reads, file root], largest first ###
+def trim_jobs(r1nm):
+	jobs = []
+	for handle in fused_samples().values():
+		if options.paired == True:
+			names = ["P1", "P2", "rem.cat"]
+		else:
+			names = ["S1"]
+		paths = ["./parsed/"+str(r1nm)+"/"+handle+"."+name+"."+parsed_ext() for name in names]
+		jobs.append([sum([os.path.getsize(path) for path in paths if os.path.exists(path)]), handle])
+	return sorted(jobs, reverse = True)
+
+### Number of samples to trim at once and threads for each, within the -t core budget ###
+# Trimming a sample is mostly I/O-bound and makes little use of extra threads, so the budget goes to running more samples
+# at once (one thread each); cores left over when there are fewer samples than cores are shared out among them
+def trim_slots(samples):
+	cores = worker_count()
+	slots = max(1, min(cores, samples))
+	return [slots, str(max(1, cores / slots))]
+
+### Run [name, shell command, log file] jobs in the given order with at most slots of them running at once ###
+# The output of each job goes to its own log file, so the output of jobs running side by side is not interleaved
+def run_concurrently(jobs, slots):
+	jobs = collections.deque(jobs)
+	running = []
+	while len(jobs) > 0 or len(running) > 0:
+		while len(jobs) > 0 and len(running) < slots:
+			[name, command, log_file] = jobs.popleft()
+			print "\n***Quality-trimming "+name+" (output in "+log_file+")***\n"
+			log = open(log_file, "w")
+			running.append([subprocess.Popen(command, shell = True, stdout = log, stderr = subprocess.STDOUT), log])
+		time.sleep(0.5)
+		for job in list(running):
+			if job[0].poll() is not None:
+				job[1].close()
+				running.remove(job)
+
+
+#################################################
+###       Native quality trimming (NumPy)     ###
+#################################################
+
+### Trimming rules (Trimmomatic LEADING:10 TRAILING:10 SLIDINGWINDOW:4:15 MINLEN:36, with phred+33 qualities) ###
+trim_leading = 10
+trim_trailing = 10
+trim_window = 4
+trim_window_quality = 15
+trim_minlen = 36
+
+### Step 5 without Trimmomatic: quality trim the parsed reads of every sample into the 'cleaned' directory ###
+# Writes the files Trimmomatic and the read name fixes (sed) would create: read pairs that both survive go to .P1/.P2.qtrim,
+# pairs with one surviving read to .S1/.S2.qtrim, and broken pairs (rem.cat) to .broken.qtrim
+# Samples are trimmed on -t processes at once (one sample per process), starting with the largest
+def native_quality_trim(r1nm):
+	print "\n***Quality-trimming reads natively***\n"
+	jobs = [[r1nm, handle] for [size, handle] in trim_jobs(r1nm)]
+	[slots, threads] = trim_slots(len(jobs))
+	telemetry = telemetry_start("trim")
+	if slots == 1:
+		results = (native_trim_sample(job) for job in jobs)
+	else:
+		pool = multiprocessing.Pool(slots, reset_writers, [int(threads)])
+		results = pool.imap_unordered(native_trim_sample, jobs)
+	for [handle, stats, reads] in results:
+		survived = 2 * stats["both"] + stats["forward"] + stats["reverse"]
+		stats = {"reads_in": stats["input"] * (2 if options.paired == True else 1), "reads_out": survived}
+		telemetry_update(telemetry, stats, {handle: stats}, reads)
+	if slots > 1:
+		pool.close()
+		pool.join()
+	telemetry_write(telemetry, True)
+
+### Quality trim the reads of one sample (see native_quality_trim) ###
+# Returns [file root, read counts, size and qualities of the reads (see read_telemetry)] of its paired or single-end reads
+def native_trim_sample(job):
+	[r1nm, handle] = job
+	indir = "./parsed/"+str(r1nm)+"/"
+	ext = cleaned_ext()
+	if options.paired == True:
+		outputs = [sample_writer("./cleaned/"+handle+"."+name+"."+ext) for name in ["P1", "S1", "P2", "S2"]]
+		[stats, reads] = trim_reads([indir+handle+".P1."+parsed_ext(), indir+handle+".P2."+parsed_ext()], outputs, True)
+		trim_log("./cleaned/"+handle+"_paired.qtrim.summary.log", stats, True)
+		outputs = [sample_writer("./cleaned/"+handle+".broken."+ext)]
+		[broken_stats, broken_reads] = trim_reads([indir+handle+".rem.cat."+parsed_ext()], outputs, False)
+		trim_log("./cleaned/"+handle+".broken.qtrim.summary.log", broken_stats, False)
+	else:
+		outputs = [sample_writer("./cleaned/"+handle+".S1."+ext)]
+		[stats, reads] = trim_reads([indir+handle+".S1."+parsed_ext()], outputs, True)
+		trim_log("./cleaned/"+handle+".qtrim.summary.log", stats, False)
+	return [handle, stats, reads]
+
+### Extension of the quality-trimmed read files (qtrim, or qtrim.gz with --compress) ###
+def cleaned_ext():
+	if options.compress == True:
+		return "qtrim.gz"
+	return "qtrim"
+
+### Quality trim one FASTQ file, or a pair of read 1 and read 2 files, in batches of reads ###
+# outputs are the writers for [single-end reads] or [paired 1, single 1, paired 2, single 2]; with rename, read names
+# ending in _1/_2 get a space instead (e.g., @1101_1234_5678_1 becomes @1101_1234_5678 1). Returns the read counts and
+# the size and qualities of the input reads for the telemetry (see read_telemetry)
+def trim_reads(inputs, outputs, rename):
+	stats = {"input": 0, "both": 0, "forward": 0, "reverse": 0, "dropped": 0}
+	telemetry_reads = None
+	if len(inputs) == 2:
+		reads = itertools.izip(read_fastq(inputs[0]), read_fastq(inputs[1]))
+	else:
+		reads = ([record] for record in read_fastq(inputs[0]))
+	for chunk in chunked(reads, 65536):
+		stats["input"] += len(chunk)
+		telemetry_reads = add_read_telemetry(telemetry_reads, read_telemetry(chunk))
+		bounds = [trim_bounds([pair[mate] for pair in chunk]) for mate in xrange(len(inputs))]
+		if len(inputs) == 1:
+			[starts, ends] = bounds[0]
+			kept = np.flatnonzero(ends - starts >= trim_minlen)
+			write_sample(outputs[0], "".join([trimmed_record(chunk[read][0], starts[read], ends[read], 1, rename) for read in kept]))
+			stats["forward"] += len(kept)
+			stats["dropped"] += len(chunk) - len(kept)
+			continue
+		survived = [ends - starts >= trim_minlen for [starts, ends] in bounds]
+		routes = [[0, 2, survived[0] & survived[1]], [1, None, survived[0] & ~survived[1]], [None, 3, ~survived[0] & survived[1]]]
+		for [out1, out2, mask] in routes:
+			for read in np.flatnonzero(mask):
+				if out1 is not None:
+					write_sample(outputs[out1], trimmed_record(chunk[read][0], bounds[0][0][read], bounds[0][1][read], 1, rename))
+				if out2 is not None:
+					write_sample(outputs[out2], trimmed_record(chunk[read][1], bounds[1][0][read], bounds[1][1][read], 2, rename))
+		stats["both"] += int(routes[0][2].sum())
+		stats["forward"] += int(routes[1][2].sum())
+		stats["reverse"] += int(routes[2][2].sum())
+		stats["dropped"] += int((~survived[0] & ~survived[1]).sum())
+	close_writers(outputs)
+	return [stats, telemetry_reads]
+
+### First and last (exclusive) bases kept of a batch of FASTQ records after LEADING, TRAILING, and SLIDINGWINDOW trimming ###
+# The qualities are packed into one uint8 array (padded with quality 0), with the quality of N bases set to 0, and each
+# rule is applied to every read at once. Reads with no bases left have start == end
+def trim_bounds(records):
+	lengths = np.array([len(record[2]) for record in records], dtype = np.int64)
+	width = max(1, int(lengths.max()))
+	quals = np.frombuffer("".join([record[2].ljust(width, "!") for record in records]), dtype = np.uint8).reshape(len(records), width).astype(np.int64) - 33
+	bases = np.frombuffer("".join([record[1].ljust(width, "N") for record in records]), dtype = np.uint8).reshape(len(records), width)
+	quals[bases == ord("N")] = 0
+	positions = np.arange(width)
+	inside = positions < lengths[:, None]
+	## LEADING and TRAILING: first and last bases with at least the required quality
+	good = inside & (quals >= trim_leading)
+	starts = np.where(good.any(1), good.argmax(1), lengths)
+	good = inside & (quals >= trim_trailing)
+	ends = np.where(good.any(1), width - good[:, ::-1].argmax(1), 0)
+	ends = np.maximum(ends, starts)
+	## SLIDINGWINDOW, as Trimmomatic's SlidingWindowTrimmer on the bases left by LEADING and TRAILING: reads shorter than
+	## the window, or whose first window's mean quality is too low, are dropped; other reads are kept through the end of
+	## the last window before the first low one, and then cut back to their last base with at least the window quality
+	if width < trim_window:
+		return [starts, starts]
+	sums = np.cumsum(np.hstack([np.zeros((len(records), 1), dtype = np.int64), quals]), axis = 1)
+	windows = sums[:, trim_window:] - sums[:, :-trim_window]
+	window_starts = positions[:width - trim_window + 1]
+	low = (windows < trim_window * trim_window_quality) & (window_starts >= starts[:, None]) & (window_starts + trim_window <= ends[:, None])
+	first_low = np.where(low.any(1), low.argmax(1), -1)
+	dropped = (ends - starts < trim_window) | (first_low == starts)
+	ends = np.where(first_low > starts, first_low - 1 + trim_window, ends)
+	good = (positions >= starts[:, None]) & (positions < ends[:, None]) & (quals >= trim_window_quality)
+	ends = np.where(good.any(1) & ~dropped, width - good[:, ::-1].argmax(1), starts)
+	return [starts, ends]
+
+### FASTQ text of a record trimmed to bases start to end, with its read name fixed if rename is set ###
+def trimmed_record(record, start, end, read, rename):
+	header = record[0]
+	if rename == True and header.endswith("_"+str(read)):
+		header = header[:-2]+" "+str(read)
+	return header+"\n"+record[1][start:end]+"\n+\n"+record[2][start:end]+"\n"
+
+### Write a trimming summary log (in the layout of the Trimmomatic summary) ###
+def trim_log(log_file, stats, paired):
+	total = max(1, stats["input"])
+	if paired == True:
+		line = "Input Read Pairs: %d Both Surviving: %d (%.2f%%) Forward Only Surviving: %d (%.2f%%) Reverse Only Surviving: %d (%.2f%%) Dropped: %d (%.2f%%)" % (stats["input"], stats["both"], 100.0 * stats["both"] / total, stats["forward"], 100.0 * stats["forward"] / total, stats["reverse"], 100.0 * stats["reverse"] / total, stats["dropped"], 100.0 * stats["dropped"] / total)
+	else:
+		line = "Input Reads: %d Surviving: %d (%.2f%%) Dropped: %d (%.2f%%)" % (stats["input"], stats["forward"], 100.0 * stats["forward"] / total, stats["dropped"], 100.0 * stats["dropped"] / total)
+	log = open(log_file, "w")
+	log.write(line+"\n")
+	log.close()
+	print line
+
+
+#################################################
+###         Read-processing telemetry         ###
+#################################################
+
+### Start the live counters of a native read-processing stage (None without --telemetry) ###
+# Counts are added up as batches of reads pass through (see telemetry_update) and written to --telemetry as one JSON line
+# every --telemetry_interval seconds, so a slow node or a failing sample shows up while the stage is still running
+def telemetry_start(stage):
+	if options.telemetry is None:
+		return None
+	now = time.time()
+	return {"stage": stage, "start": now, "written": now, "counts": {}, "samples": {}, "reads": None}
+
+### Add the counts of a batch of reads, and of the samples they went to, to the telemetry counters ###
+def telemetry_update(telemetry, counts, samples, reads):
+	if telemetry is None:
+		return
+	for name, count in counts.items():
+		telemetry["counts"][name] = telemetry["counts"].get(name, 0) + count
+	for handle, sample_counts in samples.items():
+		totals = telemetry["samples"].setdefault(handle, {})
+		for name, count in sample_counts.items():
+			totals[name] = totals.get(name, 0) + count
+	telemetry["reads"] = add_read_telemetry(telemetry["reads"], reads)
+	if time.time() - telemetry["written"] >= float(options.telemetry_interval):
+		telemetry_write(telemetry, False)
+
+### Append the telemetry counters and rates to --telemetry as a JSON line, and write the summary file at the end of a stage ###
+def telemetry_write(telemetry, final):
+	if telemetry is None:
+		return
+	telemetry["written"] = time.time()
+	elapsed = max(telemetry["written"] - telemetry["start"], 0.001)
+	counts = telemetry["counts"]
+	reads = telemetry["reads"] or {"records": 0, "bytes": 0, "cycles": []}
+	line = collections.OrderedDict()
+	line["stage"] = telemetry["stage"]
+	line["time"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(telemetry["written"]))
+	line["final"] = final
+	line["elapsed_sec"] = round(elapsed, 1)
+	line["reads_per_sec"] = round(reads["records"] / elapsed, 1)
+	line["mb_per_sec"] = round(reads["bytes"] / elapsed / 1e6, 3)
+	if "total" in counts:
+		line["clone_rate"] = round(float(counts["clones"]) / max(1, counts["total"]), 4)
+		line["rescue_rate"] = round(float(counts["rescued"]) / max(1, counts["total"] - counts["clones"]), 4)
+		line["re_site_rate"] = round(float(counts["re_sites"]) / max(1, counts["re_sites"] + counts["no_re_site"]), 4)
+	line["counts"] = counts
+	line["samples"] = telemetry["samples"]
+	line["mean_quality_per_cycle"] = [[round(float(total) / depth, 2) if depth > 0 else None for [total, depth] in zip(*cycles)] for cycles in reads["cycles"]]
+	log = open(options.telemetry, "a")
+	log.write(json.dumps(line)+"\n")
+	log.close()
+	if final:
+		summary = open(options.telemetry+"."+telemetry["stage"]+".summary.json", "w")
+		json.dump(line, summary, indent = 1)
+		summary.close()
+
+### Number, size (in bytes of FASTQ text), and quality sums per cycle of a batch of read (pair)s, for the telemetry ###
+# Returns {"records", "bytes", "cycles"}, where cycles holds [quality sums, number of reads] by cycle for each read of
+# the pairs, or None without --telemetry
+def read_telemetry(pairs):
+	if options.telemetry is None or len(pairs) == 0:
+		return None
+	reads = {"records": len(pairs) * len(pairs[0]), "bytes": 0, "cycles": []}
+	for mate in xrange(len(pairs[0])):
+		quals = [pair[mate][2] for pair in pairs]
+		lengths = np.array([len(qual) for qual in quals], dtype = np.int64)
+		width = max(1, int(lengths.max()))
+		packed = np.frombuffer("".join([qual.ljust(width, "!") for qual in quals]), dtype = np.uint8).reshape(len(quals), width)
+		sums = packed.sum(0, dtype = np.int64) - 33 * len(quals)		# padding (!) is quality 0
+		depths = (lengths[:, None] > np.arange(width)).sum(0)
+		reads["cycles"].append([sums, depths])
+		reads["bytes"] += 2 * int(lengths.sum()) + sum([len(pair[mate][0]) for pair in pairs]) + 5 * len(pairs)
+	return reads
+
+### Add up the read telemetry of two batches (either may be None) ###
+def add_read_telemetry(total, part):
+	if total is None or part is None:
+		return total or part
+	total["records"] += part["records"]
+	total["bytes"] += part["bytes"]
+	for mate in xrange(len(part["cycles"])):
+		for column in xrange(2):
+			[longer, shorter] = sorted([total["cycles"][mate][column], part["cycles"][mate][column]], key = len, reverse = True)
+			longer = longer.copy()
+			longer[:len(shorter)] += shorter
+			total["cycles"][mate][column] = longer
+	return total
 
 
 #################################################
@@ -243,33 +1261,49 @@ def SE_quality_trim(r1nm):
 
 def main():
 	if options.paired == True:
-		r1nm, r1ext = os.path.splitext(options.read1)
-		r2nm, r2ext = os.path.splitext(options.read2)
+		r1nm = read_root(options.read1)
+		r2nm = read_root(options.read2)
 		if "1" in options.run:
 			setup(r1nm)
-		if "2" in options.run:
-			PE_clone_filter()
-		if "3" in options.run:
-			PE_lead_trim(r1nm, r2nm)
-		if "4" in options.run:
-			parse_sample_sheet()
-			PE_sample_parser(r1nm, r2nm)
-			PE_sample_rename(r1nm)
+		if options.fused == True:
+			if "2" in options.run or "3" in options.run or "4" in options.run:
+				fused_parser(r1nm)
+		else:
+			if "2" in options.run and options.clone_mem is not None:
+				native_clone_filter(r1nm, r2nm)
+			elif "2" in options.run:
+				PE_clone_filter()
+			if "3" in options.run:
+				PE_lead_trim(r1nm, r2nm)
+			if "4" in options.run:
+				parse_sample_sheet()
+				PE_sample_parser(r1nm, r2nm)
+				PE_sample_rename(r1nm)
+				if options.trim_renz == True:
+					PE_site_trim(r1nm)
 		if "5" in options.run:
 			PE_quality_trim(r1nm)
 
 	else:
-		r1nm, r1ext = os.path.splitext(options.read1)
+		r1nm = read_root(options.read1)
 		if "1" in options.run:
 			setup(r1nm)
-		if "2" in options.run:
-			SE_clone_filter()
-		if "3" in options.run:
-			SE_lead_trim(r1nm)
-		if "4" in options.run:
-			parse_sample_sheet()
-			SE_sample_parser(r1nm)
-			SE_sample_rename(r1nm)
+		if options.fused == True:
+			if "2" in options.run or "3" in options.run or "4" in options.run:
+				fused_parser(r1nm)
+		else:
+			if "2" in options.run and options.clone_mem is not None:
+				native_clone_filter(r1nm, None)
+			elif "2" in options.run:
+				SE_clone_filter()
+			if "3" in options.run:
+				SE_lead_trim(r1nm)
+			if "4" in options.run:
+				parse_sample_sheet()
+				SE_sample_parser(r1nm)
+				SE_sample_rename(r1nm)
+				if options.trim_renz == True:
+					SE_site_trim(r1nm)
 		if "5" in options.run:
 			SE_quality_trim(r1nm)
 
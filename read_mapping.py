@@ -2,8 +2,14 @@
 
 ##print __name__
 
+import errno
 import optparse
 import os
+import subprocess
+import sys
+import multiprocessing
+import threading
+import reference_cache
 
 usage_line = """
 read_mapping.py
@@ -17,7 +23,9 @@ Script that takes read files (paired or unpaired) and maps them to a reference s
 Note that this script only uses the 'mem' bwa mapping algorithm and can't be used with other algorithms without
 modification. Input is a reference sequence in fasta format and the directory containing the read files to be
 mapped (without beginning or ending /). Naming conventions for read files are as follows:
-1. The file extension (normally fastq) must match that passed to the command with the '--ext' flag.
+1. The file extension (normally fastq) must match that passed to the command with the '--ext' flag. Read files
+may also be gzip (or BGZF) compressed with an added '.gz' (e.g., sample.P1.fastq.gz with '--ext fastq'), which are
+mapped without decompressing them first.
 2. Prior to the extension, there must be an indication of the read type (single or paired) as follows:
 	a. P1 and P2 for paired reads, with P1 designated for the single-end reads and P2 designated for the paired-end reads
 	b. S1 and S2 for paired reads in which the pairs were broken during quality trimming, with S1 designated
@@ -27,15 +35,42 @@ mapped (without beginning or ending /). Naming conventions for read files are as
 Example: ID1234_Loc1_ACTTAG-GTACAG.P1.fastq = single-end reads of paired reads of sample ID1234_Loc1_ACTTAG-GTACAG
 Note: Reads that do not have this file name formatting will probably not be run correctly.
 
+The reference is indexed through the shared reference cache (see reference_cache.py): it is indexed once for each
+version of bwa and reused by later runs, from any directory, as long as the FASTA is unchanged. The cache is in
+'--index_cache' (or the REFERENCE_CACHE environment variable, or ~/.reference_cache). With '--no_cache' the reference
+is indexed where it is, as before, and '--no_index' uses an existing index next to the reference.
+
 Either a '-p' flag for paired reads or a '-s' flag for single-end reads only needs to be passed to the program.
 One can also pass the number of threads that can be used for mapping and any of the bwa mapping flags (as one text string).
 The script will create an indexed reference, map all reads from each sample to the reference to create a SAM mapping file,
 convert the SAM mapping file to a BAM mapping file, merge BAM mapping files where necessary, and sort and index each sample
 BAM file. It will also remove the larger SAM files to save on space unless the '--keep_sams' flag is passed. All mapping
-files are outputted to the 'mapping' directory that is created in the working directory by the script.
+files are outputted to the 'mapping' directory that is created in the working directory by the script. The single-end
+reads of each sample (the S1, S2 and broken files that are present, plain or compressed) are streamed into bwa one
+file after another, without writing a concatenated copy of them first.
+
+With the '--stream' flag, the output of bwa is instead piped straight into 'samtools sort' (SAMtools v. 1.3 or later),
+using '--sort_mem' memory and '--sort_threads' threads, so no SAM or unsorted BAM files are written. For paired reads, the
+paired-end and single-end alignments are merged in the same sort. The mapping summary report (in the layout of 'samtools
+flagstat') is counted as the alignments stream past, and each sample ends up with one sorted, indexed BAM file
+(sample.merge.sort.bam for paired reads, sample.sort.bam for single-end reads) that is written only once.
+
+By default samples are mapped one after another with '--threads' threads. With '--cores', several samples are mapped
+at once within that many cores in total (about '--job_threads' threads per sample, split between bwa and the sorting
+with '--stream'), starting with the samples with the most reads. '--memory' caps the total memory (e.g., 64G), counting
+the reference index and the sorting memory of every sample being mapped. The output of each sample mapped alongside
+others goes to its own log file (mapping/sample.mapping.log), and each sample only removes its own SAM files.
+
+With '--batch', all samples are mapped by a single bwa process (bwa mem -p), so the reference index is only loaded
+once instead of once per read file. The reads of each sample are streamed into bwa one sample after another, and as
+bwa keeps the order of its input, the alignments come back one sample after another too. They are split back into the
+same sorted, indexed BAM files and reports as with '--stream' (which '--batch' implies), with a read group (@RG, with
+the sample name as ID and SM) and RG tags added for each sample. Only one 'samtools sort' runs at a time. bwa uses
+'--threads' threads (or, with '--cores', the cores not used for sorting).
 
 python read_mapping.py -p/-s --reference <reference.fasta> --read_dir <directory_of_reads> --ext <file_ext> [--threads <#threads>
---bwa_opts "<options_string>" --keep_sams --no_index]							
+--bwa_opts "<options_string>" --keep_sams --no_index --index_cache <directory> --no_cache --stream --sort_mem <mem> --sort_threads <#threads>
+--cores <#cores> --memory <mem> --job_threads <#threads> --batch]							
 """
 
 #################################################
@@ -52,6 +87,15 @@ parser.add_option("--ext", action = "store", dest = "ext", help = "the file exte
 parser.add_option("--bwa_opts", action = "store", dest = "bwa", help = "all additional bwa mapping options as a text string, in quotes")
 parser.add_option("--keep_sams", action = "store_true", dest = "sams", help = "keep the SAM mapping files", default = "False")
 parser.add_option("--no_index", action = "store_true", dest = "index", help = "pass flag to turn off reference indexing (i.e., if already complete)")
+parser.add_option("--index_cache", action = "store", dest = "index_cache", help = "shared reference index cache directory [$REFERENCE_CACHE or ~/.reference_cache]")
+parser.add_option("--no_cache", action = "store_true", dest = "no_cache", help = "index the reference where it is instead of through the reference cache")
+parser.add_option("--stream", action = "store_true", dest = "stream", help = "pipe bwa output straight into a sorted BAM (needs SAMtools v. 1.3+), with no intermediate SAM files")
+parser.add_option("--sort_mem", action = "store", dest = "sort_mem", help = "memory per sorting thread with --stream (samtools sort -m) [768M]", default = "768M")
+parser.add_option("--sort_threads", action = "store", dest = "sort_threads", help = "sorting/compression threads with --stream (samtools sort -@) [1]", default = "1")
+parser.add_option("--cores", action = "store", dest = "cores", help = "total cores for mapping several samples at once (instead of one at a time with --threads)")
+parser.add_option("--memory", action = "store", dest = "memory", help = "total memory for mapping several samples at once with --cores (e.g., 64G)")
+parser.add_option("--job_threads", action = "store", dest = "job_threads", help = "threads per sample with --cores [8]", default = "8")
+parser.add_option("--batch", action = "store_true", dest = "batch", help = "map all samples with one bwa process (loading the index once), with a read group per sample (implies --stream)")
 parser.add_option("-p", action = "store_true", dest = "paired", help = "paired-end reads")
 parser.add_option("-s", action = "store_true", dest = "single", help = "single-end reads only")
 
@@ -66,9 +110,12 @@ def setup():
 	os.system("mkdir mapping")											# make 'mapping' directory (may error if already present)
 	if options.index is True:											# If reference is already indexed, can skip lengthy indexing
 		print "\n***Not indexing reference genome***\n"					# by passing '--no_index' flag
-	else:									
+	elif options.no_cache == True:										# Index the reference where it is
 		print "\n***Indexing reference genome***\n"
-		os.system("bwa index "+options.reference)						# Otherwise $ bwa index <reference>
+		os.system("bwa index "+options.reference)						# $ bwa index <reference>
+	else:																# Otherwise use (or fill) the shared cache,
+		print "\n***Using the reference index cache***\n"				# mapping to the cached index from here on
+		options.reference = reference_cache.cached_bwa_index(options.reference, options.index_cache)
 
 
 #################################################
@@ -79,30 +126,81 @@ def make_SE_dict(name):
 	SE_dict = {}
 #	print "\n***Making SE_dict***\n"
 	root = name
-	ext = options.ext
-	nameS1 = str(root)+".S1."+str(ext)									# Set S1 to sample.S1.ext
-	nameS2 = str(root)+".S2."+str(ext)									# Set S2 to sample.S2.ext
-	nameBroken = str(root)+".broken."+str(ext)
-	if nameS1 not in SE_dict.keys():									# If S1 not in dictionary, add it and S2
-		SE_dict[nameS1] = [nameS2, nameBroken]
-	cat_SE(SE_dict)														# Concatenate S1 and S2 read files
+	nameS1 = read_file(root, "S1")										# Set S1 to sample.S1.ext(.gz)
+	nameS2 = read_file(root, "S2")										# Set S2 to sample.S2.ext(.gz)
+	nameBroken = read_file(root, "broken")
+	if nameS1 not in SE_dict.keys():									# If S1 not in dictionary, add it with the
+		SE_dict[nameS1] = []											# S1, S2 and broken files that are present
+		for file in [nameS1, nameS2, nameBroken]:
+			if os.path.exists("./"+options.directory+"/"+file):
+				SE_dict[nameS1].append(file)
+			else:
+				print "\n***No "+file+", skipping it***\n"
 #	print SE_dict
 	return SE_dict														# Return SE_dict for future use
 
 
 #################################################
-###        Concatenate single-end reads       ###
+###         Chain single-end read files       ###
 #################################################
-	
-def cat_SE(SE_dict):
-	print "\n***Concatenating broken pairs (ignore errors)***\n"
-	for key in SE_dict.keys():											# For each S1 key in SE_dict
-		foo = key.split(".")											# split by '.'
-		file = foo[0]+".SE."+options.ext								# output file = sample.SE.ext
-		value = SE_dict[key]											# look up S2 value
-# command = $ cat sample.S1.ext sample.S2.ext sample.broken.ext > sample.SE.ext (may error if no S2 or broken)
-		print "cat ./"+options.directory+"/"+key+" ./"+options.directory+"/"+value[0]+" ./+options.directory+"/"+value[1]+" > ./"+options.directory+"/"+file
-		os.system("cat ./"+options.directory+"/"+key+" ./"+options.directory+"/"+value[0]+" ./+options.directory+"/"+value[1]+" > ./"+options.directory+"/"+file)
+
+def SE_feeder(files, stream):											# Start feeding the single-end read files to bwa
+	feeder = threading.Thread(target = SE_reads, args = (files, stream))
+	feeder.daemon = True
+	feeder.start()
+	return feeder
+
+def SE_reads(files, stream):											# S1, S2 and broken reads one after another into
+	try:																# bwa's stdin (no concatenated copy on disk)
+		for file in files:
+			path = "./"+options.directory+"/"+file
+			if file.endswith(".gz"):									# Decompressed on the fly
+				handle = subprocess.Popen(["gzip", "-dc", path], stdout = subprocess.PIPE).stdout
+			else:
+				handle = open(path, "rb")
+			last = "\n"
+			while True:
+				chunk = handle.read(1 << 20)
+				if not chunk:
+					break
+				stream.write(chunk)
+				last = chunk[-1]
+			handle.close()
+			if last != "\n":											# (keep the next file's first record whole)
+				stream.write("\n")
+	except IOError, error:
+		if error.errno != errno.EPIPE:									# (a broken pipe is bwa stopping, its error is shown)
+			print "\n***Error: "+str(error)+", single-end reads after this point are not mapped!***\n"
+	finally:
+		try:
+			stream.close()
+		except IOError:
+			pass
+
+
+#################################################
+###        Plain or compressed read files     ###
+#################################################
+
+def read_file(root, kind):
+	name = str(root)+"."+kind+"."+str(options.ext)						# sample.kind.ext
+	if not os.path.exists("./"+options.directory+"/"+name) and os.path.exists("./"+options.directory+"/"+name+".gz"):
+		name = name+".gz"												# or sample.kind.ext.gz if only it is present
+	return name
+
+def fastq_records(path):												# FASTQ records (4 lines each) of a plain or .gz file
+	if path.endswith(".gz"):
+		handle = subprocess.Popen(["gzip", "-dc", path], stdout = subprocess.PIPE).stdout
+	else:
+		handle = open(path, "r")
+	while True:
+		record = [handle.readline(), handle.readline(), handle.readline(), handle.readline()]
+		if not record[0]:
+			break
+		if not record[3].endswith("\n"):								# (last line of a file without a final newline)
+			record[3] = record[3]+"\n"
+		yield record
+	handle.close()
 
 
 #################################################
@@ -114,15 +212,17 @@ def SE_map(name):
 	for key in SE_dict.keys():											# for each SE_dict key
 		foo = key.split(".")											# split by '.'
 		print "\n***Mapping single-end reads from "+foo[0]+"***\n"
-		input = foo[0]+".SE."+options.ext								# input SE file for mapping
 		file = foo[0]+".SE.sam"											# output SE file from mapping (.sam)
 		if options.bwa == None:											# If no additional bwa options passed
 			params = ""
 		else:															# If additional bwa options passed
 			params = options.bwa
-# command = $ bwa mem -t <input_threads> <other_bwa_opts> <reference> <SE_input> > ./mapping/<SAM_output> !! output put into 'mapping'
-		print "bwa mem -t "+str(options.threads)+" "+str(params)+" ./"+options.reference+" ./"+options.directory+"/"+input+" > ./mapping/"+file
-		os.system("bwa mem -t "+str(options.threads)+" "+str(params)+" ./"+options.reference+" ./"+options.directory+"/"+input+" > ./mapping/"+file)
+# command = $ bwa mem -t <input_threads> <other_bwa_opts> <reference> - > ./mapping/<SAM_output> !! SE reads from stdin, output put into 'mapping'
+		print "bwa mem -t "+str(options.threads)+" "+str(params)+" "+options.reference+" - > ./mapping/"+file+"   (reads: "+", ".join(SE_dict[key])+")"
+		aligner = subprocess.Popen("bwa mem -t "+str(options.threads)+" "+str(params)+" "+options.reference+" - > ./mapping/"+file, shell = True, stdin = subprocess.PIPE)
+		feeder = SE_feeder(SE_dict[key], aligner.stdin)
+		aligner.wait()
+		feeder.join()
 		sam2bam(file)													# Run sam2bam
 
 
@@ -133,9 +233,8 @@ def SE_map(name):
 def make_PE_dict(name):
 	PE_dict = {}
 	root = name															# sample name is root
-	ext = options.ext													# user-specified extension
-	nameP1 = str(root)+".P1."+str(ext)									# name of P1 read
-	nameP2 = str(root)+".P2."+str(ext)									# name of P2 read
+	nameP1 = read_file(root, "P1")										# name of P1 read
+	nameP2 = read_file(root, "P2")										# name of P2 read
 	if nameP1 not in PE_dict.keys():									# if P1 read not in dictionary
 		PE_dict[nameP1] = nameP2										# add P1 as key and P2 as value
 #	print PE_dict
@@ -158,8 +257,8 @@ def PE_map(name):
 		else:															# If additional bwa options passed
 			params = options.bwa
 # command = $ bwa mem -t <input_threads> <other_bwa_opts> <reference> <P1_input> <P2_input> > ./mapping/<SAM_output> !! output put into 'mapping'
-		print "bwa mem -t "+str(options.threads)+" "+str(params)+" ./"+options.reference+" ./"+options.directory+"/"+key+" ./"+options.directory+"/"+value+" > ./mapping/"+file
-		os.system("bwa mem -t "+str(options.threads)+" "+str(params)+" ./"+options.reference+" ./"+options.directory+"/"+key+" ./"+options.directory+"/"+value+" > ./mapping/"+file)
+		print "bwa mem -t "+str(options.threads)+" "+str(params)+" "+options.reference+" ./"+options.directory+"/"+key+" ./"+options.directory+"/"+value+" > ./mapping/"+file
+		os.system("bwa mem -t "+str(options.threads)+" "+str(params)+" "+options.reference+" ./"+options.directory+"/"+key+" ./"+options.directory+"/"+value+" > ./mapping/"+file)
 		sam2bam(file)													# run sam2bam
 
 
@@ -241,16 +340,374 @@ def SE_bam_process(name):
 	print "samtools view -h ./mapping/"+Sort_out+".bam > ./mapping/"+Sort_out+".sam"
 	os.system("samtools view -h ./mapping/"+Sort_out+".bam > ./mapping/"+Sort_out+".sam")
 
+#################################################
+###   Stream mapping into a sorted BAM file   ###
+#################################################
+
+def stream_map(name):
+	if options.bwa == None:												# If no additional bwa options passed
+		params = ""
+	else:																# If additional bwa options passed
+		params = options.bwa
+	bwa = "bwa mem -t "+str(options.threads)+" "+str(params)+" "+options.reference+" "
+	commands = []
+	if options.paired == True:
+		PE_dict = make_PE_dict(name)
+		for key in PE_dict.keys():										# bwa mem <P1_input> <P2_input>
+			commands.append([bwa+"./"+options.directory+"/"+key+" ./"+options.directory+"/"+PE_dict[key], None])
+		Sort_out = name+".merge.sort"									# same names as PE_bam_process
+	else:
+		Sort_out = name+".sort"											# same names as SE_bam_process
+	SE_dict = make_SE_dict(name)
+	for key in SE_dict.keys():											# bwa mem - (SE reads from stdin)
+		commands.append([bwa+"-", SE_dict[key]])
+# command = $ samtools sort -@ <threads> -m <mem> -T <tmp_prefix> -o ./mapping/<sort_prefix>.bam - !! SAM read from stdin
+	sort = "samtools sort -@ "+str(options.sort_threads)+" -m "+str(options.sort_mem)+" -T ./mapping/"+Sort_out+".tmp -o ./mapping/"+Sort_out+".bam -"
+	print "\n***Mapping reads from "+name+" straight into a sorted BAM***\n"
+	print sort
+	sorter = subprocess.Popen(sort, shell = True, stdin = subprocess.PIPE)
+	counts = new_flag_counts()
+	for number, [command, files] in enumerate(commands):				# PE alignments first, then SE alignments
+		if files is None:
+			print command
+			aligner = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE)
+		else:
+			print command+"   (reads: "+", ".join(files)+")"
+			aligner = subprocess.Popen(command, shell = True, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+			feeder = SE_feeder(files, aligner.stdin)
+		for line in aligner.stdout:
+			if line.startswith("@"):									# Keep the header of the first alignment only
+				if number == 0:
+					sorter.stdin.write(line)
+				continue
+			count_flags(counts, line)
+			sorter.stdin.write(line)
+		if files is not None:
+			feeder.join()
+		if aligner.wait() != 0:
+			print "\n***Error: mapping failed for "+name+" (see bwa output above)!***\n"
+	finish_sort(name, Sort_out, sorter, counts)
+
+def finish_sort(name, Sort_out, sorter, counts):						# Index the sorted BAM and write its report
+	sorter.stdin.close()
+	if sorter.wait() != 0:
+		print "\n***Error: sorting failed for "+name+" (see samtools output above)!***\n"
+		return
+## INDEX MAPPING
+	print "\n***Indexing BAM***\n"
+	print "samtools index ./mapping/"+Sort_out+".bam"
+	os.system("samtools index ./mapping/"+Sort_out+".bam")
+## GENERATE MAPPING REPORT (counted while streaming)
+	print "\n***Writing mapping summary report***\n"
+	report = open("./mapping/"+Sort_out+".bam.report", "w")
+	report.write(flagstat_report(counts))
+	report.close()
+	print flagstat_report(counts)
+
+
+#################################################
+###   Map many samples with one bwa process   ###
+#################################################
+
+def batch_map(names):
+	order = sorted(names)
+	if options.bwa == None:												# If no additional bwa options passed
+		params = ""
+	else:																# If additional bwa options passed
+		params = options.bwa
+# command = $ bwa mem -p -t <threads> <other_bwa_opts> <reference> - !! interleaved reads of all samples from stdin
+	bwa = "bwa mem -p -t "+str(options.threads)+" "+str(params)+" "+options.reference+" -"
+	print "\n***Mapping "+str(len(order))+" sample(s) with one bwa process***\n"
+	print bwa
+	inputs = [batch_inputs(name) for name in order]						# (checked before bwa starts)
+	errors = {}															# {sample number: problems with its reads}
+	aligner = subprocess.Popen(bwa, shell = True, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+	feeder = threading.Thread(target = batch_reads, args = (inputs, aligner.stdin, errors))
+	feeder.daemon = True
+	feeder.start()
+	header = []
+	current = None														# [number, name, Sort_out, sorter, counts]
+	mapped = {}
+	for line in aligner.stdout:
+		if line.startswith("@"):
+			header.append(line)
+			continue
+		number, line = line.split(":", 1)								# Sample number added to each read name
+		number = int(number)
+		if current is None or number != current[0]:
+			if current is not None:
+				finish_sample(current, errors)
+			if number in mapped:										# (bwa keeps the input order, so never)
+				raise SystemExit("\n***Error: alignments of "+order[number]+" came back out of order!***\n")
+			mapped[number] = 1
+			current = batch_sorter(number, order[number], header)
+		count_flags(current[4], line)
+		current[3].stdin.write(line.rstrip("\n")+"\tRG:Z:"+current[1]+"\n")
+	if current is not None:
+		finish_sample(current, errors)
+	feeder.join()
+	failed = aligner.wait() != 0
+	if failed:
+		print "\n***Error: batch mapping failed (see bwa output above)!***\n"
+	for number, name in enumerate(order):
+		if number not in mapped:
+			print "\n***No reads found for "+name+"!***\n"
+			if number in errors:
+				print "\n***Error: "+"; ".join(errors[number])+", no BAM written for "+name+"!***\n"
+	if errors:															# Samples with reads that could not be fed to bwa
+		raise SystemExit("\n***Error: no BAM written for "+", ".join([order[number] for number in sorted(errors)])+" (see errors above)!***\n")
+	if failed:
+		raise SystemExit(1)
+
+def batch_inputs(name):												# [[P1, P2] pairs, single-end files] of a sample
+	pairs = []
+	if options.paired == True:
+		PE_dict = make_PE_dict(name)
+		for key in PE_dict.keys():
+			missing = [file for file in [key, PE_dict[key]] if not os.path.exists("./"+options.directory+"/"+file)]
+			if missing:													# Skip the pairs, as with a missing S1/S2/broken
+				print "\n***No "+" or ".join(missing)+", skipping the paired reads of "+name+"***\n"
+			else:
+				pairs.append([key, PE_dict[key]])
+	SE_dict = make_SE_dict(name)
+	return [pairs, [file for key in SE_dict.keys() for file in SE_dict[key]]]
+
+def batch_reads(inputs, stream, errors):								# Feed each sample's reads to bwa in turn
+	try:
+		for number, [pairs, files] in enumerate(inputs):
+			prefix = "@"+str(number)+":"
+			feeds = [[batch_pairs, [prefix, key, value, stream]] for [key, value] in pairs]
+			feeds += [[batch_singles, [prefix, file, stream]] for file in files]
+			for [feed, arguments] in feeds:								# A bad file is noted (before the next sample's
+				problem = batch_feed(feed, arguments)					# reads, so before this sample's BAM is finished)
+				if problem is not None:									# and the other files and samples still mapped
+					errors.setdefault(number, []).append(problem)
+	except IOError:														# (a broken pipe is bwa stopping, its error is shown)
+		pass
+	finally:
+		try:
+			stream.close()
+		except IOError:
+			pass
+
+def batch_feed(feed, arguments):										# Problem with a file, or None; a broken pipe stops
+	try:																# all feeding
+		return feed(*arguments)
+	except IOError, error:
+		if error.errno == errno.EPIPE:
+			raise
+		return str(error)
+
+def batch_pairs(prefix, key, value, stream):							# Pairs interleaved (bwa mem -p pairs them)
+	mates = fastq_records("./"+options.directory+"/"+value)
+	for record in fastq_records("./"+options.directory+"/"+key):
+		mate = next(mates, None)
+		if mate is None:
+			return value+" has fewer reads than "+key
+		stream.write(prefix+record[0][1:]+record[1]+"+\n"+record[3])
+		stream.write(prefix+mate[0][1:]+mate[1]+"+\n"+mate[3])
+	if next(mates, None) is not None:
+		return value+" has more reads than "+key
+
+def batch_singles(prefix, file, stream):								# Single-end and broken pair reads
+	for record in fastq_records("./"+options.directory+"/"+file):
+		stream.write(prefix+record[0][1:]+record[1]+"+\n"+record[3])
+
+def batch_output(name):
+	if options.paired == True:
+		return name+".merge.sort"										# same names as PE_bam_process
+	return name+".sort"													# same names as SE_bam_process
+
+def batch_sorter(number, name, header):								# Sorted BAM of one sample, with its read group
+	Sort_out = batch_output(name)
+# command = $ samtools sort -@ <threads> -m <mem> -T <tmp_prefix> -o ./mapping/<sort_prefix>.bam - !! SAM read from stdin
+	sort = "samtools sort -@ "+str(options.sort_threads)+" -m "+str(options.sort_mem)+" -T ./mapping/"+Sort_out+".tmp -o ./mapping/"+Sort_out+".bam -"
+	print "\n***Sorting alignments of "+name+"***\n"
+	print sort
+	sorter = subprocess.Popen(sort, shell = True, stdin = subprocess.PIPE)
+	for line in header:													# bwa's header, with the read group
+		if not line.startswith("@PG"):									# before the program lines
+			sorter.stdin.write(line)
+	sorter.stdin.write("@RG\tID:"+name+"\tSM:"+name+"\n")
+	for line in header:
+		if line.startswith("@PG"):
+			sorter.stdin.write(line)
+	return [number, name, Sort_out, sorter, new_flag_counts()]
+
+def finish_sample(current, errors):
+	number, name, Sort_out, sorter, counts = current
+	if number in errors:												# Some of its reads were not mapped: no partial BAM
+		sorter.stdin.close()
+		sorter.wait()
+		if os.path.exists("./mapping/"+Sort_out+".bam"):
+			os.remove("./mapping/"+Sort_out+".bam")
+		print "\n***Error: "+"; ".join(errors[number])+", no BAM written for "+name+"!***\n"
+		return
+	finish_sort(name, Sort_out, sorter, counts)
+	print "\n***Mapping complete for "+name+"! See 'mapping' directory for results!***\n"
+
+
+#################################################
+###    Mapping summary (flagstat) counters    ###
+#################################################
+
+flagstat_counts = ["total", "secondary", "supplementary", "duplicates", "mapped", "paired", "read1", "read2", "proper",
+	"both_mapped", "singletons", "diff_chr", "diff_chr_q5"]
+
+def new_flag_counts():
+	return [dict([[stat, 0] for stat in flagstat_counts]) for qc in [0, 1]]	# [QC-passed, QC-failed] counts
+
+def count_flags(counts, line):											# Counts as in 'samtools flagstat'
+	fields = line.split("\t", 7)										# QNAME FLAG RNAME POS MAPQ CIGAR RNEXT ...
+	flag = int(fields[1])
+	count = counts[1 if flag & 0x200 else 0]							# QC-failed reads (0x200) are counted apart
+	count["total"] += 1
+	if flag & 0x100:													# secondary alignment
+		count["secondary"] += 1
+	elif flag & 0x800:													# supplementary alignment
+		count["supplementary"] += 1
+	elif flag & 0x1:													# primary alignment of a paired read
+		count["paired"] += 1
+		if flag & 0x2 and not flag & 0x4:
+			count["proper"] += 1
+		if flag & 0x40:
+			count["read1"] += 1
+		if flag & 0x80:
+			count["read2"] += 1
+		if flag & 0x8 and not flag & 0x4:
+			count["singletons"] += 1
+		if not flag & 0x4 and not flag & 0x8:
+			count["both_mapped"] += 1
+			if fields[6] != "=" and fields[6] != fields[2]:				# mate mapped to a different reference sequence
+				count["diff_chr"] += 1
+				if int(fields[4]) >= 5:
+					count["diff_chr_q5"] += 1
+	if not flag & 0x4:
+		count["mapped"] += 1
+	if flag & 0x400:
+		count["duplicates"] += 1
+
+def flagstat_report(counts):											# Report in the layout of 'samtools flagstat'
+	def both(stat):
+		return str(counts[0][stat])+" + "+str(counts[1][stat])
+	def percents(stat, total):
+		values = []
+		for count in counts:
+			if count[total] == 0:
+				values.append("N/A")
+			else:
+				values.append("%.2f%%" % (100.0 * count[stat] / count[total]))
+		return "("+values[0]+" : "+values[1]+")"
+	lines = [both("total")+" in total (QC-passed reads + QC-failed reads)",
+		both("secondary")+" secondary",
+		both("supplementary")+" supplementary",
+		both("duplicates")+" duplicates",
+		both("mapped")+" mapped "+percents("mapped", "total"),
+		both("paired")+" paired in sequencing",
+		both("read1")+" read1",
+		both("read2")+" read2",
+		both("proper")+" properly paired "+percents("proper", "paired"),
+		both("both_mapped")+" with itself and mate mapped",
+		both("singletons")+" singletons "+percents("singletons", "paired"),
+		both("diff_chr")+" with mate mapped to a different chr",
+		both("diff_chr_q5")+" with mate mapped to a different chr (mapQ>=5)"]
+	return "\n".join(lines)+"\n"
+
+
 #################################################
 ###       Remove intermediate SAM output      ###
 #################################################
 	
-def remove_sams():
+def remove_sams(name):
 	if options.sams == True:										# If user elects to keep all SAMs
 		print "\n***As specified, SAM output will be saved!***\n"
-	else:															# Else, if no election to keep SAMs, delete anything with *.sam
+	else:															# Else, if no election to keep SAMs, delete this sample's *.sam
 		print "\n***Removing unnecessary intermediate SAM output!***\n"
-		os.system("rm -f ./mapping/*.sam")
+		for file in os.listdir("./mapping"):						# (only its own, so samples mapped alongside are left alone)
+			if file.startswith(name+".") and file.endswith(".sam"):
+				os.remove("./mapping/"+file)
+
+
+#################################################
+###         Map one sample's read files       ###
+#################################################
+
+def map_sample(name):
+	if options.stream == True:
+		stream_map(name)											# Map straight into one sorted BAM (no SAMs to remove)
+	elif options.single == True:									# If user specifies reads as single-end only
+		SE_map(name)												# Run single-end mapping pipeline
+		SE_bam_process(name)
+		remove_sams(name)
+	elif options.paired == True:									# If user specifies reads as paired-end
+		PE_map(name)												# Run paired-end mapping pipeline
+		SE_map(name)
+		PE_bam_process(name)
+		remove_sams(name)
+	print "\n***Mapping complete for "+name+"! See 'mapping' directory for results!***\n"
+	return name
+
+
+#################################################
+###    Map several samples within a budget    ###
+#################################################
+
+def map_concurrently(names):
+	order = sorted(names.keys(), key = lambda name: names[name], reverse = True)	# Largest samples first
+	jobs = mapping_slots(len(order))
+	print "\n***Mapping "+str(jobs)+" sample(s) at once: bwa with "+str(options.threads)+" thread(s) per sample"+(", sorting with "+str(options.sort_threads) if options.stream == True else "")+"***\n"
+	if jobs == 1:
+		for name in order:
+			map_sample(name)
+		return
+	pool = multiprocessing.Pool(jobs)
+	for name in pool.imap_unordered(map_sample_logged, order):		# Workers keep the queue full as samples finish
+		print "\n***Mapping complete for "+name+" (see ./mapping/"+name+".mapping.log)***\n"
+	pool.close()
+	pool.join()
+
+def map_sample_logged(name):										# map_sample with all output sent to the sample's log
+	sys.stdout.flush()
+	log = open("./mapping/"+name+".mapping.log", "w")
+	os.dup2(log.fileno(), 1)										# covers the output of bwa and samtools too
+	os.dup2(log.fileno(), 2)
+	try:
+		return map_sample(name)
+	finally:
+		sys.stdout.flush()
+
+def mapping_slots(samples):											# Samples to map at once, setting the threads for each
+	cores = max(1, int(options.cores))
+	jobs = max(1, min(samples, cores / max(1, int(options.job_threads))))
+	if options.memory is not None:									# Each sample needs the index and its sorting memory
+		job_memory = index_memory() + sorting_threads(cores / jobs) * memory_bytes(options.sort_mem)
+		jobs = max(1, min(jobs, memory_bytes(options.memory) / max(1, job_memory)))
+	threads = max(1, cores / jobs)
+	if options.stream == True:										# Split each sample's threads between bwa and sorting
+		options.sort_threads = str(sorting_threads(threads))
+		options.threads = str(max(1, threads - sorting_threads(threads)))
+	else:															# (the samtools steps run on one thread)
+		options.threads = str(threads)
+	return jobs
+
+def sorting_threads(threads):										# About a quarter of a sample's threads sort and compress
+	if options.stream == True:
+		return max(1, threads / 4)
+	return 1
+
+def index_memory():													# Memory bwa needs for the reference (about the index size)
+	memory = 0
+	for ext in ["", ".bwt", ".sa", ".pac", ".ann", ".amb"]:
+		if os.path.exists(options.reference+ext):
+			memory += os.path.getsize(options.reference+ext)
+	return memory
+
+def memory_bytes(text):												# e.g., 768M or 64G -> bytes
+	units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+	text = str(text).strip().upper().rstrip("B")
+	if text[-1:] in units:
+		return int(float(text[:-1]) * units[text[-1]])
+	return int(float(text))
 
 
 #################################################
@@ -264,6 +721,8 @@ def main():
 		print "\n***Error: specify directory containing read files!***\n"
 	if options.ext is None:											# User didn't specify read file extension (e.g., fastq)
 		print "\n***Error: specify the file extension for the read files!***\n"
+	elif options.single != True and options.paired != True:		# If user doesn't specified single or paired, error
+		print "\n***Error: specify whether reads are single-end only ('-s') or paired end ('-p')!***\n"
 	else:
 		setup()														# Setup the pipeline environment
 		print "\n***Running mapping pipeline***\n"
@@ -271,26 +730,23 @@ def main():
 			print "\n***Gathing read files from specified directory***\n"
 		names = {}
 		for file in files:
-			if file.endswith("."+options.ext):						# If file ends with specified extension
+			if file.endswith("."+options.ext) or file.endswith("."+options.ext+".gz"):	# If file ends with specified extension (.gz)
 				foo = file.split(os.extsep)
 				name = foo[0]										# Take root of file name (everything up to 1st period)
 				if name not in names.keys():
-					names[name] = 1									# Store each unique file root in dictionary
+					names[name] = 0									# Store each unique file root in dictionary
+				names[name] += os.path.getsize(os.path.join(root, file))	# with the size of its read files
 #		print names
-		for name in names.keys():									# For each unique file name in dictionary
-			if options.single == True:								# If user specifies reads as single-end only
-				SE_map(name)										# Run single-end mapping pipeline
-				SE_bam_process(name)
-				remove_sams()
-				print "\n***Mapping complete! See 'mapping' directory for results!***\n"
-			elif options.paired == True:							# If user specifies reads as paired-end
-				PE_map(name)										# Run paired-end mapping pipeline
-				SE_map(name)
-				PE_bam_process(name)
-				remove_sams()
-				print "\n***Mapping complete for "+name+"! See 'mapping' directory for results!***\n"
-			else:													# If user doesn't specified single or paired, error
-				print "\n***Error: specify whether reads are single-end only ('-s') or paired end ('-p')!***\n"
+		if options.batch == True:									# Map all samples with one bwa process
+			options.stream = True
+			if options.cores is not None:
+				mapping_slots(1)
+			batch_map(names)
+		elif options.cores is not None:								# Map several samples at once within the budget
+			map_concurrently(names)
+		else:
+			for name in names.keys():								# For each unique file name in dictionary
+				map_sample(name)
 
 
 #################################################
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+##print __name__
+
+import fcntl
+import hashlib
+import optparse
+import os
+import shutil
+import subprocess
+
+usage_line = """
+reference_cache.py
+
+Version 1.0 (17 October, 2026)
+License: GNU GPLv2
+To report bugs or errors, please contact Daren Card (dcard@uta.edu).
+This script is provided as-is, with no support and no guarantee of proper or desirable functioning.
+
+Shared cache of reference genome indexes, used by read_mapping.py and the variant_calling_from_BAM scripts so that
+a reference is only indexed once, no matter how many runs (or which directories) use it. Each reference is stored
+under the MD5 checksum of its FASTA file (so renamed or copied references share one entry), together with its
+'samtools faidx' index and a sequence dictionary (with the MD5 of each sequence). The bwa index is stored within that
+entry for each bwa version, as indexes from different versions are not guaranteed to be compatible. Entries are
+built in a temporary directory under a lock file and only then moved into place, so runs started at the same time
+wait for one build instead of racing, and an interrupted build is never used. Each entry has a manifest of its files,
+with their sizes checked each time the entry is used (and their checksums with '--verify'); a damaged entry is
+rebuilt.
+
+The cache directory is '--index_cache', or the REFERENCE_CACHE environment variable, or ~/.reference_cache. Running
+this script fills (or checks) the cache for a reference ahead of time:
+
+python reference_cache.py --reference <reference.fasta> [--index_cache <directory> --samtools <path_to_samtools>
+--bwa <path_to_bwa> --no_bwa --verify]
+"""
+
+default_cache = os.environ.get("REFERENCE_CACHE", os.path.join(os.path.expanduser("~"), ".reference_cache"))
+chunk_size = 1 << 20
+
+
+#################################################
+###      Cached FASTA, .fai and dictionary    ###
+#################################################
+
+def cached_fasta(fasta, cache = None, samtools = "samtools", verify = False):
+	cache = cache_directory(cache)
+	checksum = fasta_checksum(fasta, cache)
+	entry = os.path.join(cache, checksum)
+	if not entry_ready(entry, verify):
+		lock = lock_entry(entry)										# Only one run builds an entry; the others wait
+		try:
+			if not entry_ready(entry, verify):						# (and find it ready when they get the lock)
+				print "\n***Adding "+fasta+" to the reference cache ("+entry+")***\n"
+				build_entry(entry, fasta_files, [fasta, checksum, samtools, entry])
+		finally:
+			unlock_entry(lock)
+	return os.path.join(entry, "reference.fa")
+
+def fasta_files(build, fasta, checksum, samtools, entry):
+	copy = os.path.join(build, "reference.fa")
+	if file_checksum(fasta, copy) != checksum:
+		raise SystemExit("\n***Error: "+fasta+" changed while being copied into the reference cache!***\n")
+	if subprocess.call([samtools, "faidx", copy]) != 0:
+		raise SystemExit("\n***Error: '"+samtools+" faidx' failed on "+fasta+"!***\n")
+	write_dictionary(copy, os.path.join(build, "reference.dict"), os.path.join(entry, "reference.fa"))
+
+def write_dictionary(fasta, dictionary, location):				# Sequence dictionary (as from 'samtools dict')
+	output = open(dictionary, "w")
+	output.write("@HD\tVN:1.5\n")
+	name = None
+	for line in open(fasta, "r"):
+		if line.startswith(">"):
+			if name is not None:
+				output.write("@SQ\tSN:"+name+"\tLN:"+str(length)+"\tM5:"+checksum.hexdigest()+"\tUR:file:"+location+"\n")
+			name = line[1:].split()[0]
+			length = 0
+			checksum = hashlib.md5()
+		else:
+			sequence = "".join(line.split()).upper()
+			length += len(sequence)
+			checksum.update(sequence)
+	if name is not None:
+		output.write("@SQ\tSN:"+name+"\tLN:"+str(length)+"\tM5:"+checksum.hexdigest()+"\tUR:file:"+location+"\n")
+	output.close()
+
+
+#################################################
+###       Cached bwa index (per version)      ###
+#################################################
+
+def cached_bwa_index(fasta, cache = None, samtools = "samtools", bwa = "bwa", verify = False):
+	reference = cached_fasta(fasta, cache, samtools, verify)
+	entry = os.path.join(os.path.dirname(reference), "bwa-"+bwa_version(bwa))
+	if not entry_ready(entry, verify):
+		lock = lock_entry(entry)
+		try:
+			if not entry_ready(entry, verify):
+				print "\n***Indexing reference genome into the reference cache ("+entry+")***\n"
+				build_entry(entry, bwa_files, [reference, bwa])
+		finally:
+			unlock_entry(lock)
+	return os.path.join(entry, "reference.fa")						# Prefix of the index files, as for 'bwa mem'
+
+def bwa_files(build, reference, bwa):
+	if subprocess.call([bwa, "index", "-p", os.path.join(build, "reference.fa"), reference]) != 0:
+		raise SystemExit("\n***Error: 'bwa index' failed on "+reference+"!***\n")
+
+def bwa_version(bwa):											# e.g., 0.7.17-r1188 (from bwa's usage message)
+	try:
+		process = subprocess.Popen([bwa], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+	except OSError:
+		raise SystemExit("\n***Error: can't run '"+bwa+"' to index the reference!***\n")
+	output, error = process.communicate()
+	for line in (output+error).splitlines():
+		if line.startswith("Version:"):
+			return line.split()[1].replace("/", "_")
+	return "unknown"
+
+
+#################################################
+###       Building and checking entries       ###
+#################################################
+
+def build_entry(entry, make_files, arguments):					# Build in a temporary directory, then move into place
+	parent, name = os.path.split(entry)
+	for file in os.listdir(parent):								# Leftovers from interrupted builds or damaged entries
+		if file == name:
+			print "\n***Replacing damaged reference cache entry "+entry+"***\n"
+		if file == name or file.startswith(name+".tmp"):
+			shutil.rmtree(os.path.join(parent, file))
+	build = entry+".tmp"+str(os.getpid())
+	os.mkdir(build)
+	make_files(build, *arguments)
+	manifest = open(os.path.join(build, "MANIFEST.tmp"), "w")
+	for file in sorted(os.listdir(build)):
+		path = os.path.join(build, file)
+		if os.path.isfile(path) and file != "MANIFEST.tmp":
+			manifest.write(file+"\t"+str(os.path.getsize(path))+"\t"+file_checksum(path)+"\n")
+	manifest.close()
+	os.rename(os.path.join(build, "MANIFEST.tmp"), os.path.join(build, "MANIFEST"))
+	os.rename(build, entry)
+
+def entry_ready(entry, verify):									# Entry is complete and matches its manifest
+	manifest = os.path.join(entry, "MANIFEST")
+	if not os.path.exists(manifest):
+		return False
+	for line in open(manifest, "r"):
+		file, size, checksum = line.rstrip("\n").split("\t")
+		path = os.path.join(entry, file)
+		if not os.path.isfile(path) or os.path.getsize(path) != int(size) or (verify and file_checksum(path) != checksum):
+			return False
+	return True
+
+def lock_entry(entry):											# Lock file held while an entry is built (released
+	handle = open(entry+".lock", "a")								# by the system if the build is killed)
+	try:
+		fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+	except IOError:
+		print "\n***Waiting for another run to finish "+entry+"***\n"
+		fcntl.flock(handle, fcntl.LOCK_EX)
+	return handle
+
+def unlock_entry(handle):
+	fcntl.flock(handle, fcntl.LOCK_UN)
+	handle.close()
+
+
+#################################################
+###             FASTA checksums               ###
+#################################################
+
+def fasta_checksum(fasta, cache):								# MD5 of the FASTA, remembered by path, size and time
+	path = os.path.realpath(fasta)
+	if not os.path.isfile(path):
+		raise SystemExit("\n***Error: can't find reference "+fasta+"!***\n")
+	stamp = path+"\t"+str(os.path.getsize(path))+"\t"+repr(os.path.getmtime(path))+"\t"
+	known = os.path.join(cache, "checksums")
+	if os.path.exists(known):
+		for line in open(known, "r"):
+			if line.startswith(stamp):
+				return line.rstrip("\n")[len(stamp):]
+	checksum = file_checksum(path)
+	handle = open(known, "a")										# One short append per line, so runs can share it
+	handle.write(stamp+checksum+"\n")
+	handle.close()
+	return checksum
+
+def file_checksum(path, copy = None):							# MD5 of a file, optionally copying it along the way
+	checksum = hashlib.md5()
+	handle = open(path, "rb")
+	output = open(copy, "wb") if copy is not None else None
+	while True:
+		chunk = handle.read(chunk_size)
+		if not chunk:
+			break
+		checksum.update(chunk)
+		if output is not None:
+			output.write(chunk)
+	handle.close()
+	if output is not None:
+		output.close()
+	return checksum.hexdigest()
+
+def cache_directory(cache):
+	cache = os.path.abspath(os.path.expanduser(cache or default_cache))
+	if not os.path.isdir(cache):
+		try:
+			os.makedirs(cache)
+		except OSError:												# (another run may have just made it)
+			if not os.path.isdir(cache):
+				raise
+	return cache
+
+
+#################################################
+###        	   Main Program               ###
+#################################################
+
+def main():
+	parser = optparse.OptionParser(usage = usage_line)
+	parser.add_option("--reference", action = "store", dest = "reference", help = "reference genome in FASTA format")
+	parser.add_option("--index_cache", action = "store", dest = "cache", help = "reference cache directory [$REFERENCE_CACHE or ~/.reference_cache]")
+	parser.add_option("--samtools", action = "store", dest = "samtools", help = "path to SAMtools [samtools]", default = "samtools")
+	parser.add_option("--bwa", action = "store", dest = "bwa", help = "path to bwa [bwa]", default = "bwa")
+	parser.add_option("--no_bwa", action = "store_true", dest = "no_bwa", help = "only cache the FASTA, .fai and dictionary (no bwa index)")
+	parser.add_option("--verify", action = "store_true", dest = "verify", help = "check the checksums of all cached files", default = False)
+	options, args = parser.parse_args()
+	if options.reference is None:
+		print "\n***Error: specify the reference to cache!***\n"
+	elif options.no_bwa == True:
+		print cached_fasta(options.reference, options.cache, options.samtools, options.verify)
+	else:
+		print cached_bwa_index(options.reference, options.cache, options.samtools, options.bwa, options.verify)
+
+
+#################################################
+###        	Call Main Program             ###
+#################################################
+
+if __name__ == "__main__":
+	main()
@@ -5,6 +5,7 @@
 import os
 import optparse
 import re
+import reference_cache
 
 usage_line = """
 Variant_calling_from_BAM.py
@@ -18,8 +19,10 @@ This script produces both an mpileup BCF file and a variants VCF file using a se
 as input. The user simple specifies the directory containing the BAM mapping files and a tab-delimited \
 sample sheet specifying which samples are to be included in the mpileup and variants files. This sample \
 sheet enables the user to subset data, if desired, and orders the samples in the mpileup and variants files \
-so that downstream scripts will work properly. The user must also specify the faidx-indexed reference \
-(FASTA) and can specify a prefix for the output files. The user also must specify the path or the executable \
+so that downstream scripts will work properly. The user must also specify the reference (FASTA), which is \
+faidx-indexed once through the shared reference cache (see reference_cache.py; the cache is in '--index_cache', \
+the REFERENCE_CACHE environment variable, or ~/.reference_cache) unless '--no_cache' is passed, and can \
+specify a prefix for the output files. The user also must specify the path or the executable \
 name for SAMtools and BCFtools v.0.X.XX (tested with v.0.1.19). Some further capability is also provided:
 	1. The option to exclude INDELS from the variants file
 	2. The option to set the amount of missing data (i.e., samples without data at a locus)
@@ -39,8 +42,8 @@ the user to specify an executable with a name other than 'samtools' or 'bcftools
 she has both version 0 and 1 on the computer.
 
 python Variant_calling_from_BAM.py --samplsheet <samplesheet.txt> --dir <dir_with_BAMs> --prefix <out_prefix> \
---samtools <path_to_samtools> --bcftools <path_to_bcftools> --ref <path_to_reference> [--indels --miss <0.XX> \
---pval <0.XX> --mpileup <mpileup.bcf> --exe <1,2>]
+--samtools <path_to_samtools> --bcftools <path_to_bcftools> --ref <path_to_reference> [--index_cache <directory> \
+--no_cache --indels --miss <0.XX> --pval <0.XX> --mpileup <mpileup.bcf> --exe <1,2>]
 """
 
 
@@ -56,7 +59,9 @@ parser.add_option("--dir", action = "store", type = "string", dest = "dir", help
 parser.add_option("--prefix", action = "store", dest = "prefix", help = "prefix for output files [out]", default = "out")
 parser.add_option("--samtools", action = "store", dest = "samtools", help = "path to SAMtools v0.X.XX, or just provide the program if it is in your path (this option is needed because of the multiple versions of SAMtools that exist)")
 parser.add_option("--bcftools", action = "store", dest = "bcftools", help = "path to BCFtools v0.X.XX, or just provide the program if it is in your path (this option is needed because of the multiple versions of BCFtools that exist)")
-parser.add_option("--ref", action = "store", dest = "ref", help = "path to the faidx-indexed reference file in FASTA format")
+parser.add_option("--ref", action = "store", dest = "ref", help = "path to the reference file in FASTA format")
+parser.add_option("--index_cache", action = "store", dest = "index_cache", help = "shared reference index cache directory [$REFERENCE_CACHE or ~/.reference_cache]")
+parser.add_option("--no_cache", action = "store_true", dest = "no_cache", help = "use the reference as is (must already be faidx-indexed)")
 parser.add_option("--indels", action = "store_true", dest = "indels", help = "do not perform INDEL calling [TRUE]", default = True)
 parser.add_option("--miss", action = "store", dest = "miss", help = "only include variants where fraction of samples covered by reads is above given FLOAT threshold (0-1) [0.50]", default = "0.50")
 parser.add_option("--pval", action = "store", dest = "pval", help = "p-value threshold for variant calling model (i.e., if P(ref|data)<FLOAT) [0.05]", default = "0.05")
@@ -104,6 +109,8 @@ def main():
 	
 	## If user wanted to create mpileup, create command and then run it
 	if "1" in options.exe:
+		if options.no_cache != True:
+			options.ref = reference_cache.cached_fasta(options.ref, options.index_cache, options.samtools)
 		mpileup = options.samtools+" mpileup -P ILLUMINA -u -g -f "+options.ref+" "+sample_list+" > ./vcf/"+options.prefix+".mpileup.bcf"
 		print mpileup
 		os.system(mpileup)